@@ -1,17 +1,23 @@
 import copy
+import hashlib
+import itertools
 import json
 import logging
-from datetime import timedelta
+import uuid
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 from http import HTTPStatus
-from typing import List
+from typing import Any, Dict, List
 
 import werkzeug.exceptions as wex
 from flask import Blueprint, current_app, jsonify, request
 from flask import render_template
 
 import tdmq.errors
+from . import arrow_io, column_spool, compression
+from .ingest_queue import ingest_queue
 from .model import EntityType, EntityCategory, Source, Timeseries
+from .record_validation import record_validator
 from .utils import convert_roi, str_to_bool
 
 logger = logging.getLogger(__name__)
@@ -29,6 +35,53 @@ ERROR_CODES = {
     500: "error_retrieving_data"
 }
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+# Endpoints whose successful responses are compressed, if the client accepts it
+_COMPRESSED_ENDPOINTS = {
+    'tdmq.sources_get',
+    'tdmq.timeseries_get',
+    'tdmq.timeseries_get_stream',
+}
+
+
+@tdmq_bp.after_request
+def compress_response(response):
+    """
+    Compress the response with the encoding negotiated with the client (see
+    tdmq.compression).  Streamed responses are compressed chunk by chunk;
+    responses shorter than COMPRESSION_MIN_SIZE are sent uncompressed.
+    """
+    if request.endpoint not in _COMPRESSED_ENDPOINTS or response.status_code != 200 or \
+       'Content-Encoding' in response.headers or response.mimetype == arrow_io.PARQUET_CONTENT_TYPE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    levels = current_app.config.get('COMPRESSION_LEVEL') or {}
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding', ''), levels.keys())
+    if encoding is None:
+        return response
+
+    min_size = current_app.config.get('COMPRESSION_MIN_SIZE', 0)
+    if response.is_streamed:
+        prefix, rest = compression.read_prefix(response.response, min_size)
+        if rest is None:
+            response.set_data(b''.join(prefix))
+            return response
+        body = itertools.chain(prefix, rest)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        body = [data]
+
+    logger.debug("Compressing response with %s", encoding)
+    response.response = compression.compress_chunks(body, encoding, levels[encoding])
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    return response
+
 
 @tdmq_bp.app_errorhandler(wex.HTTPException)
 def handle_http_exception(e):
@@ -56,6 +109,8 @@ def handle_tdmq_error(e):
         "code": e.status,
         "description": e.detail
     }
+    if isinstance(e, tdmq.errors.RecordValidationError):
+        struct['errors'] = e.errors
     return jsonify(struct), e.status
 
 
@@ -144,6 +199,12 @@ def sources_get():
     if offset:
         offset = int(offset)
 
+    data_format = rargs.pop('format', 'json')
+    if data_format not in ('json', 'parquet'):
+        raise wex.BadRequest(f"Unknown/unsupported format {data_format}")
+    if data_format == 'parquet' and not arrow_io.arrow_available():
+        raise tdmq.errors.UnsupportedFunctionality("The parquet format is not available on this server")
+
     match_attr = rargs  # everything that hasn't been popped
 
     try:
@@ -151,10 +212,32 @@ def sources_get():
     except tdmq.errors.DBOperationalError:
         raise wex.InternalServerError()
 
+    if data_format == 'parquet':
+        return _file_response(
+            arrow_io.write_sources_parquet(items), arrow_io.PARQUET_CONTENT_TYPE, "sources.parquet")
+
     res = jsonify(items)
     return res
 
 
+def _file_response(f, content_type: str, filename: str, chunk_size: int = 65536):
+    """
+    Stream the contents of the open file `f` as an attachment;  the file is
+    closed at the end.
+    """
+    def generate():
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    response = current_app.response_class(generate(), content_type=content_type)
+    response.headers["Content-Disposition"] = f"attachment;filename={filename}"
+    return response
+
+
 @tdmq_bp.route('/sources', methods=['POST'])
 @auth_required
 def sources_post():
@@ -182,6 +265,88 @@ def sources_delete(tdmq_id):
     return ('', HTTPStatus.NO_CONTENT)
 
 
+def _parse_query_timestamp(s: str):
+    try:
+        t = datetime.fromisoformat(s.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return t if t.tzinfo else t.replace(tzinfo=timezone.utc)
+
+
+def _parse_timeseries_args(rargs) -> Dict[str, Any]:
+    """
+    Parse and validate the timeseries query arguments shared by the
+    timeseries endpoints.
+    """
+    args = dict((k, rargs.get(k, None))
+                for k in ['after', 'before', 'bucket', 'fields', 'op', 'ops', 'fill', 'time_format'])
+    for k in ('after', 'before'):
+        if args[k] is not None and _parse_query_timestamp(args[k]) is None:
+            raise wex.BadRequest(f"Invalid timestamp {args[k]!r} for {k}")
+    if args['bucket'] is not None:
+        try:
+            args['bucket'] = timedelta(seconds=float(args['bucket']))
+        except ValueError as e:
+            raise wex.BadRequest(f"Invalid bucket {args['bucket']!r}") from e
+    if args['fields'] is not None:
+        args['fields'] = args['fields'].split(',')
+    if args['op'] is not None and ',' in args['op']:
+        args['op'] = args['op'].split(',')
+    if args['ops'] is not None:
+        args['ops'] = args['ops'].split(',')
+    return args
+
+
+def _timeseries_cache_info(tdmq_id, anonymize_private: bool):
+    """
+    Compute the cache validator for the timeseries requested.  The weak ETag
+    depends on the source, the (normalized) query arguments and the
+    version of the records in the requested time interval, so it can be
+    computed without running the timeseries query.  The query arguments
+    must have been validated.
+    """
+    after, before = request.args.get('after'), request.args.get('before')
+    version = Timeseries.get_version(tdmq_id, after, before)
+    key = [ request.endpoint, str(tdmq_id), sorted(request.args.items(multi=True)), version['version'] ]
+    etag = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+    # Historical data, i.e., data well in the past, can be cached by proxies
+    immutable_after = current_app.config.get('CACHE_IMMUTABLE_AFTER')
+    before_time = _parse_query_timestamp(before) if before else None
+    cacheable = immutable_after is not None and before_time is not None and \
+        before_time < datetime.now(timezone.utc) - timedelta(seconds=immutable_after)
+
+    return dict(etag=etag,
+                last_modified=version['last_ingest'],
+                cacheable=cacheable,
+                public=version['public'] and anonymize_private)
+
+
+def _set_cache_headers(response, cache_info):
+    response.set_etag(cache_info['etag'], weak=True)
+    if cache_info['last_modified']:
+        response.last_modified = cache_info['last_modified'].replace(tzinfo=timezone.utc)
+    if cache_info['cacheable']:
+        response.cache_control.max_age = current_app.config.get('CACHE_MAX_AGE', 0)
+        if cache_info['public']:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _not_modified(cache_info):
+    """
+    Returns a 304 response if the request's If-None-Match matches the
+    validator in `cache_info`; None otherwise.
+    """
+    if request.if_none_match.contains_weak(cache_info['etag']):
+        return _set_cache_headers(current_app.response_class(status=HTTPStatus.NOT_MODIFIED), cache_info)
+    return None
+
+
 @tdmq_bp.route('/sources/<uuid:tdmq_id>/timeseries_stream')
 def timeseries_get_stream(tdmq_id):
     rargs = request.args
@@ -190,41 +355,100 @@ def timeseries_get_stream(tdmq_id):
     if not anonymize_private and not _request_authorized():
         raise wex.Unauthorized("Unauthorized request for unanonymized private data")
 
-    args = dict((k, rargs.get(k, None))
-                for k in ['after', 'before', 'bucket', 'fields', 'op'])
-    if args['bucket'] is not None:
-        args['bucket'] = timedelta(seconds=float(args['bucket']))
-    if args['fields'] is not None:
-        args['fields'] = args['fields'].split(',')
+    args = _parse_timeseries_args(rargs)
     if rargs.get('sparse'):
         sparse_format = str_to_bool(rargs['sparse'])
     else:
         # By default, use a dense format if only a subset of the fields is
         # requested by the query.
-        sparse_format = not bool(args['fields'])
+        sparse_format = not bool(args['fields'] or args['ops'])
+
+    if rargs.get('max_points'):
+        try:
+            max_points = int(rargs['max_points'])
+        except ValueError:
+            max_points = None
+        if max_points is None or max_points <= 0:
+            raise tdmq.errors.TdmqBadRequestException(
+                f"max_points must be a positive integer;  got {rargs['max_points']!r}")
+        args['max_points'] = max_points
+        args['method'] = rargs.get('method', 'lttb')
 
     data_format = rargs.get('format', 'json')
-    if data_format not in ('json', 'csv'):
+    if data_format not in ('json', 'csv', 'arrow', 'parquet'):
         raise wex.BadRequest(f"Unknown/unsupported format {data_format}")
+    orient = rargs.get('orient', 'rows')
+    if orient not in ('rows', 'columns'):
+        raise wex.BadRequest(f"Unknown/unsupported orient {orient}")
+    if data_format in ('arrow', 'parquet'):
+        if not arrow_io.arrow_available():
+            raise tdmq.errors.UnsupportedFunctionality(f"The {data_format} format is not available on this server")
+        # Arrow and Parquet have their own timestamp type
+        args['time_format'] = None
 
     batch_size = int(rargs.get('batch_size', 2500))
     assert batch_size > 0
     logger.debug("GET using batch_size of %s", batch_size)
 
+    cache_info = _timeseries_cache_info(tdmq_id, anonymize_private)
+    not_modified = _not_modified(cache_info)
+    if not_modified is not None:
+        return not_modified
+
+    if data_format == 'json' and orient == 'rows' and \
+       current_app.config.get('DB_JSON_SERIALIZATION') and not args.get('max_points'):
+        result = Timeseries.get_one_json_by_batch(tdmq_id, anonymize_private, batch_size, args, sparse_format)
+        response = current_app.response_class(
+            generate_ts_json_preformatted(result, args['time_format']),
+            content_type='application/json')
+        return _set_cache_headers(response, cache_info)
+
     result = Timeseries.get_one_by_batch(tdmq_id, anonymize_private, batch_size, args)
 
-    if data_format == 'json':
+    if data_format == 'json' and orient == 'columns':
         response = current_app.response_class(
-            generate_ts_json(result, sparse_format),
+            generate_ts_json_columns(result, args['time_format']),
             content_type='application/json')
+    elif data_format == 'json':
+        response = current_app.response_class(
+            generate_ts_json(result, sparse_format, args['time_format']),
+            content_type='application/json')
+    elif data_format == 'arrow':
+        response = current_app.response_class(
+            arrow_io.generate_ts_arrow(result, Timeseries.get_property_types(tdmq_id)),
+            content_type=arrow_io.CONTENT_TYPE)
+    elif data_format == 'parquet':
+        response = _file_response(
+            arrow_io.write_ts_parquet(result, Timeseries.get_property_types(tdmq_id)),
+            arrow_io.PARQUET_CONTENT_TYPE, f"{result.tdmq_id}.parquet")
     else:
         response = current_app.response_class(
             generate_ts_csv(result), content_type='text/csv')
         response.headers["Content-Disposition"] = f"attachment;filename={result.tdmq_id}.csv"
-    return response
+    return _set_cache_headers(response, cache_info)
 
 
-def generate_ts_json(resultset, sparse_format: bool):
+def _ts_json_opening(resultset, sparse_format: bool, time_format: str = None, orient: str = 'rows') -> str:
+    """
+    Opening of the JSON timeseries response, up to the "items" key.
+    """
+    response_opening = \
+        f'{{"tdmq_id": {json.dumps(str(resultset.tdmq_id))},'\
+        f'"shape": {json.dumps(resultset.shape)},'\
+        f'"bucket": {json.dumps(resultset.bucket)},'\
+        f'"fields": {json.dumps(resultset.fields)},'\
+        f'"sparse": {json.dumps(sparse_format)},'
+    if time_format and time_format != 'epoch':
+        response_opening += f'"time_format": {json.dumps(time_format)},'
+    if orient != 'rows':
+        response_opening += f'"orient": {json.dumps(orient)},'
+    if resultset.default_footprint:
+        response_opening += f'"default_footprint": {json.dumps(resultset.default_footprint)},'
+    response_opening += '"items": '
+    return response_opening
+
+
+def generate_ts_json(resultset, sparse_format: bool, time_format: str = None):
     def format_sparse_row(row: List) -> str:
         assert len(row) == len(resultset.fields)
         d = {field_name: value for field_name, value in zip(resultset.fields, row) if value is not None}
@@ -236,16 +460,7 @@ def generate_ts_json(resultset, sparse_format: bool):
     row_format_fn = format_sparse_row if sparse_format else format_dense_row
 
     logger.debug("Generating JSON timeseries output")
-    response_opening = \
-        f'{{"tdmq_id": {json.dumps(str(resultset.tdmq_id))},'\
-        f'"shape": {json.dumps(resultset.shape)},'\
-        f'"bucket": {json.dumps(resultset.bucket)},'\
-        f'"fields": {json.dumps(resultset.fields)},'\
-        f'"sparse": {json.dumps(sparse_format)},'
-    if resultset.default_footprint:
-        response_opening += f'"default_footprint": {json.dumps(resultset.default_footprint)},'
-    response_opening += '"items": ['
-    yield response_opening
+    yield _ts_json_opening(resultset, sparse_format, time_format) + '['
     first_batch = True
     for batch in resultset:
         logger.debug("Timeseries: sending %s records", len(batch))
@@ -256,6 +471,62 @@ def generate_ts_json(resultset, sparse_format: bool):
     yield ']}'  # response closing
 
 
+def generate_ts_json_preformatted(resultset, time_format: str = None):
+    """
+    Like generate_ts_json, for results whose batches have already been
+    serialized to JSON by the database.
+    """
+    logger.debug("Generating JSON timeseries output from preformatted batches")
+    yield _ts_json_opening(resultset, resultset.sparse, time_format) + '['
+    first_batch = True
+    for batch in resultset:
+        if not first_batch:
+            yield ','
+        yield batch
+        first_batch = False
+    yield ']}'
+
+
+def generate_ts_json_columns(resultset, time_format: str = None):
+    """
+    Generator of the JSON timeseries with the columnar layout:  "items" maps
+    each field to the array of its values.  The time column is streamed as
+    the batches are read, while the others are spooled (see
+    column_spool.ColumnSpool).
+    """
+    logger.debug("Generating columnar JSON timeseries output")
+    with column_spool.ColumnSpool(len(resultset.fields)) as spool:
+        yield _ts_json_opening(resultset, False, time_format, orient='columns')
+        yield from column_spool.generate_json_object(resultset.fields, spool, batches=resultset)
+        yield '}'
+
+
+def generate_ts_legacy_json(resultset, time_format: str = None):
+    """
+    Generator of the JSON response of the legacy /timeseries endpoint:  the
+    columns are in "coords" (time and footprint) and "data" (the fields).
+    Columns without any value are null, unless the timeseries is empty.
+    The time column is streamed as the batches are read.
+    """
+    logger.debug("Generating legacy JSON timeseries output")
+    with column_spool.ColumnSpool(len(resultset.fields)) as spool:
+        opening = \
+            f'{{"tdmq_id": {json.dumps(str(resultset.tdmq_id))},'\
+            f'"shape": {json.dumps(resultset.shape)},'\
+            f'"bucket": {json.dumps(resultset.bucket)},'
+        if resultset.default_footprint:
+            opening += f'"default_footprint": {json.dumps(resultset.default_footprint)},'
+        if time_format and time_format != 'epoch':
+            opening += f'"time_format": {json.dumps(time_format)},'
+        yield opening + '"coords": '
+        yield from column_spool.generate_json_object(
+            resultset.fields[:2], spool, batches=resultset, null_if_all_null=True)
+        yield ',"data": '
+        yield from column_spool.generate_json_object(
+            resultset.fields[2:], spool, columns=range(2, len(resultset.fields)), null_if_all_null=True)
+        yield '}'
+
+
 def generate_ts_csv(resultset):
     def format_row(row: List) -> str:
         return ','.join( (str(v if v is not None else '') for v in row) )
@@ -272,7 +543,9 @@ def generate_ts_csv(resultset):
 @tdmq_bp.route('/sources/<uuid:tdmq_id>/timeseries')
 def timeseries_get(tdmq_id):
     """
-    Old implementation of GET /timeseries that retrieves and returns the entire query set at once.
+    Old GET /timeseries interface, which returns the timeseries by column.
+    The result is read by batches and transposed through a ColumnSpool,
+    so memory use does not depend on the size of the timeseries.
     """
     rargs = request.args
 
@@ -280,16 +553,38 @@ def timeseries_get(tdmq_id):
     if not anonymize_private and not _request_authorized():
         raise wex.Unauthorized("Unauthorized request for unanonymized private data")
 
-    args = dict((k, rargs.get(k, None))
-                for k in ['after', 'before', 'bucket', 'fields', 'op'])
-    if args['bucket'] is not None:
-        args['bucket'] = timedelta(seconds=float(args['bucket']))
-    if args['fields'] is not None:
-        args['fields'] = args['fields'].split(',')
+    args = _parse_timeseries_args(rargs)
 
-    result = Timeseries.get_one(tdmq_id, anonymize_private, args)
-    jres = jsonify(result)
-    return jres
+    batch_size = int(rargs.get('batch_size', 2500))
+    assert batch_size > 0
+
+    cache_info = _timeseries_cache_info(tdmq_id, anonymize_private)
+    not_modified = _not_modified(cache_info)
+    if not_modified is not None:
+        return not_modified
+
+    result = Timeseries.get_one_by_batch(tdmq_id, anonymize_private, batch_size, args)
+    response = current_app.response_class(
+        generate_ts_legacy_json(result, args['time_format']),
+        content_type='application/json')
+    return _set_cache_headers(response, cache_info)
+
+
+@tdmq_bp.route('/sources/<uuid:tdmq_id>/timeseries_summary')
+def timeseries_summary(tdmq_id):
+    """
+    Number of records of the source in [after, before) and the times of the
+    first and the last one, in `time_format`.  It is much cheaper than the
+    timeseries itself and lets clients fetch long timeseries by windows.
+    """
+    rargs = request.args
+    result = Timeseries.get_summary(tdmq_id, rargs.get('after'), rargs.get('before'), rargs.get('time_format'))
+    if result is None:
+        raise wex.NotFound(f"source {tdmq_id} does not exist")
+    time_format = rargs.get('time_format')
+    if time_format and time_format != 'epoch':
+        result['time_format'] = time_format
+    return jsonify(result)
 
 
 @tdmq_bp.route('/sources/<uuid:tdmq_id>/activity/latest')
@@ -304,19 +599,143 @@ def source_activity_latest(tdmq_id):
 @tdmq_bp.route('/records', methods=["POST"])
 @auth_required
 def records_post():
-    def validate_record(record):
-        if not all(record.get(k) for k in ('time', 'data')) or \
-           not any(record.get(k) for k in ('tdmq_id', 'source')):
-            raise wex.BadRequest(
-                "Missing fields in POSTed timeseries record.  "
-                "Mandatory fields: 'time', 'data', ('tdmq_id' or 'source').  "
-                f"Received keys: {record.keys()}")
+    if request.mimetype == NDJSON_CONTENT_TYPE:
+        return _records_post_ndjson()
 
+    on_conflict = _parse_on_conflict()
     data = request.json
     for record in data:
-        validate_record(record)
-    n = Timeseries.store_new_records(data)
-    return jsonify({"loaded": n})
+        _validate_record(record)
+    record_validator.validate(data)
+    if ingest_queue.enabled:
+        _check_queued_records(data)
+        n = ingest_queue.enqueue(data, on_conflict)
+        return jsonify({"queued": n}), HTTPStatus.ACCEPTED
+    n = Timeseries.store_new_records(data, on_conflict)
+    return jsonify(_conflict_counts(on_conflict, n, len(data)))
+
+
+def _parse_on_conflict():
+    on_conflict = request.args.get('on_conflict') or None
+    if on_conflict is not None and on_conflict not in Timeseries.OnConflictModes:
+        raise wex.BadRequest(f"Unknown/unsupported on_conflict mode {on_conflict}")
+    # Fail before reading the records (or queueing them) without the unique index
+    Timeseries.check_on_conflict(on_conflict)
+    return on_conflict
+
+
+def _conflict_counts(on_conflict, n_loaded: int, n_records: int):
+    """
+    Counts of the records loaded out of `n_records`:  with `on_conflict`,
+    the others were skipped ('ignore') or merged into an existing record
+    ('update').
+    """
+    counts = {"loaded": n_loaded}
+    if on_conflict == 'ignore':
+        counts['skipped'] = n_records - n_loaded
+    elif on_conflict == 'update':
+        counts['updated'] = n_records - n_loaded
+    return counts
+
+
+def _validate_record(record):
+    if not isinstance(record, dict) or \
+       not all(record.get(k) for k in ('time', 'data')) or \
+       not any(record.get(k) for k in ('tdmq_id', 'source')):
+        raise wex.BadRequest(
+            "Missing fields in POSTed timeseries record.  "
+            "Mandatory fields: 'time', 'data', ('tdmq_id' or 'source').  "
+            f"Received keys: {record.keys() if isinstance(record, dict) else type(record)}")
+
+
+def _check_queued_records(data):
+    """
+    Reject the records that the ingest queue would fail to load, since
+    queued records are only loaded after the response.
+    """
+    for record in data:
+        if not isinstance(record['time'], str) or _parse_query_timestamp(record['time']) is None:
+            raise wex.BadRequest(f"Invalid record time {record['time']!r}.  Queued records need ISO 8601 times")
+        if 'tdmq_id' in record:
+            try:
+                uuid.UUID(str(record['tdmq_id']))
+            except ValueError:
+                raise wex.BadRequest(f"Invalid tdmq_id {record['tdmq_id']!r}")
+    unknown = Timeseries.unknown_sources(data)
+    if unknown:
+        raise wex.BadRequest(f"Unknown sources: {', '.join(unknown[:10])}{'...' if len(unknown) > 10 else ''}")
+
+
+def _ndjson_record_batches(stream, batch_size: int):
+    """
+    Generator of the validated records in the NDJSON `stream`, in lists of
+    up to `batch_size` records.  The stream is read one line at a time.
+    """
+    batch = []
+    offset = 0
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise wex.BadRequest(f"Invalid JSON on line {line_number}: {e}")
+        _validate_record(record)
+        batch.append(record)
+        if len(batch) >= batch_size:
+            record_validator.validate(batch, offset)
+            yield batch
+            offset += len(batch)
+            batch = []
+    if batch:
+        record_validator.validate(batch, offset)
+        yield batch
+
+
+def _records_post_ndjson():
+    """
+    Load records sent as newline-delimited JSON (one record per line).  The
+    body is read, validated and loaded in batches of `batch_size` records.
+    With `commit=batch`, each batch is committed separately:  if a batch
+    fails, the error response reports the batches already loaded.
+    """
+    batch_size = int(request.args.get('batch_size', current_app.config.get('INGEST_BATCH_SIZE', 5000)))
+    if batch_size <= 0:
+        raise wex.BadRequest("batch_size must be > 0")
+    commit = request.args.get('commit', 'all')
+    if commit not in ('all', 'batch'):
+        raise wex.BadRequest(f"Unknown/unsupported commit mode {commit}")
+    on_conflict = _parse_on_conflict()
+
+    counts = []
+    sizes = []  # number of records read in each batch
+
+    def batches():
+        for batch in _ndjson_record_batches(request.stream, batch_size):
+            sizes.append(len(batch))
+            yield batch
+
+    def response_counts():
+        return dict(_conflict_counts(on_conflict, sum(counts), sum(sizes[:len(counts)])), batches=counts)
+
+    try:
+        Timeseries.store_new_record_batches(batches(), commit == 'batch', on_batch=counts.append,
+                                            on_conflict=on_conflict)
+    except (wex.HTTPException, tdmq.errors.TdmqError) as e:
+        if commit != 'batch' or not counts:
+            raise
+        # Report what has been committed before the error
+        if isinstance(e, wex.HTTPException):
+            status, title, description = e.code, ERROR_CODES.get(e.code), e.description
+        else:
+            status, title, description = e.status, e.title, e.detail
+        logger.info("NDJSON ingestion failed after loading %s records", sum(counts))
+        struct = {"error": title, "code": status, "description": description, **response_counts()}
+        if isinstance(e, tdmq.errors.RecordValidationError):
+            struct['errors'] = e.errors
+        return jsonify(struct), status
+    return jsonify(response_counts())
 
 
 @tdmq_bp.route('/')
@@ -10,7 +10,7 @@ from logging.config import dictConfig
 import flask
 
 from flask import request
-from prometheus_client import Histogram
+from prometheus_client import Gauge, Histogram
 from prometheus_client.utils import INF
 from prometheus_flask_exporter import PrometheusMetrics
 # try:
@@ -20,7 +20,10 @@ from prometheus_flask_exporter import PrometheusMetrics
 
 from tdmq.api import tdmq_bp
 from tdmq.db import add_db_cli, close_db
+from .ingest_queue import add_ingest_queue_cli, ingest_queue
 from .loc_anonymizer import loc_anonymizer
+from .record_validation import record_validator
+from .result_cache import result_cache
 
 # This is the best way I've found to close the DB connect when the application exits.
 atexit.register(close_db)
@@ -126,10 +129,21 @@ def configure_prometheus_exporter(app, prom_registry=None):
         labelnames=('method', 'status', 'path'),
         registry=prom_registry,
         buckets=(500, 1500, 3000, 6000, 12000, 24000, 48000, INF))
+    metrics_ingest_queue_depth = Gauge(
+        'tdmq_ingest_queue_depth',
+        'Number of records waiting in the ingest queue',
+        registry=prom_registry,
+        multiprocess_mode='max')
+    metrics_ingest_commit_seconds = Histogram(
+        'tdmq_ingest_commit_seconds',
+        'Histogram of the duration of the ingest queue group commits',
+        registry=prom_registry)
 
     metrics.init_app(app)
     app.metrics = metrics
     app.metrics.response_size_bytes = metrics_response_size_bytes
+    app.metrics.ingest_queue_depth = metrics_ingest_queue_depth
+    app.metrics.ingest_commit_seconds = metrics_ingest_commit_seconds
 
 
 class DefaultConfig:
@@ -142,9 +156,65 @@ class DefaultConfig:
     DB_USER = 'postgres'
     DB_PASSWORD = 'foobar'
     DB_MAX_QUERY_TIME = '50000'
+    # Serialize the rows of JSON timeseries in the database rather than in Python
+    DB_JSON_SERIALIZATION = False
 
     LOG_LEVEL = "INFO"
 
+    # Compression of timeseries and source list responses.  Keys are the
+    # enabled encodings (zstd and br require the zstandard and brotli
+    # packages); values the compression levels.
+    COMPRESSION_LEVEL = {
+        'zstd': 3,
+        'br': 4,
+        'gzip': 6,
+    }
+    # Responses smaller than this (in bytes) are not compressed
+    COMPRESSION_MIN_SIZE = 1024
+
+    # Timeseries whose `before` is older than CACHE_IMMUTABLE_AFTER seconds
+    # are considered historical:  their responses can be cached (publicly,
+    # for public sources) for CACHE_MAX_AGE seconds, without revalidation.
+    # Records backfilled in such an interval aren't seen by these caches
+    # until the response expires, so this is only safe for deployments that
+    # don't backfill.  By default (None), responses always require
+    # revalidation through their ETag.
+    CACHE_IMMUTABLE_AFTER = None
+    CACHE_MAX_AGE = 3600
+
+    # Records posted as NDJSON are validated and loaded in batches of this size
+    INGEST_BATCH_SIZE = 5000
+
+    # Validate the data of the records against the schema of their entity
+    # type (requires the jsonschema package).  Schemas are reloaded from the
+    # database at most every RECORD_SCHEMA_REFRESH_INTERVAL seconds.
+    RECORD_SCHEMA_VALIDATION = True
+    RECORD_SCHEMA_REFRESH_INTERVAL = 60
+
+    # Server-side cache of bucketed timeseries results.  None disables it;
+    # 'memory' keeps the results in each worker process;
+    # 'sqlite:///path/to/cache.db' shares them among the workers on the host.
+    RESULT_CACHE = None
+    RESULT_CACHE_MAX_ENTRIES = 1024
+    # Results with more rows than this, or larger than this many bytes
+    # (pickled), are not cached
+    RESULT_CACHE_MAX_ROWS = 100000
+    RESULT_CACHE_MAX_ENTRY_SIZE = 2 * 1024 * 1024
+
+    # Asynchronous ingestion.  With 'sqlite:///path/to/queue.db', the records
+    # POSTed as JSON are queued in a spool shared by the workers on the host
+    # and loaded in group commits of up to INGEST_FLUSH_MAX_RECORDS records
+    # every INGEST_FLUSH_INTERVAL seconds, by a thread in each worker
+    # (INGEST_QUEUE_FLUSHER = 'worker') or by `flask ingest-queue run`
+    # ('external').  None loads the records synchronously.
+    INGEST_QUEUE = None
+    INGEST_QUEUE_FLUSHER = 'worker'
+    INGEST_FLUSH_INTERVAL = 1.0
+    INGEST_FLUSH_MAX_RECORDS = 10000
+    # Groups claimed by a flusher for longer than this (in seconds) are
+    # considered abandoned and loaded again
+    INGEST_CLAIM_TIMEOUT = 300
+
     TILEDB_INTERNAL_VFS = {
         'storage.root': "s3://tdm-public/",
         'config': {
@@ -255,12 +325,17 @@ def create_app(test_config=None, prom_registry=None):
 
     add_db_cli(app)
     loc_anonymizer.init_app(app)
+    result_cache.init_app(app)
+    record_validator.init_app(app)
 
     app.register_blueprint(tdmq_bp, url_prefix=app.config['APP_PREFIX'])
 
     # prometheus exporter must be configured after the routes are registered
     configure_prometheus_exporter(app, prom_registry)
 
+    add_ingest_queue_cli(app)
+    ingest_queue.init_app(app, app.metrics.ingest_queue_depth, app.metrics.ingest_commit_seconds)
+
     @app.before_request
     def log_request():
         logger = logging.getLogger("request")
@@ -0,0 +1,348 @@
+"""
+Apache Arrow IPC and Parquet encoding of timeseries and source catalogs.
+
+The server streams a timeseries as one Arrow record batch per batch of rows
+produced by `tdmq.model.Timeseries.get_one_by_batch`;  the client reads the
+stream back into a `pyarrow.Table`.  Parquet files are written with one row
+group per batch of rows.
+
+Column types:
+  * time:       timestamp[us, tz=UTC];
+  * footprint:  string (hex EWKB for raw records, GeoJSON for buckets);
+  * properties: the type declared for the property by the schema of the
+                entity type of the source (`property_types`):  float64 for
+                numbers and integers, bool for booleans, string for anything
+                else.  Bucketed columns are float64, except for counts
+                (int64) and string_agg (string).  The type of undeclared
+                properties is inferred from the first batch of rows;  if it
+                has no value, the type is string.  Values of string columns
+                that aren't strings (e.g., objects and arrays) are sent as
+                JSON strings.
+
+Since the schema of the stream is fixed before the first batch is sent, the
+columns can't be widened afterwards:  a value that doesn't fit the type of
+its column (e.g., a string in a float64 column) raises ColumnTypeError,
+rather than being lost.  Use the JSON format for such data.  The error is
+raised before the response starts if it's in the first batch (Parquet files
+are written entirely beforehand);  otherwise, the Arrow stream is ended with
+a batch carrying the error, which `read_ts_arrow` raises.
+
+The metadata of the response (tdmq_id, shape, bucket, default_footprint) is
+stored, JSON-encoded, in the 'tdmq' key of the schema metadata.
+
+pyarrow is an optional dependency:  without it, `UnsupportedFunctionality`
+is raised.
+"""
+
+import io
+import json
+import logging
+import tempfile
+from datetime import datetime
+from numbers import Number
+
+import tdmq.errors
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet  # noqa: F401 pylint: disable=unused-import
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+PARQUET_CONTENT_TYPE = 'application/vnd.apache.parquet'
+
+PARQUET_COMPRESSION = 'zstd'
+
+# Parquet files are spooled in memory up to this size, then on disk
+PARQUET_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+METADATA_KEY = b'tdmq'
+
+# Custom metadata key of the record batch that ends a truncated stream
+ERROR_KEY = b'tdmq_error'
+
+
+def arrow_available() -> bool:
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise tdmq.errors.UnsupportedFunctionality("The Arrow and Parquet formats require pyarrow, which is not installed")
+
+
+def _to_float(v):
+    if v is None or isinstance(v, float):
+        return v
+    if isinstance(v, Number) and not isinstance(v, bool):
+        return float(v)
+    raise TypeError(f"{v!r} is not a number")
+
+
+def _to_int(v):
+    if v is None or (isinstance(v, int) and not isinstance(v, bool)):
+        return v
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    raise TypeError(f"{v!r} is not an integer")
+
+
+def _to_string(v):
+    if v is None or isinstance(v, str):
+        return v
+    return json.dumps(v)
+
+
+def _to_bool(v):
+    if v is None or isinstance(v, bool):
+        return v
+    raise TypeError(f"{v!r} is not a boolean")
+
+
+def _infer_field_type(values):
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            return pa.bool_()
+        if isinstance(v, Number):
+            return pa.float64()
+        return pa.string()
+    return pa.string()
+
+
+def _declared_field_type(name, bucket, property_types):
+    """
+    Arrow type of the timeseries field `name`, as declared by the entity
+    type schema (`property_types`) and the bucketing operation.  None if the
+    type isn't declared.
+    """
+    prop, _, op = name.partition(':')
+    if not op and bucket and isinstance(bucket.get('op'), str):
+        op = bucket['op']
+    if op:
+        if op in ('count_records', 'count_values'):
+            return pa.int64()
+        if op in ('string_agg', 'jsonb_agg'):
+            return pa.string()
+        return pa.float64()
+    declared = (property_types or {}).get(prop)
+    if declared in ('number', 'integer'):
+        return pa.float64()
+    if declared == 'boolean':
+        return pa.bool_()
+    if declared is not None:
+        return pa.string()
+    return None
+
+
+def _converter(arrow_type):
+    if pa.types.is_boolean(arrow_type):
+        return _to_bool
+    if pa.types.is_integer(arrow_type):
+        return _to_int
+    if pa.types.is_floating(arrow_type):
+        return _to_float
+    return _to_string
+
+
+def _time_to_us(t):
+    return None if t is None else round(float(t) * 1_000_000)
+
+
+def _schema(resultset, first_batch, property_types=None):
+    columns = list(zip(*first_batch)) if first_batch else [()] * len(resultset.fields)
+    arrow_fields = [
+        pa.field('time', pa.timestamp('us', tz='UTC')),
+        pa.field('footprint', pa.string()) ]
+    arrow_fields.extend(
+        pa.field(name, _declared_field_type(name, resultset.bucket, property_types) or _infer_field_type(values))
+        for name, values in zip(resultset.fields[2:], columns[2:]))
+
+    metadata = {
+        'tdmq_id': str(resultset.tdmq_id),
+        'shape': resultset.shape,
+        'bucket': resultset.bucket,
+        'default_footprint': resultset.default_footprint,
+    }
+    return pa.schema(arrow_fields, metadata={ METADATA_KEY: json.dumps(metadata) })
+
+
+def _record_batch(schema, converters, rows):
+    columns = list(zip(*rows))
+    arrays = [
+        pa.array([ _time_to_us(t) for t in columns[0] ], type=schema.field(0).type),
+        pa.array([ _to_string(f) for f in columns[1] ], type=pa.string()) ]
+    for i, (convert, values) in enumerate(zip(converters, columns[2:]), start=2):
+        field = schema.field(i)
+        try:
+            arrays.append(pa.array([ convert(v) for v in values ], type=field.type))
+        except (TypeError, ValueError, OverflowError) as e:
+            raise tdmq.errors.ColumnTypeError(
+                f"A value of field '{field.name}' does not fit its {field.type} column ({e}).  "
+                "Request the timeseries in the JSON format") from e
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _ts_record_batches(resultset, property_types=None):
+    """
+    Returns the schema for `resultset` and an iterator over its record batches.
+    The types of the properties that aren't declared by `property_types` are
+    inferred from the first batch of rows, which is fetched here.
+    """
+    batches = iter(resultset)
+    first_batch = next(batches, None)
+    schema = _schema(resultset, first_batch, property_types)
+    converters = [ _converter(f.type) for f in list(schema)[2:] ]
+
+    def record_batches():
+        batch = first_batch
+        while batch:
+            logger.debug("Timeseries: encoding %s records", len(batch))
+            yield _record_batch(schema, converters, batch)
+            batch = next(batches, None)
+
+    return schema, record_batches()
+
+
+def _arrow_stream(schema, first_record_batch, record_batches):
+    sink = io.BytesIO()
+
+    def flush():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield flush()  # schema message
+        if first_record_batch is not None:
+            writer.write_batch(first_record_batch)
+            yield flush()
+        try:
+            for record_batch in record_batches:
+                writer.write_batch(record_batch)
+                yield flush()
+        except tdmq.errors.ColumnTypeError as e:
+            # The status and the first batches have been sent:  end the
+            # stream with an empty batch that carries the error, which
+            # read_ts_arrow raises
+            logger.error("Arrow timeseries stream truncated: %s", e.detail)
+            writer.write_batch(pa.RecordBatch.from_pylist([], schema=schema),
+                               custom_metadata={ ERROR_KEY: e.detail })
+    yield flush()  # end-of-stream marker
+
+
+def generate_ts_arrow(resultset, property_types=None):
+    """
+    Encode `resultset` (see `tdmq.model.Timeseries.QueryResult`) as an Arrow
+    IPC stream.  `property_types` maps the properties to the JSON schema
+    types declared by the entity type of the source.
+
+    The schema and the first record batch are built here, so that their
+    errors are raised before the response starts;  returns a generator of
+    the chunks of the stream.  A ColumnTypeError in a later batch ends the
+    stream with the error (see read_ts_arrow).
+    """
+    _require_pyarrow()
+    logger.debug("Generating Arrow timeseries output")
+
+    schema, record_batches = _ts_record_batches(resultset, property_types)
+    first_record_batch = next(record_batches, None)
+    return _arrow_stream(schema, first_record_batch, record_batches)
+
+
+def _write_parquet(schema, record_batches, compression):
+    spool = tempfile.SpooledTemporaryFile(max_size=PARQUET_SPOOL_MAX_SIZE)
+    try:
+        with pa.parquet.ParquetWriter(spool, schema, compression=compression) as writer:
+            for record_batch in record_batches:
+                writer.write_batch(record_batch)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+def write_ts_parquet(resultset, property_types=None, compression: str = PARQUET_COMPRESSION):
+    """
+    Write `resultset` as a Parquet file, with one row group per batch of rows.
+    The file has the same schema as the Arrow stream (see `generate_ts_arrow`).
+
+    Since the Parquet footer can only be written at the end, the file is
+    spooled to a temporary file, which is returned positioned at its start.
+    The caller must close it.
+    """
+    _require_pyarrow()
+    logger.debug("Writing Parquet timeseries output")
+    schema, record_batches = _ts_record_batches(resultset, property_types)
+    return _write_parquet(schema, record_batches, compression)
+
+
+def _catalog_type(values):
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            return pa.bool_()
+        if isinstance(v, datetime):
+            return pa.timestamp('us', tz='UTC')
+        if isinstance(v, Number):
+            return pa.float64()
+        return pa.string()
+    return pa.string()
+
+
+def write_sources_parquet(sources, compression: str = PARQUET_COMPRESSION):
+    """
+    Write a list of source descriptions (as returned by
+    `tdmq.model.Source.search`) as a Parquet file.  There is one column per
+    top-level attribute;  structured attributes (e.g., default_footprint and
+    description) are stored as JSON strings.
+
+    Returns a temporary file positioned at its start.  The caller must close it.
+    """
+    _require_pyarrow()
+    names = list(dict.fromkeys(k for s in sources for k in s))
+    columns = [ [ s.get(name) for s in sources ] for name in names ]
+    types = [ _catalog_type(values) for values in columns ]
+
+    def convert(arrow_type, v):
+        if v is None or isinstance(v, str) or not pa.types.is_string(arrow_type):
+            return v
+        return _to_string(v) if isinstance(v, (dict, list)) else str(v)
+
+    arrays = [ pa.array([ convert(t, v) for v in values ], type=t) for t, values in zip(types, columns) ]
+    schema = pa.schema([ pa.field(name, t) for name, t in zip(names, types) ])
+    record_batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+    return _write_parquet(schema, [record_batch], compression)
+
+
+def read_ts_arrow(data):
+    """
+    Decode an Arrow IPC stream produced by `generate_ts_arrow`.  Raises
+    ColumnTypeError if the stream was ended by an error.
+
+    :returns: (metadata dict, pyarrow.Table)
+    """
+    _require_pyarrow()
+    record_batches = []
+    with pa.ipc.open_stream(data) as reader:
+        schema = reader.schema
+        while True:
+            try:
+                record_batch, custom_metadata = reader.read_next_batch_with_custom_metadata()
+            except StopIteration:
+                break
+            if custom_metadata is not None and ERROR_KEY in custom_metadata:
+                raise tdmq.errors.ColumnTypeError(
+                    "Truncated Arrow stream: " + custom_metadata[ERROR_KEY].decode('utf-8'))
+            record_batches.append(record_batch)
+    table = pa.Table.from_batches(record_batches, schema=schema)
+    metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b'{}'))
+    return metadata, table
@@ -1,4 +1,5 @@
 
+from .async_client import AsyncClient  # noqa: F401
 from .client import Client, log_level, set_log_level  # noqa: F401
 from .sources import Source  # noqa: F401
 from .timeseries import TimeSeries  # noqa: F401
@@ -0,0 +1,240 @@
+"""
+Asynchronous client for the TDMq service, built on aiohttp.
+
+`AsyncClient` offers coroutine versions of the main `Client` methods, so
+that many requests can be in flight at the same time -- at most
+`max_concurrency`.  `gather_timeseries` fetches the timeseries of many
+sources concurrently:
+
+    async with AsyncClient(url) as client:
+        sources = await client.find_sources(entity_type='WeatherObserver')
+        series = await client.gather_timeseries(sources, after=..., bucket=3600, op='avg')
+
+The sources it returns are the same objects returned by `Client`:  their
+(synchronous) methods use the `client` attribute of the AsyncClient, a
+`Client` with the same settings.  Requires the aiohttp package.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import tdmq.errors
+from tdmq import arrow_io
+from tdmq.client import json_stream
+from tdmq.client.client import Client
+from tdmq.client.sources import NonScalarSource, Source
+from tdmq.client.timeseries import TimeSeries
+
+_logger = logging.getLogger(__name__)
+
+
+def _encode_params(params: Dict[str, Any]) -> List:
+    """
+    Encode query parameters as `requests` does:  None values are dropped,
+    lists are repeated and the other values converted to strings.
+    """
+    encoded = []
+    for k, v in (params or {}).items():
+        if v is None:
+            continue
+        for item in (v if isinstance(v, (list, tuple)) else [v]):
+            encoded.append((k, str(item)))
+    return encoded
+
+
+class AsyncClient:
+    def __init__(self, tdmq_base_url=None, auth_token=None, verify_ssl=None, use_arrow=False,
+                 max_concurrency=32, max_retries=3, backoff_factor=0.5, timeout=None):
+        """
+        :param max_concurrency: maximum number of requests in flight.
+        :param max_retries: number of retries, with exponential backoff
+                          (`backoff_factor` * 2^n seconds), of GET requests
+                          failed with connection errors or 502, 503 and 504
+                          responses.
+        :param timeout:   total timeout of each request, in seconds.
+        The other parameters are as in `Client`.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncClient requires the aiohttp package")
+        self.client = Client(tdmq_base_url, auth_token, verify_ssl, use_arrow)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._ssl = None if verify_ssl else False
+        self._session = None
+        self._semaphore = None
+        self._connect_lock = None
+
+    @property
+    def base_url(self) -> str:
+        return self.client.base_url
+
+    @property
+    def connected(self) -> bool:
+        return self.client.connected
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self.client.close()
+
+    def _get_session(self):
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._connect_lock = asyncio.Lock()
+            # aiohttp sets Accept-Encoding to the encodings it can decode
+            headers = { k: v for k, v in self.client.headers.items() if k != 'Accept-Encoding' }
+            self._session = aiohttp.ClientSession(
+                headers=headers, timeout=self._timeout,
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, ssl=self._ssl))
+        return self._session
+
+    async def _request(self, method: str, resource: str, read, params=None, json_obj=None):
+        """
+        Make a request and return `await read(response)`.
+        """
+        session = self._get_session()
+        url = resource if resource.startswith(self.base_url) else f'{self.base_url}/{resource}'
+        retries = self.max_retries if method == 'GET' else 0
+        for attempt in range(retries + 1):
+            try:
+                async with self._semaphore:
+                    async with session.request(method, url, params=_encode_params(params), json=json_obj) as r:
+                        if r.status in Client.RETRY_STATUS and attempt < retries:
+                            raise aiohttp.ClientResponseError(r.request_info, r.history, status=r.status)
+                        # pylint: disable=protected-access
+                        self.client._check_status_authorized(r.status, r.reason, r.headers)
+                        self.client._raise_for_status_code(r.status, r.reason)
+                        return await read(r)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+                if attempt >= retries:
+                    raise
+                delay = self.backoff_factor * 2 ** attempt
+                _logger.debug("%s %s failed (%s).  Retrying in %s s", method, url, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _do_get(self, resource, params=None):
+        return await self._request('GET', resource, lambda r: r.json(), params=params)
+
+    async def connect(self) -> None:
+        if self.connected:
+            return
+        self._get_session()
+        async with self._connect_lock:
+            if not self.connected:
+                service_info = await self._do_get('service_info')
+                # pylint: disable=protected-access
+                self.client._configure(service_info)
+
+    async def find_sources(self, args: Dict[str, Any] = None, **kwargs) -> List[Source]:
+        """
+        See Client.find_sources.
+        """
+        await self.connect()
+        params = dict(args or {}, **kwargs)
+        # pylint: disable=protected-access
+        return [ self.client._source_factory(s) for s in await self._do_get('sources', params=params) ]
+
+    async def get_source(self, tdmq_id, anonymized=True) -> Source:
+        await self.connect()
+        res = await self._do_get(f'sources/{tdmq_id}', params={'anonymized': anonymized})
+        # pylint: disable=protected-access
+        return self.client._source_factory(res)
+
+    async def get_timeseries(self, code, args, sparse: bool = None):
+        """
+        See Client.get_timeseries.  Responses are not cached.
+        """
+        await self.connect()
+        args = dict(args)
+        if sparse is not None:
+            args['sparse'] = sparse
+
+        async def read(r):
+            parser = json_stream.TimeseriesParser(columns=args.get('orient') == 'columns')
+            async for chunk in r.content.iter_chunked(Client.TIMESERIES_CHUNK_SIZE):
+                parser.feed(chunk)
+            return parser.finish()
+
+        return await self._request('GET', f'sources/{code}/timeseries_stream', read, params=args)
+
+    async def get_timeseries_arrow(self, code, args):
+        """
+        See Client.get_timeseries_arrow.
+        """
+        await self.connect()
+
+        async def read(r):
+            return arrow_io.read_ts_arrow(await r.read())
+
+        return await self._request('GET', f'sources/{code}/timeseries_stream', read,
+                                   params=dict(args, format='arrow'))
+
+    async def add_records(self, records, on_conflict: str = None) -> Dict[str, int]:
+        """
+        See Client.add_records.  POSTs are not retried.
+        """
+        await self.connect()
+        params = { 'on_conflict': on_conflict } if on_conflict else None
+        return await self._request('POST', 'records', lambda r: r.json(), params=params, json_obj=records)
+
+    async def get_latest_source_activity(self, tdmq_id):
+        await self.connect()
+        r = await self._do_get(f'sources/{tdmq_id}/activity/latest')
+        if r['time'] is not None:
+            # pylint: disable=protected-access
+            r['time'] = self.client._parse_timestamp(r['time'])
+        return r
+
+    async def _fetch_timeseries(self, ts: TimeSeries) -> TimeSeries:
+        # pylint: disable=protected-access
+        if isinstance(ts.source, NonScalarSource):
+            ts._load_response(ts._set_time_from_response(
+                await self.get_timeseries(ts.source.tdmq_id, ts._fetch_args(), sparse=False)))
+            return ts
+        if self.client.use_arrow:
+            try:
+                _, table = await self.get_timeseries_arrow(ts.source.tdmq_id, ts._query_args())
+                ts._load_arrow_table(table)
+                return ts
+            except tdmq.errors.UnsupportedFunctionality:
+                _logger.info("The service does not support the Arrow format.  Falling back to JSON")
+                self.client.use_arrow = False
+        ts._load_response(ts._set_time_from_response(
+            await self.get_timeseries(ts.source.tdmq_id, ts._fetch_args(orient='columns'))))
+        return ts
+
+    async def gather_timeseries(self, sources: Iterable[Source], after=None, before=None, bucket=None,
+                                op=None, properties=None, fill=None) -> List[TimeSeries]:
+        """
+        Fetch concurrently the timeseries of `sources`, with the arguments of
+        ScalarSource.timeseries.  Returns the fetched TimeSeries objects, in
+        the order of `sources`.  As with NonScalarSource.timeseries, only
+        the index of the timeseries of non-scalar sources is fetched.
+        """
+        await self.connect()
+        # pylint: disable=protected-access
+        if self.client._property_types is None:
+            # fetched here, not by the blocking Client.get_property_types
+            self.client._set_entity_types(await self._do_get('entity_types'))
+        series = []
+        for source in sources:
+            if isinstance(source, NonScalarSource):
+                series.append(source.timeseries(after, before, bucket, op, properties))
+            else:
+                series.append(source.timeseries(after, before, bucket, op, properties, fill))
+        return list(await asyncio.gather(*(self._fetch_timeseries(ts) for ts in series)))
@@ -2,7 +2,10 @@
 import math
 import logging
 import os
+import threading
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timezone
 from functools import wraps
@@ -11,10 +14,18 @@ from urllib.parse import urlparse
 
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 
 import tiledb
 import tdmq.errors
+from tdmq import arrow_io
+from tdmq.client import frames, json_stream
+from tdmq.client.disk_cache import TimeseriesDiskCache
 from tdmq.client.sources import Source, NonScalarSource, ScalarSource
+from tdmq.client.timeseries import _to_datetime
+from tdmq.client.writer import BufferedWriter
 
 # FIXME need to do this to patch a overzealous logging by urllib3
 logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
@@ -37,6 +48,10 @@ class Client:
     TDMQ_DT_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
     TDMQ_DT_FMT_NO_MICRO = '%Y-%m-%dT%H:%M:%SZ'
 
+    EXPORT_FORMATS = ('csv', 'parquet')
+    FETCH_MANY_OUTPUTS = ('pandas', 'xarray')
+    TIMESERIES_CHUNK_SIZE = 65536
+
     @staticmethod
     def _parse_timestamp(ts):
         """
@@ -56,7 +71,41 @@ class Client:
             ts = ts.astimezone(timezone.utc)
         return ts.strftime(cls.TDMQ_DT_FMT)
 
-    def __init__(self, tdmq_base_url=None, auth_token=None, verify_ssl=None):
+    # Methods retried on errors and on the RETRY_STATUS responses:  all but POST
+    RETRY_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, tdmq_base_url=None, auth_token=None, verify_ssl=None, use_arrow=False,
+                 timeseries_cache_size=0, pool_size=10, max_retries=3, backoff_factor=0.5,
+                 timeout=(10, None), cache_dir=None):
+        """
+        The client keeps the connections to the service alive in a pool,
+        shared by all the threads using the client.
+
+        :param use_arrow: fetch scalar timeseries in the Arrow format, which
+                          requires pyarrow.  By default, JSON is used.  If the
+                          service does not support Arrow, the client falls
+                          back to JSON.
+        :param timeseries_cache_size: number of timeseries responses kept,
+                          with their ETag, to make conditional requests.  If
+                          the service replies that the timeseries has not
+                          changed, the cached response is returned.  The
+                          parsed responses are kept in memory, so the cache
+                          is disabled (0) by default.
+        :param pool_size: maximum number of connections kept open.  Threads
+                          wait for a free connection when they are all in use.
+        :param max_retries: number of retries of failed requests, with
+                          exponential backoff (`backoff_factor` * 2^n seconds).
+                          Requests that may not have reached the service are
+                          always retried;  others (e.g., read timeouts, 502,
+                          503 and 504 responses) only if they are
+                          idempotent, i.e., not POSTs.
+        :param timeout:   (connect, read) timeouts in seconds, as in
+                          `requests`.  None waits forever.
+        :param cache_dir: directory where scalar timeseries are cached
+                          across sessions (see `tdmq.client.disk_cache`).
+                          By default, they are not.
+        """
         self.base_url = (tdmq_base_url or
                          os.getenv('TDMQ_BASE_URL') or
                          self.DEFAULT_TDMQ_BASE_URL)
@@ -69,14 +118,49 @@ class Client:
         self.tiledb_storage_root = None
         self.tiledb_ctx = None
         self.tiledb_vfs = None
-        self._request_opts = dict()
+        self._request_opts = { 'timeout': timeout }
         if not verify_ssl:  # either None or False
             self._request_opts['verify'] = False
+        self._pool_size = pool_size
+        self._session = self._make_session(pool_size, max_retries, backoff_factor)
 
         self.headers = {"User-Agent": "TDMq client/unknown"}
         if auth_token is not None:
             self.headers["Authorization"] = f"Bearer {auth_token}"
         self.headers["Accept"] = "application/json"
+        # Ask for compressed responses, with all the encodings that can be
+        # decoded here (gzip, plus br and zstd if their packages are installed)
+        self.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+        self.use_arrow = use_arrow
+
+        self._timeseries_cache = OrderedDict()  # (resource, params) -> (etag, parsed response)
+        self._timeseries_cache_size = timeseries_cache_size
+        self._timeseries_cache_lock = threading.Lock()
+        self.timeseries_disk_cache = TimeseriesDiskCache(cache_dir, self.base_url) if cache_dir else None
+        # (entity_category, entity_type) -> {property: declared JSON type}
+        self._property_types = None
+        self._property_types_lock = threading.Lock()
+
+    @classmethod
+    def _make_session(cls, pool_size, max_retries, backoff_factor) -> requests.Session:
+        retry_args = dict(total=max_retries, backoff_factor=backoff_factor,
+                          status_forcelist=cls.RETRY_STATUS, raise_on_status=False)
+        try:
+            retry = Retry(allowed_methods=cls.RETRY_METHODS, **retry_args)
+        except TypeError:  # urllib3 < 1.26
+            retry = Retry(method_whitelist=cls.RETRY_METHODS, **retry_args)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self) -> None:
+        """
+        Close the connections to the service.
+        """
+        self._session.close()
 
     def requires_connection(func):
         """
@@ -93,29 +177,35 @@ class Client:
     def url_for(self, resource: str) -> str:
         return f'{self.base_url}/{resource}'
 
+    @classmethod
+    def _raise_for_status(cls, response: requests.Response) -> None:
+        cls._raise_for_status_code(response.status_code, response.reason)
+
     @staticmethod
-    def _raise_for_status(response: requests.Response) -> None:
-        if response.status_code < 400:
+    def _raise_for_status_code(status_code: int, reason: str) -> None:
+        if status_code < 400:
             return
-        if response.status_code == 401 or response.status_code == 403:
-            raise tdmq.errors.UnauthorizedError(response.reason, response.status_code)
-        if response.status_code == 404:
-            raise tdmq.errors.ItemNotFoundException(response.reason)
-        if response.status_code == 413:
-            raise tdmq.errors.QueryTooLargeException(response.reason)
-        if response.status_code == 500:
-            raise tdmq.errors.InternalServerError(response.reason)
-        if response.status_code == 501:
-            raise tdmq.errors.UnsupportedFunctionality(response.reason)
-        if response.status_code >= 400 and response.status_code < 500:
-            raise tdmq.errors.TdmqBadRequestException(response.reason, response.status_code)
-        raise tdmq.errors.TdmqError(title="Server error", status=response.status_code, detail=response.reason)
+        if status_code == 401 or status_code == 403:
+            raise tdmq.errors.UnauthorizedError(reason, status_code)
+        if status_code == 404:
+            raise tdmq.errors.ItemNotFoundException(reason)
+        if status_code == 413:
+            raise tdmq.errors.QueryTooLargeException(reason)
+        if status_code == 500:
+            raise tdmq.errors.InternalServerError(reason)
+        if status_code == 501:
+            raise tdmq.errors.UnsupportedFunctionality(reason)
+        if status_code >= 400 and status_code < 500:
+            raise tdmq.errors.TdmqBadRequestException(reason, status_code)
+        raise tdmq.errors.TdmqError(title="Server error", status=status_code, detail=reason)
 
     def connect(self):
         if self.connected:
             return
 
-        service_info = self._do_get('service_info')
+        self._configure(self._do_get('service_info'))
+
+    def _configure(self, service_info) -> None:
         _logger.debug("Service sent the following info: \n%s", service_info)
 
         if service_info['version'] != '0.1':
@@ -135,42 +225,75 @@ class Client:
         _logger.info("Client connected to TDMQ service at %s", self.base_url)
 
     def _check_if_authorized(self, response: requests.Response) -> None:
-        if response.status_code in (401, 403):
-            msg = f"Request not authorized ({response.status_code} {response.reason})"
-            if "nginx" in response.headers.get("Server", "").lower():
+        self._check_status_authorized(response.status_code, response.reason, response.headers)
+
+    def _check_status_authorized(self, status_code: int, reason: str, headers) -> None:
+        if status_code in (401, 403):
+            msg = f"Request not authorized ({status_code} {reason})"
+            if "nginx" in headers.get("Server", "").lower():
                 # This looks like our oauth2 proxy
                 _logger.debug("Looks like our request was denied authorization by the TDMq oauth2 proxy")
                 url_parts = urlparse(self.base_url)
                 sign_in_uri = f"{url_parts.scheme}://{url_parts.netloc}/oauth2/sign_in"
                 msg += f"\nPlease get an authentication token from {sign_in_uri}"
             _logger.error(msg)
-            raise tdmq.errors.UnauthorizedError(msg, status=response.status_code)
+            raise tdmq.errors.UnauthorizedError(msg, status=status_code)
 
     def _do_get(self, resource, params=None):
-        r = requests.get(f'{self.base_url}/{resource}', params=params,
-                         headers=self.headers, **self._request_opts)
+        r = self._session.get(f'{self.base_url}/{resource}', params=params,
+                              headers=self.headers, **self._request_opts)
         self._check_if_authorized(r)
         self._raise_for_status(r)
         return r.json()
 
     @contextmanager
-    def _do_get_stream_ctx(self, resource, params=None):
-        with requests.get(f'{self.base_url}/{resource}', stream=True, params=params,
-                          headers=self.headers, **self._request_opts) as r:
+    def _do_get_stream_ctx(self, resource, params=None, headers=None):
+        headers = dict(self.headers, **headers) if headers else self.headers
+        with self._session.get(f'{self.base_url}/{resource}', stream=True, params=params,
+                               headers=headers, **self._request_opts) as r:
             self._check_if_authorized(r)
             self._raise_for_status(r)
             yield r
 
-    def _do_post(self, resource: str, json_obj) -> requests.Response:
-        r = requests.post(resource, json=json_obj, headers=self.headers,
-                          **self._request_opts)
+    def _do_get_timeseries_cached(self, resource, params, parse_fn):
+        """
+        GET a timeseries `resource`, parsing the response with `parse_fn`.  If a
+        response for the same request is cached, the request is made
+        conditional on its ETag and the cached result is returned if the
+        service replies 304 (Not Modified).
+        """
+        key = (resource, tuple(sorted((k, str(v)) for k, v in params.items())))
+        with self._timeseries_cache_lock:
+            cached = self._timeseries_cache.get(key)
+        headers = { 'If-None-Match': cached[0] } if cached else None
+        with self._do_get_stream_ctx(resource, params=params, headers=headers) as req:
+            if req.status_code == 304 and cached:
+                _logger.debug('%s not modified.  Using cached response', resource)
+                with self._timeseries_cache_lock:
+                    if key in self._timeseries_cache:
+                        self._timeseries_cache.move_to_end(key)
+                return cached[1]
+            result = parse_fn(req)
+            etag = req.headers.get('ETag')
+
+        if etag and self._timeseries_cache_size > 0:
+            with self._timeseries_cache_lock:
+                self._timeseries_cache[key] = (etag, result)
+                self._timeseries_cache.move_to_end(key)
+                while len(self._timeseries_cache) > self._timeseries_cache_size:
+                    self._timeseries_cache.popitem(last=False)
+        return result
+
+    def _do_post(self, resource: str, json_obj, params=None) -> requests.Response:
+        r = self._session.post(resource, json=json_obj, params=params, headers=self.headers,
+                               **self._request_opts)
         self._check_if_authorized(r)
         self._raise_for_status(r)
         return r
 
     def _destroy_source(self, tdmq_id):
-        r = requests.delete(f'{self.base_url}/sources/{tdmq_id}', headers=self.headers,
-                            **self._request_opts)
+        r = self._session.delete(f'{self.base_url}/sources/{tdmq_id}', headers=self.headers,
+                                 **self._request_opts)
         self._check_if_authorized(r)
         self._raise_for_status(r)
         array_name = self._source_data_path(tdmq_id)
@@ -255,8 +378,29 @@ class Client:
         return self.get_source(tdmq_id)
 
     @requires_connection
-    def add_records(self, records) -> None:
-        self._do_post(f'{self.base_url}/records', json_obj=records)
+    def add_records(self, records, on_conflict: str = None) -> Dict[str, int]:
+        """
+        Load `records`.  With `on_conflict` ('ignore' or 'update'), records
+        with the same source and time as a stored one are skipped or merged
+        into it, so that uploads can be safely retried.  This requires the
+        unique index on the records on the server (`flask db record-index`).
+
+        Returns the counts of the records loaded (and skipped or updated) by
+        the server.
+        """
+        params = { 'on_conflict': on_conflict } if on_conflict else None
+        r = self._do_post(f'{self.base_url}/records', json_obj=records, params=params)
+        return r.json()
+
+    @requires_connection
+    def buffered_writer(self, **kwargs) -> BufferedWriter:
+        """
+        Create a BufferedWriter, which posts the records written to it in
+        batches from a background thread.  See tdmq.client.writer for the
+        arguments.  Records of many sources can be written to the same
+        writer, e.g., with `source.ingest_one(t, data, writer=writer)`.
+        """
+        return BufferedWriter(self, **kwargs)
 
     @requires_connection
     def get_entity_categories(self):
@@ -266,7 +410,35 @@ class Client:
     def get_entity_types(self):
         return self._do_get('entity_types')
 
-    def __source_factory(self, api_struct):
+    @staticmethod
+    def _schema_property_types(schema) -> Dict[str, str]:
+        types = dict()
+        for prop, spec in ((schema or {}).get('properties') or {}).items():
+            t = spec.get('type') if isinstance(spec, dict) else None
+            if isinstance(t, list):
+                t = [ x for x in t if x != 'null' ]
+                t = t[0] if len(t) == 1 else None
+            if isinstance(t, str):
+                types[prop] = t
+        return types
+
+    def _set_entity_types(self, entity_types) -> None:
+        self._property_types = {
+            (et['entity_category'], et['entity_type']): self._schema_property_types(et.get('schema'))
+            for et in entity_types['entity_types'] }
+
+    def get_property_types(self, entity_category, entity_type) -> Dict[str, str]:
+        """
+        JSON schema types of the properties of an entity type, as declared by
+        its schema (empty if it has none).  Scalar timeseries are decoded
+        according to these types.  The entity types are fetched once.
+        """
+        with self._property_types_lock:
+            if self._property_types is None:
+                self._set_entity_types(self.get_entity_types())
+            return self._property_types.get((entity_category, entity_type), {})
+
+    def _source_factory(self, api_struct):
         if api_struct['description'].get('shape'):
             return NonScalarSource(self, api_struct['tdmq_id'], api_struct)
         # else
@@ -327,33 +499,67 @@ class Client:
             args.update(kwargs)
         else:
             args = kwargs
-        return [ self.__source_factory(s) for s in self._do_get('sources', params=args) ]
+        return [ self._source_factory(s) for s in self._do_get('sources', params=args) ]
+
+    @requires_connection
+    def export_sources(self, path: str, args: Dict[str, Any] = None, chunk_size=65536, **kwargs) -> None:
+        """
+        Write the catalog of the sources selected by `args` (see `find_sources`)
+        to the Parquet file `path`.
+        """
+        params = dict(args or {}, **kwargs)
+        params['format'] = 'parquet'
+        with self._do_get_stream_ctx('sources', params=params) as req, open(path, 'wb') as f:
+            for chunk in req.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
 
     @requires_connection
     def get_source(self, tdmq_id, anonymized=True):
         res = self._do_get(f'sources/{tdmq_id}', params={'anonymized': anonymized})
         assert res['tdmq_id'] == str(tdmq_id)
-        return self.__source_factory(res)
+        return self._source_factory(res)
 
     @requires_connection
     def get_timeseries(self, code, args, sparse: bool = None):
+        """
+        Fetch a timeseries in the JSON format.  The response is decoded as
+        it arrives (see `tdmq.client.json_stream`):  if `args` asks for the
+        columnar layout (orient=columns), the items are returned as numpy
+        arrays, even if the service sends rows.
+        """
         args = dict((k, v) for k, v in args.items() if v is not None)
         if sparse is not None:
             args['sparse'] = sparse
         # for testing!  args['batch_size'] = 1
         _logger.debug('get_timeseries(%s, %s)', code, args)
         try:
-            with self._do_get_stream_ctx(f'sources/{code}/timeseries_stream', params=args) as req:
-                return req.json()
+            return self._do_get_timeseries_cached(
+                f'sources/{code}/timeseries_stream', args,
+                lambda req: json_stream.parse_timeseries(req.iter_content(chunk_size=self.TIMESERIES_CHUNK_SIZE),
+                                                         columns=args.get('orient') == 'columns'))
         except requests.exceptions.ChunkedEncodingError as e:
             if '0 bytes read' in str(e).lower():
                 raise RuntimeError("Server took too long to respond.  Try reducing the size of the time series you're requesting")
             raise
 
+    @requires_connection
+    def get_timeseries_arrow(self, code, args):
+        """
+        Fetch a timeseries in the Arrow format.
+
+        :returns: (metadata dict, pyarrow.Table).  The table has the columns
+                  'time', 'footprint' and one column per field.
+        """
+        args = dict((k, v) for k, v in args.items() if v is not None)
+        args['format'] = 'arrow'
+        _logger.debug('get_timeseries_arrow(%s, %s)', code, args)
+        return self._do_get_timeseries_cached(
+            f'sources/{code}/timeseries_stream', args, lambda req: arrow_io.read_ts_arrow(req.content))
+
     @requires_connection
     def export_timeseries(self, code, args, data_format: str = 'csv', chunk_size=16384):
-        if data_format != 'csv':
-            raise NotImplementedError("only CSV export is supported")
+        if data_format not in self.EXPORT_FORMATS:
+            raise NotImplementedError(f"Unsupported export format {data_format}.  Supported formats: {self.EXPORT_FORMATS}")
         _logger.debug('export_timeseries(%s, %s, data_format=%s, chunk_size=%s)',
                       code, args, data_format, chunk_size)
         args = dict((k, v) for k, v in args.items() if v is not None)
@@ -362,6 +568,50 @@ class Client:
             for chunk in req.iter_content(chunk_size=chunk_size):
                 yield chunk
 
+    @requires_connection
+    def fetch_many(self, sources: List[Source], after=None, before=None, bucket=None, op=None,
+                   properties=None, fill=None, output: str = 'pandas'):
+        """
+        Fetch the timeseries of many scalar sources, in parallel over the
+        pooled connections, and align them on a common time axis (see
+        `tdmq.client.frames`).  The arguments are those of
+        ScalarSource.timeseries.
+
+        :param output: 'pandas' for a DataFrame indexed by (source, time),
+                       with one column per property;  'xarray' for a Dataset
+                       with `source` and `time` dimensions.  Sources are
+                       labelled with their external id.
+        """
+        if output not in self.FETCH_MANY_OUTPUTS:
+            raise NotImplementedError(f"Unsupported output {output}.  Supported outputs: {self.FETCH_MANY_OUTPUTS}")
+        if any(isinstance(s, NonScalarSource) for s in sources):
+            raise ValueError("fetch_many only supports scalar sources")
+        series = [ s.timeseries(after, before, bucket, op, properties, fill) for s in sources ]
+        if series:
+            with ThreadPoolExecutor(max_workers=min(self._pool_size, len(series))) as executor:
+                # pylint: disable=protected-access
+                list(executor.map(lambda ts: ts._ensure_fetched(), series))
+        if output == 'xarray':
+            return frames.to_dataset(series, bucket)
+        return frames.to_dataframe(series, bucket)
+
+    @requires_connection
+    def get_timeseries_summary(self, tdmq_id, after=None, before=None):
+        """
+        Number of records of source `tdmq_id` in [after, before) and the
+        times of the first and the last one (None if there are no records).
+
+        :returns: dict with keys 'count', 'first' and 'last'
+        """
+        _logger.debug("get_timeseries_summary(%s, %s, %s)", tdmq_id, after, before)
+        params = {'after': after, 'before': before, 'time_format': 'epoch_us'}
+        r = self._do_get(f'sources/{tdmq_id}/timeseries_summary',
+                         params={ k: v for k, v in params.items() if v is not None })
+        for k in ('first', 'last'):
+            if r[k] is not None:
+                r[k] = _to_datetime(r[k])
+        return r
+
     @requires_connection
     def get_latest_source_activity(self, tdmq_id):
         _logger.debug("get_latest_source_activity(%s)", tdmq_id)
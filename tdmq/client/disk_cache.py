@@ -0,0 +1,283 @@
+"""
+Persistent on-disk cache of scalar timeseries.
+
+A Client created with a `cache_dir` keeps the scalar timeseries it fetches
+on disk, so that re-running a notebook does not download the same
+historical data again.  The timeseries are cached per source and query
+(fields, bucket and operations) as segments:  numpy .npz files, each
+covering a time interval [start, end), listed in a manifest.json.  When a
+timeseries is requested, only the parts of [after, before) that aren't
+covered by the segments are fetched -- typically, the newest tail.  The
+segments touched by a request are then merged into one.
+
+The cache can only hold records that the service already has, so the
+coverage stops at the time of the latest record of the source, as reported
+by the service (`Client.get_latest_source_activity`):  later records may
+still arrive.  With a bucket, it stops at the start of the bucket of the
+latest record, since that bucket may still be filling up.  The latest
+activity time is checked at every request:  if it moved back (records were
+deleted), the cached timeseries of the source are dropped.  Records
+ingested with a timestamp older than the latest one aren't detected;  call
+`clear` after such backfills.
+
+With a bucket, the requested interval is widened to whole buckets, so that
+no cached bucket aggregates only part of its records.  Timeseries with gap
+filling (`fill`) are not cached.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tdmq.client.timeseries import NoneArray, ScalarTimeSeries, _to_datetime, _to_us
+
+_logger = logging.getLogger(__name__)
+
+# Origin of the buckets of TimescaleDB's time_bucket:  2000-01-03 UTC
+_BUCKET_ORIGIN = 946857600 * 1_000_000
+# Unbounded intervals
+_MIN, _MAX = int(np.iinfo(np.int64).min), int(np.iinfo(np.int64).max)
+
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def _concat(pieces: List[Tuple[np.ndarray, Dict]]) -> Tuple[np.ndarray, Dict]:
+    """
+    Concatenate the (time, series) `pieces`.  Fields missing in some piece
+    are null there.
+    """
+    time = np.concatenate([ t for t, _ in pieces ]) if pieces else np.array([], dtype='datetime64[us]')
+    series = dict()
+    for name in dict.fromkeys(name for _, s in pieces for name in s):
+        parts = [ (s.get(name), len(t)) for t, s in pieces ]
+        arrays = [ p for p, _ in parts if p is not None and not isinstance(p, NoneArray) ]
+        if not arrays:
+            series[name] = NoneArray(len(time))
+        elif len(arrays) == len(parts):
+            series[name] = np.concatenate(arrays)
+        elif all(a.dtype.kind in 'biuf' for a in arrays):
+            series[name] = np.concatenate([
+                np.full(n, np.nan) if p is None or isinstance(p, NoneArray) else p.astype(np.float64)
+                for p, n in parts ])
+        else:
+            series[name] = np.concatenate([
+                np.full(n, None, dtype=object) if p is None or isinstance(p, NoneArray) else p.astype(object)
+                for p, n in parts ])
+    return time, series
+
+
+def _slice(piece: Tuple[np.ndarray, Dict], start: int, end: int) -> Tuple[np.ndarray, Dict]:
+    """
+    The part of `piece` in [start, end).
+    """
+    time, series = piece
+    us = time.view(np.int64)
+    i, j = np.searchsorted(us, start), np.searchsorted(us, end)
+    if i == 0 and j == len(time):
+        return piece
+    return time[i:j], { name: (NoneArray(j - i) if isinstance(v, NoneArray) else v[i:j])
+                        for name, v in series.items() }
+
+
+class TimeseriesDiskCache:
+    def __init__(self, cache_dir: str, base_url: str):
+        self.cache_dir = cache_dir
+        self._base_url = base_url
+        self._locks: Dict[str, threading.Lock] = dict()
+        self._locks_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def clear(self, tdmq_id: str = None) -> None:
+        """
+        Drop the cached timeseries of source `tdmq_id`, or of all sources.
+        """
+        path = os.path.join(self.cache_dir, str(tdmq_id)) if tdmq_id else self.cache_dir
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _interval(ts: ScalarTimeSeries) -> Optional[Tuple[int, int]]:
+        """
+        The interval of `ts` in microseconds, widened to whole buckets.
+        None if `ts` can't be cached.
+        """
+        if ts.fill is not None:
+            return None
+        try:
+            start = _MIN if ts.after is None else _to_us(ts.after)
+            end = _MAX if ts.before is None else _to_us(ts.before)
+        except (TypeError, ValueError):
+            return None
+        if ts.bucket:
+            width = int(round(float(ts.bucket) * 1_000_000))
+            if start != _MIN:
+                start = _BUCKET_ORIGIN + (start - _BUCKET_ORIGIN) // width * width
+            if end != _MAX:
+                end = _BUCKET_ORIGIN - (_BUCKET_ORIGIN - end) // width * width
+        return start, end
+
+    def applies(self, ts: ScalarTimeSeries) -> bool:
+        return self._interval(ts) is not None
+
+    def _directory(self, ts: ScalarTimeSeries) -> str:
+        args = ts._query_args()  # pylint: disable=protected-access
+        query = json.dumps([self._base_url] + [ args.get(k) for k in ('fields', 'bucket', 'op', 'ops') ])
+        return os.path.join(self.cache_dir, str(ts.source.tdmq_id), hashlib.sha1(query.encode()).hexdigest())
+
+    def _lock(self, directory: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(directory, threading.Lock())
+
+    # storage
+
+    @staticmethod
+    def _read_manifest(directory: str) -> Dict:
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            _logger.warning("Ignoring the corrupted timeseries cache in %s", directory)
+        return {'version': MANIFEST_VERSION, 'latest': None, 'segments': []}
+
+    @staticmethod
+    def _write_manifest(directory: str, manifest: Dict) -> None:
+        tmp = os.path.join(directory, f'.{MANIFEST}.{uuid.uuid4().hex}')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(directory, MANIFEST))
+
+    @staticmethod
+    def _save_segment(directory: str, start: int, end: int, piece: Tuple[np.ndarray, Dict]) -> Dict:
+        time, series = piece
+        arrays = {'time': time.view(np.int64)}
+        columns = []
+        for i, (name, values) in enumerate(series.items()):
+            if isinstance(values, NoneArray):
+                columns.append([name, 'null'])
+            elif values.dtype.kind in 'biuf':
+                columns.append([name, 'array'])
+                arrays[f'c{i}'] = values
+            else:
+                # object columns are stored as JSON, so they can be loaded without pickle
+                columns.append([name, 'json'])
+                arrays[f'c{i}'] = np.array([ json.dumps(v, default=_json_default) for v in values ], dtype=str)
+        file_name = f'{uuid.uuid4().hex}.npz'
+        np.savez(os.path.join(directory, file_name), **arrays)
+        return {'file': file_name, 'start': start, 'end': end, 'columns': columns}
+
+    @staticmethod
+    def _load_segment(directory: str, segment: Dict) -> Tuple[np.ndarray, Dict]:
+        with np.load(os.path.join(directory, segment['file']), allow_pickle=False) as data:
+            time = data['time'].view('datetime64[us]')
+            series = dict()
+            for i, (name, kind) in enumerate(segment['columns']):
+                if kind == 'null':
+                    series[name] = NoneArray(len(time))
+                elif kind == 'array':
+                    series[name] = data[f'c{i}']
+                else:
+                    values = np.empty(len(time), dtype=object)
+                    for j, v in enumerate(data[f'c{i}']):
+                        values[j] = json.loads(v)
+                    series[name] = values
+        return time, series
+
+    @staticmethod
+    def _drop_segments(directory: str, segments: List[Dict]) -> None:
+        for segment in segments:
+            try:
+                os.remove(os.path.join(directory, segment['file']))
+            except FileNotFoundError:
+                pass
+
+    # fetching
+
+    @staticmethod
+    def _fetch_remote(ts: ScalarTimeSeries, start: int, end: int) -> Tuple[np.ndarray, Dict]:
+        client = ts.source.client
+        part = ScalarTimeSeries(
+            ts.source,
+            None if start == _MIN else client._format_timestamp(_to_datetime(start)),  # pylint: disable=protected-access
+            None if end == _MAX else client._format_timestamp(_to_datetime(end)),  # pylint: disable=protected-access
+            ts.bucket, ts.op, ts.properties)
+        part._fetch_remote()  # pylint: disable=protected-access
+        return part.time, part.series
+
+    def fetch(self, ts: ScalarTimeSeries) -> Tuple[np.ndarray, Dict]:
+        """
+        Fetch `ts` through the cache.  Returns (time, series).
+        """
+        start, end = self._interval(ts)
+        latest = ts.source.client.get_latest_source_activity(ts.source.tdmq_id)['time']
+        latest = None if latest is None else _to_us(latest)
+        if latest is None:
+            cached_until = _MIN
+        elif ts.bucket:
+            width = int(round(float(ts.bucket) * 1_000_000))
+            cached_until = _BUCKET_ORIGIN + (latest - _BUCKET_ORIGIN) // width * width
+        else:
+            cached_until = latest + 1
+
+        directory = self._directory(ts)
+        with self._lock(directory):
+            os.makedirs(directory, exist_ok=True)
+            manifest = self._read_manifest(directory)
+            segments = sorted(manifest['segments'], key=lambda s: s['start'])
+            if manifest['latest'] is not None and (latest is None or latest < manifest['latest']):
+                _logger.info("The latest activity of source %s moved back.  Dropping its cached timeseries",
+                             ts.source.tdmq_id)
+                self._drop_segments(directory, segments)
+                segments = []
+
+            # fetch the gaps
+            gaps, pos = [], start
+            for segment in segments:
+                if segment['end'] <= pos or segment['start'] >= end:
+                    continue
+                if segment['start'] > pos:
+                    gaps.append((pos, segment['start']))
+                pos = max(pos, segment['end'])
+            if pos < end:
+                gaps.append((pos, end))
+            tail = []
+            for gap_start, gap_end in gaps:
+                _logger.debug("Fetching %s [%s, %s) into the timeseries cache", ts.source.tdmq_id, gap_start, gap_end)
+                piece = self._fetch_remote(ts, gap_start, gap_end)
+                if min(gap_end, cached_until) > gap_start:
+                    segments.append(self._save_segment(
+                        directory, gap_start, min(gap_end, cached_until), _slice(piece, gap_start, cached_until)))
+                if gap_end > cached_until:
+                    tail.append(_slice(piece, max(gap_start, cached_until), gap_end))
+
+            # merge the segments overlapping (or adjacent to) the request
+            segments.sort(key=lambda s: s['start'])
+            touched = [ s for s in segments if s['end'] >= start and s['start'] <= end ]
+            others = [ s for s in segments if s not in touched ]
+            pieces = [ self._load_segment(directory, s) for s in touched ]
+            if len(touched) > 1:
+                merged = self._save_segment(directory, touched[0]['start'], touched[-1]['end'], _concat(pieces))
+                self._drop_segments(directory, touched)
+                touched = [merged]
+            manifest['segments'] = others + touched
+            manifest['latest'] = latest
+            self._write_manifest(directory, manifest)
+
+        return _concat([ _slice(p, start, end) for p in pieces ] + tail)
@@ -0,0 +1,104 @@
+"""
+Alignment of the timeseries of many scalar sources on a common time axis.
+
+The time axis is the union of the timestamps of the series.  With a
+`bucket`, it also includes the missing buckets between the first and the
+last, so that it is a regular grid.  Each property becomes a (source, time)
+array:  float64, with NaN where a source has no value, if all its values
+are numbers;  else object, with None.  The arrays are filled one source at
+a time, with vectorized assignments, and wrapped into a pandas DataFrame
+indexed by (source, time) or an xarray Dataset with `source` and `time`
+dimensions.
+
+pandas and xarray are optional dependencies:  without them, `to_dataframe`
+and `to_dataset` raise ImportError.
+"""
+
+from numbers import Number
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from tdmq.client.timeseries import NoneArray, ScalarTimeSeries
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+
+def _as_float(values) -> np.ndarray:
+    """
+    Return `values` as a float64 array, with NaN for None, or None if some
+    value isn't a number.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'biuf':
+        return values.astype(np.float64)
+    if values.dtype.kind == 'O' and all(v is None or isinstance(v, Number) for v in values):
+        return values.astype(np.float64)
+    return None
+
+
+def align(series: List[ScalarTimeSeries], bucket: float = None) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Align the (fetched) `series` on a common time axis.
+
+    :returns: (time axis, dict mapping each property to its (source, time) array)
+    """
+    if not series:
+        return np.array([], dtype='datetime64[us]'), dict()
+    times = np.unique(np.concatenate([ ts.time for ts in series ]))
+    if bucket and len(times) > 1:
+        step = np.timedelta64(int(round(float(bucket) * 1e6)), 'us')
+        times = np.union1d(times, np.arange(times[0], times[-1] + step, step))
+    positions = [ np.searchsorted(times, ts.time) for ts in series ]
+
+    columns = dict()
+    for name in dict.fromkeys(name for ts in series for name in ts.series):
+        values = [ ts.series.get(name) for ts in series ]
+        values = [ None if v is None or isinstance(v, NoneArray) else v for v in values ]
+        floats = [ _as_float(v) if v is not None else None for v in values ]
+        if all(f is not None for v, f in zip(values, floats) if v is not None):
+            column = np.full((len(series), len(times)), np.nan)
+            values = floats
+        else:
+            column = np.full((len(series), len(times)), None, dtype=object)
+        for i, v in enumerate(values):
+            if v is not None:
+                column[i, positions[i]] = v
+        columns[name] = column
+    return times, columns
+
+
+def _labels(series: List[ScalarTimeSeries]) -> List[str]:
+    return [ ts.source.id or ts.source.tdmq_id for ts in series ]
+
+
+def to_dataframe(series: List[ScalarTimeSeries], bucket: float = None):
+    """
+    Align `series` into a pandas DataFrame indexed by (source, time), with
+    one column per property.
+    """
+    if pd is None:
+        raise ImportError("to_dataframe requires the pandas package")
+    times, columns = align(series, bucket)
+    index = pd.MultiIndex.from_product([_labels(series), pd.DatetimeIndex(times)], names=['source', 'time'])
+    return pd.DataFrame({ name: column.ravel() for name, column in columns.items() }, index=index)
+
+
+def to_dataset(series: List[ScalarTimeSeries], bucket: float = None):
+    """
+    Align `series` into an xarray Dataset with `source` and `time`
+    dimensions, with one variable per property.
+    """
+    if xr is None:
+        raise ImportError("to_dataset requires the xarray package")
+    times, columns = align(series, bucket)
+    return xr.Dataset({ name: (('source', 'time'), column) for name, column in columns.items() },
+                      coords={'source': _labels(series), 'time': times})
@@ -0,0 +1,366 @@
+"""
+Incremental parsing of JSON timeseries responses.
+
+Decoding a timeseries response with `json.loads` needs the whole body in
+memory, plus the lists of Python objects of its items, before any numpy
+array is built from them.  `TimeseriesParser` decodes the body as it
+arrives, chunk by chunk.  The keys of the response before "items" are
+decoded as usual;  the items are decoded a few at a time and:
+
+  * with the columnar layout (orient=columns), appended to a growable numpy
+    buffer per field, so that the peak memory is close to the size of the
+    final arrays.  If the parser is created with `columns=True`, responses
+    with the rows layout (dense or sparse) are transposed into columns as
+    they are read, and returned as if they had the columnar layout;
+  * else, appended to the list of rows, as `json.loads` would do.
+
+The column buffers are typed after their values:  int64 for integers,
+float64 for numbers (with NaN for nulls), bool for booleans and object for
+anything else.  Columns without any value are returned as NoneArrays.
+"""
+
+import codecs
+import json
+import re
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from tdmq.client.timeseries import NoneArray
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+# the characters that may follow a value
+_delimiters = frozenset(' \t\n\r,:]}')
+
+# numpy kind of the column that can hold the values of each JSON type
+_KINDS = {type(None): None, bool: 'b', int: 'i', float: 'f'}
+
+
+def _object_array(values: List) -> np.ndarray:
+    array = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    return array
+
+
+class ColumnBuffer:
+    """
+    Growable typed array.  Its type is promoted (int64 -> float64 -> object,
+    bool -> object) as the values require.
+    """
+    INITIAL_CAPACITY = 1024
+    DTYPES = {'i': np.int64, 'f': np.float64, 'b': np.bool_, 'O': object}
+
+    def __init__(self):
+        self._data = None
+        self._kind = None
+        self._has_nulls = False
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _target_kind(self, kinds) -> str:
+        kinds = set(kinds)
+        has_nulls = self._has_nulls or None in kinds
+        kinds.discard(None)
+        if self._kind is not None:
+            kinds.add(self._kind)
+        if not kinds:
+            return None
+        if 'O' in kinds or ('b' in kinds and (len(kinds) > 1 or has_nulls)):
+            return 'O'
+        if kinds == {'b'}:
+            return 'b'
+        if 'f' in kinds or has_nulls:
+            return 'f'
+        return 'i'
+
+    def _promote(self, kind: str, capacity: int) -> None:
+        if self._data is None:
+            # only nulls so far
+            self._data = np.empty(capacity, dtype=self.DTYPES[kind])
+            if self._len > 0:
+                self._data[:self._len] = np.nan if kind == 'f' else None
+        elif kind == 'O':
+            data = np.empty(capacity, dtype=object)
+            data[:self._len] = self._data[:self._len]
+            if self._kind == 'f' and self._has_nulls:
+                nulls = np.isnan(self._data[:self._len])
+                data[:self._len][nulls] = None
+            self._data = data
+        else:
+            self._data = self._data.astype(self.DTYPES[kind])
+        self._kind = kind
+
+    def extend(self, values: List) -> None:
+        if not values:
+            return
+        kinds = { _KINDS.get(t, 'O') for t in set(map(type, values)) }
+        kind = self._target_kind(kinds)
+        self._has_nulls = self._has_nulls or None in kinds
+        n = self._len + len(values)
+        if kind is None:
+            self._len = n
+            return
+        if self._data is not None and n > len(self._data):
+            self._data.resize(max(n, 2 * len(self._data)), refcheck=False)
+        if kind != self._kind:
+            self._promote(kind, max(n, self.INITIAL_CAPACITY) if self._data is None else len(self._data))
+        if kind == 'i':
+            try:
+                self._data[self._len:n] = values
+            except OverflowError:
+                # integers beyond int64
+                self._promote('O', len(self._data))
+                kind = 'O'
+        if kind == 'O':
+            self._data[self._len:n] = _object_array(values)
+        elif kind != 'i':
+            self._data[self._len:n] = values
+        self._len = n
+
+    def finish(self):
+        """
+        Return the array of the values:  a numpy array, or a NoneArray if
+        all the values are null.
+        """
+        if self._kind is None:
+            return NoneArray(self._len)
+        self._data.resize(self._len, refcheck=False)
+        return self._data
+
+
+class TimeseriesParser:
+    """
+    Incremental parser of a JSON timeseries response (see the module
+    documentation).  Pass the chunks of the body to `feed`, then call
+    `finish` to get the decoded response.
+    """
+    def __init__(self, columns: bool = False):
+        self._to_columns = columns
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._pos = 0
+        self._final = False
+        self._state = self._start
+        self._key = None
+        self._result = dict()
+        self._rows = None          # rows layout, not transposed
+        self._columns = None       # field -> ColumnBuffer, or decoded value
+        self._column = None        # ColumnBuffer being read
+
+    def feed(self, chunk: bytes) -> None:
+        self._text = self._text[self._pos:] + self._text_decoder.decode(chunk)
+        self._pos = 0
+        while self._state():
+            pass
+
+    def finish(self) -> Dict:
+        self._text = self._text[self._pos:] + self._text_decoder.decode(b'', final=True)
+        self._pos = 0
+        self._final = True
+        while self._state():
+            pass
+        if self._state != self._end or self._skip_whitespace() < len(self._text):
+            raise ValueError("Truncated or invalid JSON timeseries response")
+        return self._result
+
+    # helpers
+
+    def _skip_whitespace(self) -> int:
+        self._pos = _whitespace.match(self._text, self._pos).end()
+        return self._pos
+
+    def _peek(self) -> str:
+        """
+        Next non-whitespace character, or None if more data are needed.
+        """
+        pos = self._skip_whitespace()
+        return self._text[pos] if pos < len(self._text) else None
+
+    def _expect(self, char: str, state) -> bool:
+        c = self._peek()
+        if c is None:
+            return False
+        if c != char:
+            raise ValueError(f"Invalid JSON timeseries response:  expected {char!r} at {c!r}")
+        self._pos += 1
+        self._state = state
+        return True
+
+    def _decode(self):
+        """
+        Decode the next value.  Returns (True, value), or (False, None) if
+        more data are needed.
+        """
+        if self._peek() is None:
+            return False, None
+        try:
+            value, end = _decoder.raw_decode(self._text, self._pos)
+        except ValueError:
+            if self._final:
+                raise
+            return False, None
+        if not self._final and (end == len(self._text) or self._text[end] not in _delimiters):
+            # a number may continue in the next chunk
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _read_elements(self, fast: bool) -> Tuple[List, bool]:
+        """
+        Decode the elements of the current array available in the buffer.
+        Returns (values, whether the array is closed).  If `fast`, first try
+        to decode at once all the elements up to the end of the array or the
+        last comma:  that works for arrays of scalars.
+        """
+        values = []
+        if fast:
+            text, pos = self._text, self._skip_whitespace()
+            if pos < len(text) and text[pos] == ',':
+                pos += 1
+            close = text.find(']', pos)
+            end = close if close >= 0 else text.rfind(',', pos)
+            if end > pos:
+                try:
+                    values = json.loads('[' + text[pos:end] + ']')
+                    self._pos = end if close < 0 else end + 1
+                    if close >= 0:
+                        return values, True
+                except ValueError:
+                    pass
+        while True:
+            c = self._peek()
+            if c is None:
+                return values, False
+            if c == ']':
+                self._pos += 1
+                return values, True
+            if c == ',':
+                self._pos += 1
+                continue
+            done, value = self._decode()
+            if not done:
+                return values, False
+            values.append(value)
+
+    # states:  each returns whether it made progress
+
+    def _start(self) -> bool:
+        return self._expect('{', self._next_key)
+
+    def _next_key(self) -> bool:
+        c = self._peek()
+        if c == '}':
+            self._pos += 1
+            self._state = self._end
+            return True
+        if c == ',':
+            self._pos += 1
+            return True
+        done, key = self._decode()
+        if not done:
+            return False
+        self._key = key
+        return self._set_state(self._colon)
+
+    def _colon(self) -> bool:
+        return self._expect(':', self._value)
+
+    def _set_state(self, state) -> bool:
+        self._state = state
+        return True
+
+    def _value(self) -> bool:
+        if self._key == 'items':
+            c = self._peek()
+            if c == '[':
+                self._pos += 1
+                if self._to_columns:
+                    self._columns = { f: ColumnBuffer() for f in self._result['fields'] }
+                else:
+                    self._rows = []
+                return self._set_state(self._rows_items)
+            if c == '{':
+                self._pos += 1
+                self._columns = dict()
+                return self._set_state(self._next_column)
+        done, value = self._decode()
+        if not done:
+            return False
+        self._result[self._key] = value
+        return self._set_state(self._next_key)
+
+    def _rows_items(self) -> bool:
+        rows, closed = self._read_elements(fast=False)
+        if rows:
+            if self._rows is not None:
+                self._rows.extend(rows)
+            elif isinstance(rows[0], dict):
+                for f, buffer in self._columns.items():
+                    buffer.extend([ row.get(f) for row in rows ])
+            else:
+                for buffer, values in zip(self._columns.values(), zip(*rows)):
+                    buffer.extend(list(values))
+        if closed:
+            if self._rows is not None:
+                self._result['items'] = self._rows
+            else:
+                self._result['orient'] = 'columns'
+                self._result['items'] = { f: b.finish() for f, b in self._columns.items() }
+            self._state = self._next_key
+        return bool(rows) or closed
+
+    def _next_column(self) -> bool:
+        c = self._peek()
+        if c == '}':
+            self._pos += 1
+            self._result['items'] = {
+                f: b.finish() if isinstance(b, ColumnBuffer) else b for f, b in self._columns.items() }
+            return self._set_state(self._next_key)
+        if c == ',':
+            self._pos += 1
+            return True
+        done, key = self._decode()
+        if not done:
+            return False
+        self._key = key
+        return self._set_state(self._column_colon)
+
+    def _column_colon(self) -> bool:
+        return self._expect(':', self._column_value)
+
+    def _column_value(self) -> bool:
+        c = self._peek()
+        if c == '[':
+            self._pos += 1
+            self._column = self._columns[self._key] = ColumnBuffer()
+            return self._set_state(self._column_items)
+        done, value = self._decode()
+        if not done:
+            return False
+        self._columns[self._key] = value
+        return self._set_state(self._next_column)
+
+    def _column_items(self) -> bool:
+        values, closed = self._read_elements(fast=True)
+        self._column.extend(values)
+        if closed:
+            self._column = None
+            self._state = self._next_column
+        return bool(values) or closed
+
+    def _end(self) -> bool:
+        return False
+
+
+def parse_timeseries(chunks: Iterable[bytes], columns: bool = False) -> Dict:
+    """
+    Decode the JSON timeseries response whose body is read in `chunks`.
+    """
+    parser = TimeseriesParser(columns)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.finish()
@@ -162,6 +162,14 @@ class ScalarSource(Source):
     def edge_id(self) -> str:
         return self._get_info().get('edge_id')
 
+    @property
+    def property_types(self) -> Dict[str, str]:
+        """
+        JSON schema types of the controlled properties, as declared by the
+        schema of the entity type.
+        """
+        return self.client.get_property_types(self.entity_category, self.entity_type)
+
     def __repr__(self) -> str:
         return repr({
             'tdmq_id ':               self.tdmq_id,
@@ -178,8 +186,21 @@ class ScalarSource(Source):
             'sensor_id':              self.sensor_id,
             })
 
-    def timeseries(self, after=None, before=None, bucket=None, op=None, properties=None):
-        return ScalarTimeSeries(self, after, before, bucket, op, properties)
+    def timeseries(self, after=None, before=None, bucket=None, op=None, properties=None, fill=None,
+                   lazy=False):
+        """
+        :param op: bucketing operation.  A list of operations, or a dict mapping
+                   properties to operations (e.g., {'temperature': ['min', 'max']}),
+                   computes them all in one query;  the resulting series are
+                   named 'property:op'.
+        :param fill: with `bucket`, also return empty buckets in [after, before).
+                     One of 'null', 'locf' (last observation carried forward)
+                     or 'linear' (interpolation).
+        :param lazy: fetch only the windows of the timeseries that are indexed
+                     (e.g., `ts[-100:]`), rather than the whole timeseries.
+                     Ignored with `bucket`.  See ScalarTimeSeries.
+        """
+        return ScalarTimeSeries(self, after, before, bucket, op, properties, fill, lazy)
 
     def _format_record(self, t, d, foot=None):
         record = {
@@ -191,21 +212,28 @@ class ScalarSource(Source):
             record['footprint'] = foot
         return record
 
-    def ingest_one(self, t, data, slot=None, footprint=None):
+    def ingest_one(self, t, data, slot=None, footprint=None, writer=None):
+        """
+        If `writer` (a tdmq.client.writer.BufferedWriter) is given, the record
+        is buffered in it rather than posted right away.
+        """
         if footprint is None:
             footprint_it = None
         else:
             footprint_it = [footprint]
-        self.ingest_many([t], [data], slot, footprint_it)
+        self.ingest_many([t], [data], slot, footprint_it, writer)
 
-    def ingest_many(self, times, data, initial_slot=None, footprint_iter=None):
+    def ingest_many(self, times, data, initial_slot=None, footprint_iter=None, writer=None):
         if initial_slot:
             raise TypeError("Can't specity a slot to ingest a scalar record")
         if footprint_iter is None:
             records = [ self._format_record(t, d) for t, d in zip(times, data) ]
         else:
             records = [ self._format_record(t, d, f) for t, d, f in zip(times, data, footprint_iter) ]
-        self.client.add_records(records)
+        if writer is not None:
+            writer.write_many(records)
+        else:
+            self.client.add_records(records)
 
 
 class NonScalarSource(Source):
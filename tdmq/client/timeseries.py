@@ -1,17 +1,111 @@
 import abc
+import bisect
 import collections.abc
+import logging
 import warnings
+from datetime import datetime, timedelta, timezone
+
 import numpy as np
 
+from tdmq.errors import UnsupportedFunctionality
+
+_logger = logging.getLogger(__name__)
+
+# Variable-width strings with None for nulls (numpy >= 2)
+_STRING_DTYPE = np.dtypes.StringDType(na_object=None) if hasattr(np, 'dtypes') and \
+    hasattr(np.dtypes, 'StringDType') else None
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_us(t) -> int:
+    """
+    Microseconds since the epoch of the datetime (or ISO string) `t`.
+    Naive datetimes are UTC.
+    """
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t.replace('Z', '+00:00'))
+    if not isinstance(t, datetime):
+        raise TypeError(f"Unsupported time {t!r}")
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return (t - _EPOCH) // timedelta(microseconds=1)
+
+
+def _to_datetime(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def decode_column(values, declared_type: str = None):
+    """
+    Convert the `values` of a timeseries field (a list, or an array) to a
+    typed numpy array, with a single vectorized conversion:
+
+      * numbers:  float64, with NaN for nulls (as in the Arrow format);
+      * booleans without nulls:  bool;
+      * strings:  numpy's StringDType, with None for nulls, where available;
+      * anything else:  object.
+
+    `declared_type` is the JSON schema type declared for the property, if
+    any:  declared numbers are converted directly, without looking at the
+    values first.  Fields without any value become NoneArrays.  The result
+    is always one-dimensional:  array-valued properties become object arrays
+    of lists.
+    """
+    if isinstance(values, NoneArray):
+        return values
+    if isinstance(values, np.ndarray) and values.ndim > 1:
+        return _object_array(values.tolist())
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind in 'iu':
+            return values.astype(np.float64)
+        if values.dtype.kind == 'U' and _STRING_DTYPE is not None:
+            return values.astype(_STRING_DTYPE)
+        if values.dtype.kind != 'O':
+            return values
+        n_nulls = int(np.count_nonzero(np.equal(values, None)))
+    else:
+        n_nulls = values.count(None)
+    if n_nulls == len(values):
+        return NoneArray(len(values))
+
+    if declared_type in ('number', 'integer'):
+        try:
+            array = np.array(values, dtype=np.float64)
+            if array.ndim == 1:
+                return array
+        except (TypeError, ValueError):
+            pass  # not numbers, after all
+    types = set(map(type, values))
+    types.discard(type(None))
+    if types <= {int, float}:
+        return np.array(values, dtype=np.float64)
+    if types == {bool} and n_nulls == 0:
+        return np.array(values, dtype=np.bool_)
+    if types == {str} and _STRING_DTYPE is not None:
+        return np.array(values, dtype=_STRING_DTYPE)
+    if isinstance(values, np.ndarray):
+        return values
+    return _object_array(values)
+
+
+def _object_array(values):
+    # np.array would turn a column of equal-length lists into a 2-D array
+    array = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    return array
+
 
 class TimeSeries(abc.ABC):
 
-    def __init__(self, source, after, before, bucket, op, properties=None):
+    def __init__(self, source, after, before, bucket, op, properties=None, fill=None):
         self._source = source
         self._after = after
         self._before = before
         self._bucket = bucket
         self._op = op
+        self._fill = fill
         self._time = None
         if isinstance(properties, str):
             self._properties = [properties]
@@ -38,16 +132,46 @@ class TimeSeries(abc.ABC):
     def op(self):
         return self._op
 
+    @property
+    def fill(self):
+        return self._fill
+
     @property
     def properties(self):
         return self._properties
 
     @property
     def time(self):
+        """
+        numpy.datetime64[us] array with the (UTC) timestamps of the series.
+        """
         self._ensure_fetched()
         return self._time
 
-    def _fetch_ts_and_set_time(self, sparse: bool = None):
+    def _query_args(self):
+        """
+        Arguments for the timeseries query.  `op` can be a single operation, a
+        list of operations to be applied to all the properties, or a dict
+        mapping each property to an operation or a list of operations.
+        """
+        args = {'after': self.after, 'before': self.before,
+                'bucket': self.bucket, 'fill': self.fill}
+
+        if isinstance(self.op, dict):
+            args['ops'] = ','.join(
+                f"{prop}:{op}"
+                for prop, ops in self.op.items()
+                for op in ([ops] if isinstance(ops, str) else ops))
+        else:
+            if self.op is not None and not isinstance(self.op, str):
+                args['op'] = ','.join(self.op)
+            else:
+                args['op'] = self.op
+            if self.properties:
+                args['fields'] = ','.join(self.properties)
+        return args
+
+    def _fetch_ts_and_set_time(self, sparse: bool = None, orient: str = None):
         """
         Fetch timeseries from tdmq web service and set the self.time array; returns tdmq
         timeseries data.
@@ -61,27 +185,53 @@ class TimeSeries(abc.ABC):
 
         :returns: dict mapping:  controlledProperty -> list
         """
+        res = self.source.get_timeseries(self._fetch_args(orient), sparse)
+        return self._set_time_from_response(res)
+
+    def _fetch_args(self, orient: str = None):
+        """
+        Query arguments to fetch the JSON timeseries.
+        """
         if not self.source.is_stationary:
             warnings.warn("Mobile data sources aren't implemented in the Client")
 
-        args = {'after': self.after, 'before': self.before,
-                'bucket': self.bucket, 'op': self.op}
+        args = self._query_args()
+        args['time_format'] = 'epoch_us'
+        if orient:
+            args['orient'] = orient
+        return args
 
-        if self.properties:
-            args['fields'] = ','.join(self.properties)
-
-        res = self.source.get_timeseries(args, sparse)
-        # pylint: disable=protected-access
+    def _set_time_from_response(self, res):
+        """
+        Set the self.time array from the JSON timeseries response `res`.
+        Returns `res`.
+        """
         assert res['fields'][0] == 'time'
-        if res['sparse']:
-            timestamps = (row['time'] for row in res['items'])
+        if res.get('orient') == 'columns':
+            timestamps = res['items']['time']
+        elif res['sparse']:
+            timestamps = [row['time'] for row in res['items']]
         else:
-            timestamps = (row[0] for row in res['items'])
+            timestamps = [row[0] for row in res['items']]
 
-        self._time = np.array([self.source.client._parse_timestamp(t) for t in timestamps])
+        self._time = self._to_datetime64(timestamps, res.get('time_format', 'epoch'))
 
         return res
 
+    @staticmethod
+    def _to_datetime64(timestamps, time_format: str) -> np.ndarray:
+        """
+        Convert the timestamps of a timeseries response to a datetime64[us]
+        array.  Services that don't support `time_format` send seconds since
+        the epoch.
+        """
+        if time_format == 'epoch_us':
+            return np.asarray(timestamps, dtype=np.int64).view('datetime64[us]')
+        if time_format == 'epoch_ms':
+            return np.asarray(timestamps, dtype=np.int64).astype('datetime64[ms]').astype('datetime64[us]')
+        seconds = np.asarray(timestamps, dtype=np.float64)
+        return np.round(seconds * 1_000_000).astype(np.int64).astype('datetime64[us]')
+
     def _ensure_fetched(self):
         if self._time is None:
             self._fetch()
@@ -175,11 +325,39 @@ class ScalarTimeSeries(TimeSeries):
     """
     To the attributes defined by TimeSeries, this class adds self.series
     which contains a dict mapping property names to np_arrays of scalar data.
+
+    A `lazy` timeseries doesn't download the whole [after, before) interval
+    up front.  `len()` only fetches the summary of the interval (number of
+    records, first and last time), and then `before` is frozen just after
+    the last record, so that the positions of the records don't change as
+    new ones arrive.  Indexing with integers and slices fetches only the
+    window of time holding the selected records:  the window bounds are
+    found by an interpolation search on the number of records before a
+    time, which the service counts cheaply (`Client.get_timeseries_summary`).
+    The fetched windows are kept, and reused by the slices that fall inside
+    them.  Accessing `time` or `series` fetches the whole timeseries, as
+    usual.  Bucketed timeseries are never lazy, since the summary counts
+    records, not buckets.
     """
 
-    def __init__(self, source, after, before, bucket, op, properties=None):
+    # Rows that a window may hold beyond the requested ones, at least
+    MIN_WINDOW_MARGIN = 256
+    # Maximum number of summary requests to locate a window bound
+    MAX_SEARCH_STEPS = 24
+
+    def __init__(self, source, after, before, bucket, op, properties=None, fill=None, lazy=False):
         self._series = None
-        super().__init__(source, after, before, bucket, op, properties)
+        super().__init__(source, after, before, bucket, op, properties, fill)
+        self._lazy = lazy and not bucket
+        self._count = None
+        # known (time in us, number of records before it) points, sorted
+        self._marks = None
+        # fetched windows:  (first row, time, series)
+        self._windows = []
+
+    @property
+    def lazy(self):
+        return self._lazy
 
     @property
     def series(self):
@@ -191,12 +369,79 @@ class ScalarTimeSeries(TimeSeries):
             self._fetch()
 
     def _fetch(self):
-        api_response = self._fetch_ts_and_set_time()
-        if api_response['sparse']:
+        cache = self.source.client.timeseries_disk_cache
+        if cache is not None and cache.applies(self):
+            self._time, self._series = cache.fetch(self)
+            return
+        self._fetch_remote()
+
+    def _fetch_remote(self):
+        client = self.source.client
+        if client.use_arrow:
+            try:
+                self._fetch_arrow()
+                return
+            except UnsupportedFunctionality:
+                _logger.info("The service does not support the Arrow format.  Falling back to JSON")
+                client.use_arrow = False
+
+        # Services that don't support the columnar layout ignore `orient`
+        self._load_response(self._fetch_ts_and_set_time(orient='columns'))
+
+    def _load_response(self, api_response):
+        """
+        Set the series from the JSON timeseries response.  The time must
+        already be set (see `_set_time_from_response`).
+        """
+        if api_response.get('orient') == 'columns':
+            self._parse_columns_response(api_response)
+        elif api_response['sparse']:
             self._parse_sparse_response(api_response)
         else:
             self._parse_dense_response(api_response)
 
+    def _fetch_arrow(self):
+        """
+        Fetch the timeseries in the Arrow format.  Numeric series without
+        missing values are used without copying;  missing values in numeric
+        series are represented as NaN.
+        """
+        if not self.source.is_stationary:
+            warnings.warn("Mobile data sources aren't implemented in the Client")
+
+        _, table = self.source.client.get_timeseries_arrow(self.source.tdmq_id, self._query_args())
+        self._load_arrow_table(table)
+
+    def _load_arrow_table(self, table):
+        self._time = table.column('time').to_numpy().astype('datetime64[us]')
+        self._series = dict()
+        for name in table.column_names[2:]:
+            column = table.column(name)
+            if column.null_count == len(column):
+                self._series[name] = NoneArray(len(column))
+            else:
+                self._series[name] = decode_column(column.to_numpy(), self._declared_type(name))
+
+    def _declared_type(self, field: str) -> str:
+        """
+        JSON schema type of `field`, as declared by the schema of the entity
+        type of the source and the bucketing operation.
+        """
+        prop, _, op = field.partition(':')
+        if not op and isinstance(self.op, str):
+            op = self.op
+        if op in ('count_records', 'count_values'):
+            return 'integer'
+        if op == 'string_agg':
+            return 'string'
+        return self.source.property_types.get(prop)
+
+    def _parse_columns_response(self, api_response):
+        assert api_response.get('orient') == 'columns'
+        self._series = {
+            f: decode_column(api_response['items'][f], self._declared_type(f))
+            for f in api_response['fields'][2:] }
+
     def _parse_sparse_response(self, api_response):
         assert api_response['sparse']
         # Sparse representation is a list of dictionaries.  In each dictionary,
@@ -208,12 +453,7 @@ class ScalarTimeSeries(TimeSeries):
             # server side, it was not sent -- so we cannot assume that the key
             # will be in the dict.
             field_data = [row.get(f) for row in api_response['items']]
-            # If all values are None, replace the array with a NoneArray;
-            # else we store the data in a numpy array.
-            if all(x is None for x in field_data):
-                self._series[f] = NoneArray(len(field_data))
-            else:
-                self._series[f] = np.array(field_data)
+            self._series[f] = decode_column(field_data, self._declared_type(f))
 
     def _parse_dense_response(self, api_response):
         assert not api_response['sparse']
@@ -221,33 +461,158 @@ class ScalarTimeSeries(TimeSeries):
         if len(api_response['items']) > 0:
             transpose = list(zip(*api_response['items']))
         else:
-            transpose = [[]] * len(api_response['fields'])
+            transpose = [()] * len(api_response['fields'])
 
         self._series = dict()
         # iterate over fields, except for 'time' and 'footprint' (the first two)
         for idx in range(2, len(api_response['fields'])):
             field_name = api_response['fields'][idx]
-            if all(x is None for x in transpose[idx]):
-                self._series[field_name] = NoneArray(len(transpose[idx]))
-            else:
-                self._series[field_name] = np.array(transpose[idx])
+            self._series[field_name] = decode_column(transpose[idx], self._declared_type(field_name))
 
     def get_item(self, args):
         assert len(args) == 1
+        if self._lazy and self._time is None and isinstance(args[0], (int, np.integer, slice)):
+            return self._get_lazy_item(args[0])
         return (self.time[args], dict((propname, self.series[propname][args]) for propname in self.series))
 
-    def export(self, stream, data_format: str = 'csv') -> None:
-        if data_format != 'csv':
-            raise NotImplementedError("only CSV export is supported")
-        args = {'after': self.after, 'before': self.before,
-                'bucket': self.bucket, 'op': self.op}
-        if self.properties:
-            args['fields'] = ','.join(self.properties)
-        args['format'] = 'csv'
+    def __len__(self):
+        if self._lazy and self._time is None:
+            return self._get_count()
+        return super().__len__()
+
+    # lazy access
+
+    def _get_count(self) -> int:
+        """
+        Fetch the summary of the timeseries, once, and freeze `before`.
+        """
+        if self._count is None:
+            summary = self.source.client.get_timeseries_summary(self.source.tdmq_id, self.after, self.before)
+            count = summary['count']
+            if count > 0:
+                start = _to_us(summary['first'] if self.after is None else self.after)
+                end = _to_us(summary['last']) + 1
+                self._before = self.source.client._format_timestamp(_to_datetime(end))  # pylint: disable=protected-access
+                self._marks = [(start, 0), (end, count)]
+                self._add_mark(_to_us(summary['first']), 0)
+            self._count = count
+        return self._count
+
+    def _count_between(self, start: int, end: int) -> int:
+        client = self.source.client
+        # pylint: disable=protected-access
+        return client.get_timeseries_summary(
+            self.source.tdmq_id,
+            client._format_timestamp(_to_datetime(start)),
+            client._format_timestamp(_to_datetime(end)))['count']
+
+    def _add_mark(self, t: int, c: int) -> None:
+        i = bisect.bisect_left(self._marks, (t, c))
+        if i == len(self._marks) or self._marks[i] != (t, c):
+            self._marks.insert(i, (t, c))
 
-        for chunk in self.source.client.export_timeseries(self.source.tdmq_id, args, data_format='csv'):
+    def _locate(self, k: int, margin: int, below: bool):
+        """
+        Find a time with a number of records c before it, such that
+        k - margin <= c <= k if `below`, else k <= c <= k + margin.  Returns
+        (time, c);  if the search doesn't converge, c is farther from k.
+        """
+        for step in range(self.MAX_SEARCH_STEPS):
+            counts = [ c for _, c in self._marks ]
+            if below:
+                lo = self._marks[bisect.bisect_right(counts, k) - 1]
+                if k - lo[1] <= margin:
+                    return lo
+                hi = self._marks[bisect.bisect_right(counts, k)]
+                target = k - margin // 2
+            else:
+                hi = self._marks[bisect.bisect_left(counts, k)]
+                if hi[1] - k <= margin:
+                    return hi
+                lo = self._marks[bisect.bisect_left(counts, k) - 1]
+                target = k + margin // 2
+            if hi[0] - lo[0] <= 1:
+                break
+            if step % 2 == 0:
+                t = lo[0] + (hi[0] - lo[0]) * (target - lo[1]) // (hi[1] - lo[1])
+            else:
+                t = (lo[0] + hi[0]) // 2
+            t = min(max(t, lo[0] + 1), hi[0] - 1)
+            # count the records on the shorter side
+            if t - lo[0] <= hi[0] - t:
+                c = lo[1] + self._count_between(lo[0], t)
+            else:
+                c = hi[1] - self._count_between(t, hi[0])
+            self._add_mark(t, c)
+        counts = [ c for _, c in self._marks ]
+        if below:
+            return self._marks[bisect.bisect_right(counts, k) - 1]
+        return self._marks[bisect.bisect_left(counts, k)]
+
+    def _get_window(self, start: int, stop: int):
+        """
+        Return a fetched window holding the rows in [start, stop), fetching
+        it if needed.
+        """
+        for window in self._windows:
+            if window[0] <= start and window[0] + len(window[1]) >= stop:
+                return window
+        margin = max(self.MIN_WINDOW_MARGIN, (stop - start) // 2)
+        t_start, c_start = self._locate(start, margin, below=True)
+        t_stop, _ = self._locate(stop, margin, below=False)
+        client = self.source.client
+        # pylint: disable=protected-access
+        part = ScalarTimeSeries(
+            self.source,
+            client._format_timestamp(_to_datetime(t_start)),
+            client._format_timestamp(_to_datetime(t_stop)),
+            None, self.op, self.properties)
+        part._fetch()
+        _logger.debug("Fetched rows [%s, %s) of %s", c_start, c_start + len(part._time), self.source.tdmq_id)
+        window = (c_start, part._time, part._series)
+        self._windows.append(window)
+        return window
+
+    def _get_lazy_item(self, index):
+        n = self._get_count()
+        if isinstance(index, slice):
+            rows = range(*index.indices(n))
+            if len(rows) > 0:
+                start, stop = min(rows[0], rows[-1]), max(rows[0], rows[-1]) + 1
+            else:
+                start = stop = min(rows.start, n)
+            if n == 0:
+                return self.time[index], dict((p, v[index]) for p, v in self.series.items())
+            first, time, series = self._get_window(start, stop)
+            local_stop = rows.stop - first
+            local = slice(rows.start - first, local_stop if local_stop >= 0 else None, rows.step)
+        else:
+            if not -n <= index < n:
+                raise IndexError(f"index {index} is out of bounds for timeseries with size {n}")
+            index = int(index) % n
+            first, time, series = self._get_window(index, index + 1)
+            local = index - first
+        return (time[local], dict((propname, values[local]) for propname, values in series.items()))
+
+    def export(self, stream, data_format: str = 'csv') -> None:
+        """
+        Write the timeseries to the binary `stream` in `data_format`
+        ('csv' or 'parquet').
+        """
+        args = self._query_args()
+        for chunk in self.source.client.export_timeseries(self.source.tdmq_id, args, data_format=data_format):
             stream.write(chunk)
 
+    def export_to_file(self, path: str, data_format: str = None) -> None:
+        """
+        Write the timeseries to the file `path`.  If `data_format` is not
+        specified, it is taken from the file extension (.csv or .parquet).
+        """
+        if data_format is None:
+            data_format = 'parquet' if path.endswith('.parquet') else 'csv'
+        with open(path, 'wb') as f:
+            self.export(f, data_format)
+
 
 class NonScalarTimeSeries(TimeSeries):
     def __init__(self, source, after, before, bucket, op):
@@ -267,7 +632,9 @@ class NonScalarTimeSeries(TimeSeries):
 
     def _fetch(self):
         # NonScalarTimeSeries ignores any properties specified.  It only considers tiledb_index
-        api_response = self._fetch_ts_and_set_time(sparse=False)
+        self._load_response(self._fetch_ts_and_set_time(sparse=False))
+
+    def _load_response(self, api_response):
         assert api_response['fields'][2] == 'tiledb_index'
         self._tiledb_indices = [row[2] for row in api_response['items']]
 
@@ -0,0 +1,203 @@
+"""
+Buffered ingestion of records.
+
+`Source.ingest_one` and `ingest_many` post their records right away:  a
+gateway that ingests every reading as it arrives makes one HTTP request per
+reading.  A `BufferedWriter` collects the records of any number of sources
+and posts them together, from a background thread, as soon as one of these
+thresholds is reached:
+
+  * `max_records` records are buffered;
+  * the buffered records take `max_bytes` bytes (JSON-encoded);
+  * the oldest buffered record has waited `max_delay` seconds.
+
+Failed posts are retried with exponential backoff, up to `max_retries`
+times, if the failure is transient (connection errors, timeouts and 5xx
+responses).  Since a post may fail after the service has loaded its
+records, use `on_conflict='ignore'` (which needs the unique index on the
+records on the service) to avoid storing them twice.  Records that can't be
+posted are handed to the `on_error(records, exception)` callback, or
+logged.
+
+If the service can't keep up, at most `max_buffered` records are buffered:
+then `write` blocks until there's room, or raises BufferFullError if the
+writer was created with `block=False`.
+
+The writer is flushed and closed on `close`, at the end of a `with` block,
+or when the interpreter exits.
+"""
+
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List
+
+import requests
+
+import tdmq.errors
+
+_logger = logging.getLogger(__name__)
+
+
+class BufferFullError(tdmq.errors.TdmqError):
+    def __init__(self, msg: str = None):
+        super().__init__("Write buffer full", 503, msg)
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(e, tdmq.errors.TdmqError) and e.status >= 500 and \
+        not isinstance(e, tdmq.errors.UnsupportedFunctionality)
+
+
+class BufferedWriter:
+    def __init__(self, client, max_records: int = 1000, max_bytes: int = 1024 * 1024,
+                 max_delay: float = 1.0, max_buffered: int = 100000, block: bool = True,
+                 max_retries: int = 5, backoff: float = 0.5, on_conflict: str = None,
+                 on_error: Callable[[List[Dict], Exception], None] = None):
+        if max_records <= 0 or max_buffered < max_records:
+            raise ValueError("max_records must be > 0 and <= max_buffered")
+        self.client = client
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.block = block
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_conflict = on_conflict
+        self.on_error = on_error
+
+        # buffered (record, size in bytes, time it was written)
+        self._buffer = deque()
+        self._buffer_bytes = 0
+        self._in_flight = 0
+        self._closed = False
+        self._flush_requested = False
+        self._cond = threading.Condition()
+        self.records_posted = 0
+        self.records_failed = 0
+
+        self._thread = threading.Thread(target=self._run, name='tdmq-buffered-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of records written but not yet posted.
+        """
+        with self._cond:
+            return len(self._buffer) + self._in_flight
+
+    def write(self, record: Dict) -> None:
+        self.write_many([record])
+
+    def write_many(self, records: Iterable[Dict]) -> None:
+        with self._cond:
+            for record in records:
+                if self._closed:
+                    raise RuntimeError("Writing to a closed BufferedWriter")
+                while len(self._buffer) + self._in_flight >= self.max_buffered:
+                    if not self.block:
+                        raise BufferFullError(f"{self.max_buffered} records waiting to be posted")
+                    self._cond.wait()
+                size = len(json.dumps(record))
+                self._buffer.append((record, size, time.monotonic()))
+                self._buffer_bytes += size
+                # wake up the thread to start the max_delay timer, or to post
+                if len(self._buffer) == 1 or \
+                   len(self._buffer) >= self.max_records or self._buffer_bytes >= self.max_bytes:
+                    self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Post the buffered records and wait until they have been posted (or
+        have failed).  Returns False if `timeout` expires first.
+        """
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            done = self._cond.wait_for(lambda: not self._buffer and self._in_flight == 0, timeout)
+            self._flush_requested = False
+            return done
+
+    def close(self) -> None:
+        """
+        Flush the writer and stop its thread.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _ready(self) -> bool:
+        if not self._buffer:
+            return False
+        return self._closed or self._flush_requested or \
+            len(self._buffer) >= self.max_records or self._buffer_bytes >= self.max_bytes or \
+            time.monotonic() - self._buffer[0][2] >= self.max_delay
+
+    def _take_batch(self) -> List[Dict]:
+        batch, size = [], 0
+        while self._buffer and len(batch) < self.max_records and \
+                (not batch or size + self._buffer[0][1] <= self.max_bytes):
+            record, record_size, _ = self._buffer.popleft()
+            batch.append(record)
+            size += record_size
+        self._buffer_bytes -= size
+        self._in_flight = len(batch)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if self._closed and not self._buffer:
+                        return
+                    timeout = self.max_delay - (time.monotonic() - self._buffer[0][2]) if self._buffer else None
+                    self._cond.wait(timeout)
+                batch = self._take_batch()
+            try:
+                self._post(batch)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+
+    def _post(self, batch: List[Dict]) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.client.add_records(batch, on_conflict=self.on_conflict)
+                self.records_posted += len(batch)
+                _logger.debug("BufferedWriter: posted %s records", len(batch))
+                return
+            except Exception as e:  # pylint: disable=broad-except
+                if attempt < self.max_retries and _is_transient(e):
+                    delay = self.backoff * 2 ** attempt
+                    _logger.warning("BufferedWriter: posting %s records failed (%s).  Retrying in %s s",
+                                    len(batch), e, delay)
+                    time.sleep(delay)
+                    continue
+                self.records_failed += len(batch)
+                if self.on_error is None:
+                    _logger.error("BufferedWriter: dropping %s records that could not be posted: %s", len(batch), e)
+                    return
+                try:
+                    self.on_error(batch, e)
+                except Exception:  # pylint: disable=broad-except
+                    _logger.exception("BufferedWriter: on_error callback failed")
+                return
@@ -0,0 +1,166 @@
+"""
+Transposition of row batches into JSON arrays, one per column, in bounded
+memory.
+
+Columnar JSON layouts can only be written once all the rows have been read:
+the second column can't start before the first one is complete.  The
+`ColumnSpool` encodes each batch of rows as it arrives, appending the values
+of each column to the column's own temporary file.  The files share a single
+in-memory budget of `max_size` bytes:  when it's exceeded, the largest
+columns are moved to disk.  The columns are then read back one at a time.
+
+The first column of a layout doesn't need to be spooled:  it's streamed as
+the rows are read (see `generate_json_object`), so the response starts
+with the first batch.
+"""
+
+import json
+import logging
+import tempfile
+from typing import Iterable, Iterator, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+# The spooled columns are kept in memory up to this total size (in bytes),
+# then on disk
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ColumnSpool:
+    def __init__(self, n_columns: int, max_size: int = SPOOL_MAX_SIZE):
+        # max_size=0:  the files are only moved to disk by _enforce_budget
+        self._files = [ tempfile.SpooledTemporaryFile(max_size=0) for _ in range(n_columns) ]
+        self._sizes = [0] * n_columns
+        self._on_disk = [False] * n_columns
+        self._max_size = max_size
+        self._streamed = None
+        self._all_null = [True] * n_columns
+        self._n_rows = 0
+
+    @property
+    def n_rows(self) -> int:
+        return self._n_rows
+
+    @property
+    def in_memory_size(self) -> int:
+        """
+        Size (in bytes) of the columns kept in memory.
+        """
+        return sum(size for size, on_disk in zip(self._sizes, self._on_disk) if not on_disk)
+
+    def all_null(self, column: int) -> bool:
+        """
+        True if all the values in `column` are null (or there are no rows).
+        """
+        return self._all_null[column]
+
+    def _encode(self, values) -> bytes:
+        encoded = json.dumps(values)[1:-1]
+        if self._n_rows > 0:
+            encoded = ',' + encoded
+        return encoded.encode('utf-8')
+
+    def _enforce_budget(self) -> None:
+        in_memory = self.in_memory_size
+        while in_memory > self._max_size:
+            column = max((i for i, on_disk in enumerate(self._on_disk) if not on_disk),
+                         key=self._sizes.__getitem__)
+            logger.debug("ColumnSpool: moving column %s (%s bytes) to disk", column, self._sizes[column])
+            self._files[column].rollover()
+            self._on_disk[column] = True
+            in_memory -= self._sizes[column]
+
+    def _add_rows(self, rows: Sequence[Sequence]) -> bytes:
+        """
+        Spool `rows`, except for the streamed column.  Returns the encoded
+        values of the streamed column, if any.
+        """
+        streamed = b''
+        for i, values in enumerate(zip(*rows)):
+            if self._all_null[i] and any(v is not None for v in values):
+                self._all_null[i] = False
+            encoded = self._encode(values)
+            if i == self._streamed:
+                streamed = encoded
+            else:
+                self._files[i].write(encoded)
+                self._sizes[i] += len(encoded)
+        self._n_rows += len(rows)
+        self._enforce_budget()
+        return streamed
+
+    def add_rows(self, rows: Sequence[Sequence]) -> None:
+        if rows:
+            self._add_rows(rows)
+
+    def add_batches(self, batches: Iterable[Sequence[Sequence]]) -> None:
+        for batch in batches:
+            self.add_rows(batch)
+        logger.debug("ColumnSpool: %s rows spooled", self._n_rows)
+
+    def stream_column(self, batches: Iterable[Sequence[Sequence]], column: int) -> Iterator[bytes]:
+        """
+        Generator of the chunks of the JSON array of `column`, produced as
+        the rows of `batches` are read.  The other columns are spooled.
+        """
+        self._streamed = column
+        yield b'['
+        for batch in batches:
+            if batch:
+                yield self._add_rows(batch)
+        yield b']'
+        logger.debug("ColumnSpool: %s rows streamed and spooled", self._n_rows)
+
+    def column_chunks(self, column: int) -> Iterator[bytes]:
+        """
+        Generator of the chunks of the JSON array of `column`.
+        """
+        assert column != self._streamed
+        f = self._files[column]
+        f.seek(0)
+        yield b'['
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield b']'
+
+    def close(self) -> None:
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def generate_json_object(names: List[str], spool: ColumnSpool, columns: Sequence[int] = None,
+                         batches: Iterable[Sequence[Sequence]] = None,
+                         null_if_all_null: bool = False) -> Iterator[bytes]:
+    """
+    Generator of the JSON object mapping each of `names` to the array of a
+    column of `spool`:  the i-th name maps to column `columns[i]` (by
+    default, column i).
+
+    If `batches` is given, the first column is streamed while they are read
+    into the spool (see ColumnSpool.stream_column).  With `null_if_all_null`,
+    the other columns without any value are represented by null instead of
+    an array, unless there are no rows.
+    """
+    if columns is None:
+        columns = range(len(names))
+    yield b'{'
+    for i, (name, column) in enumerate(zip(names, columns)):
+        yield (',' if i > 0 else '').encode('utf-8') + json.dumps(name).encode('utf-8') + b':'
+        if i == 0 and batches is not None:
+            yield from spool.stream_column(batches, column)
+        elif null_if_all_null and spool.n_rows > 0 and spool.all_null(column):
+            yield b'null'
+        else:
+            yield from spool.column_chunks(column)
+    yield b'}'
@@ -0,0 +1,172 @@
+"""
+HTTP response compression, negotiated per request through Accept-Encoding.
+
+Supported encodings are gzip (always available), zstd (requires the
+zstandard package) and br (requires the brotli package).  Streamed
+responses are compressed chunk by chunk:  the compressor is flushed at
+chunk boundaries -- i.e., once per batch of rows for the timeseries
+generators -- so that the client can decode each batch as soon as it
+arrives.  Tiny chunks (e.g., separators) are coalesced with the following
+ones.
+"""
+
+import logging
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Server preference among encodings accepted with the same quality
+_PREFERENCE = ('zstd', 'br', 'gzip')
+
+# Don't flush the compressor before at least this much data has been fed
+MIN_FLUSH_SIZE = 4096
+
+
+def available_encodings() -> List[str]:
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def _parse_accept_encoding(header: str) -> Dict[str, float]:
+    accepted = dict()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def negotiate(accept_encoding: str, enabled: Iterable[str]) -> Optional[str]:
+    """
+    Choose the content encoding for a response, given the Accept-Encoding
+    header of the request and the encodings enabled on the server.
+    Returns None if the response should not be compressed.
+    """
+    if not accept_encoding:
+        return None
+    accepted = _parse_accept_encoding(accept_encoding)
+    default_q = accepted.get('*', 0.0)
+    candidates = [ e for e in _PREFERENCE if e in enabled and e in available_encodings() ]
+    best, best_q = None, 0.0
+    for encoding in candidates:
+        q = accepted.get(encoding, default_q)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.compress(data)
+
+    def flush(self) -> bytes:
+        return self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._c.flush(zlib.Z_FINISH)
+
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        self._c = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.compress(data)
+
+    def flush(self) -> bytes:
+        return self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._c.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self, level: int):
+        self._c = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.process(data)
+
+    def flush(self) -> bytes:
+        return self._c.flush()
+
+    def finish(self) -> bytes:
+        return self._c.finish()
+
+
+_COMPRESSORS = {
+    'gzip': _GzipCompressor,
+    'zstd': _ZstdCompressor,
+    'br': _BrotliCompressor,
+}
+
+
+def _to_bytes(chunk) -> bytes:
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+def read_prefix(chunks: Iterable, min_size: int) -> Tuple[List[bytes], Optional[Iterator]]:
+    """
+    Read chunks from `chunks` until at least `min_size` bytes have been read.
+
+    :returns: (chunks read, iterator over the remaining chunks).  The iterator
+              is None if the stream ended before reaching `min_size` bytes.
+    """
+    it = iter(chunks)
+    prefix, size = [], 0
+    while size < min_size:
+        chunk = next(it, None)
+        if chunk is None:
+            return prefix, None
+        chunk = _to_bytes(chunk)
+        prefix.append(chunk)
+        size += len(chunk)
+    return prefix, it
+
+
+def compress_chunks(chunks: Iterable, encoding: str, level: int) -> Iterator[bytes]:
+    """
+    Generator that compresses the `chunks` (str or bytes) with `encoding`,
+    flushing the compressor at chunk boundaries once at least MIN_FLUSH_SIZE
+    bytes are pending.
+    """
+    compressor = _COMPRESSORS[encoding](level)
+    pending = 0
+    for chunk in chunks:
+        chunk = _to_bytes(chunk)
+        out = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= MIN_FLUSH_SIZE:
+            out += compressor.flush()
+            pending = 0
+        if out:
+            yield out
+    yield compressor.finish()
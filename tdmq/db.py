@@ -1,7 +1,10 @@
 
+import itertools
 import json
 import logging
+import re
 import uuid
+from decimal import Decimal
 from typing import Any, Dict, Iterator, List, Tuple
 
 import psycopg2.extras
@@ -10,6 +13,7 @@ from psycopg2.sql import SQL
 
 import tdmq.db_manager
 import tdmq.errors
+from tdmq.result_cache import result_cache
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +31,22 @@ def _compute_tdmq_id(external_id):
     return uuid.uuid5(NAMESPACE_TDMQ, external_id)
 
 
+def get_db_settings(config):
+    """
+    Connection parameters of the application's configured database.
+    """
+    query_timeout = config.get('DB_MAX_QUERY_TIME', 50000)
+    logger.info("Setting database query timeout to %s", query_timeout)
+    return {
+        'user': config['DB_USER'],
+        'password': config['DB_PASSWORD'],
+        'host': config['DB_HOST'],
+        'dbname': config['DB_NAME'],
+        # abort queries after query_timeout milliseconds
+        'options': f'-c statement_timeout={query_timeout}'
+    }
+
+
 def get_db():
     """
     Requires active application context.
@@ -42,16 +62,7 @@ def get_db():
 
     if not _db_connection:
         import flask
-        query_timeout = flask.current_app.config.get('DB_MAX_QUERY_TIME', 50000)
-        logger.info("Setting database query timeout to %s", query_timeout)
-        db_settings = {
-            'user': flask.current_app.config['DB_USER'],
-            'password': flask.current_app.config['DB_PASSWORD'],
-            'host': flask.current_app.config['DB_HOST'],
-            'dbname': flask.current_app.config['DB_NAME'],
-            # abort queries after query_timeout milliseconds
-            'options': f'-c statement_timeout={query_timeout}'
-        }
+        db_settings = get_db_settings(flask.current_app.config)
         logger.info("Creating DB connection")
         _db_connection = tdmq.db_manager.db_connect(db_settings)
     return _db_connection
@@ -84,11 +95,18 @@ def query_db_all(q, args=(), fetch=True, one=False, cursor_factory=None):
     return result
 
 
-def query_db_batches(q, args=(), batch_size: int = 2500, cursor_factory=None):
+def query_db_batches(q, args=(), batch_size: int = 2500, cursor_factory=None, server_side: bool = False):
+    """
+    Yields the rows of the result of `q` in lists of up to `batch_size`.
+    With `server_side`, the rows are read through a server-side cursor, so
+    each batch is fetched from the database as it's consumed, rather than
+    receiving the whole result first.
+    """
     assert batch_size > 0
     logger.debug("executing batch query with batch_size %s", batch_size)
     with get_db() as db:
-        with db.cursor(cursor_factory=cursor_factory) as cur:
+        cursor_name = 'batch_cursor' if server_side else None
+        with db.cursor(cursor_name, cursor_factory=cursor_factory) as cur:
             cur.execute(q, tuple(args))
             while True:
                 batch = cur.fetchmany(batch_size)
@@ -282,6 +300,57 @@ def list_entity_types(category_start=None, type_start=None):
     return query_db_all(q, cursor_factory=psycopg2.extras.RealDictCursor)
 
 
+def _query_in_transaction(q, args=()):
+    """
+    Like query_db_all, but if a transaction is in progress on the connection
+    the query joins it, without committing it.
+    """
+    conn = get_db()
+    in_transaction = conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    with conn.cursor() as cur:
+        cur.execute(q, tuple(args))
+        result = cur.fetchall()
+    if not in_transaction:
+        conn.commit()
+    return result
+
+
+def get_entity_type_schemas():
+    """
+    Get the (entity_category, entity_type, schema) of all the entity types.
+    Doesn't commit the transaction in progress, if any.
+    """
+    q = sql.SQL("SELECT entity_category, entity_type, schema FROM entity_type")
+    return _query_in_transaction(q)
+
+
+def get_source_entity_types(tdmq_ids, external_ids):
+    """
+    Get the (tdmq_id, external_id, entity_category, entity_type) of the
+    sources with tdmq_id in `tdmq_ids` or external_id in `external_ids`.
+    Doesn't commit the transaction in progress, if any.
+    """
+    q = sql.SQL("""
+        SELECT tdmq_id, external_id, entity_category, entity_type
+        FROM source
+        WHERE tdmq_id = ANY(%s::uuid[]) OR external_id = ANY(%s)""")
+    return _query_in_transaction(q, args=(list(tdmq_ids), list(external_ids)))
+
+
+def get_source_entity_type_schema(tdmq_id):
+    """
+    Get the schema of the entity type of source `tdmq_id`, or None if it
+    has none.
+    """
+    q = sql.SQL("""
+        SELECT entity_type.schema
+        FROM source
+        JOIN entity_type USING (entity_category, entity_type)
+        WHERE source.tdmq_id = %s""")
+    row = query_db_all(q, args=(str(tdmq_id),), one=True)
+    return row[0] if row else None
+
+
 def dump_table(conn, tname, path, itersize=100000):
     query = sql.SQL('SELECT row_to_json({0}) from {0}').format(
         sql.Identifier(tname)
@@ -345,15 +414,19 @@ def load_sources_conn(conn, data, validate=False, chunk_size=500):
     return [t[0] for t in tuples]
 
 
-def load_records(records, validate=False, chunk_size=500):
-    return load_records_conn(get_db(), records, validate, chunk_size)
+def load_records(records, validate=False, chunk_size=500, on_conflict=None):
+    return load_records_conn(get_db(), records, validate, chunk_size, on_conflict)
 
 
-def load_records_conn(conn, records, validate=False, chunk_size=500):
+def load_records_conn(conn, records, validate=False, chunk_size=500, on_conflict=None):
     """
     Load records.
 
-    Return the number of loaded objects.
+    Return the number of loaded objects.  With `on_conflict` (see
+    ON_CONFLICT_MODES), records with the same source and time as an
+    existing record (or as another record of `records`) are skipped or
+    merged into it;  only the records inserted as new records are counted
+    as loaded.
 
     {"time": "2019-02-21T11:32:08Z",
      "source": "sensor_0",
@@ -366,38 +439,276 @@ def load_records_conn(conn, records, validate=False, chunk_size=500):
      "footprint": {"type": "Point", "coordinates": [9.222, 30.003]},
      "data": {"something": 42 }
     """
-    def get_required_internal_source_id_map(cursor, data):
-        external_ids = tuple(set(d['source'] for d in data if 'tdmq_id' not in d))
-        if external_ids:
-            #  If we get a lot of external_ids, using the IN clause might not be so efficient
-            q = "SELECT external_id, tdmq_id FROM source WHERE external_id IN %s"
-            cursor.execute(q, (external_ids,))
-            # The following `fetchall` and transforming the result to a dict is also at risk
-            # of explosion
-            map_external_to_tdm_id = dict(cur.fetchall())  # creates a mapping external_ids -> tdmq_id
-        else:
-            map_external_to_tdm_id = dict()
+    with conn:
+        with conn.cursor() as cur:
+            logger.debug('load_records: start loading %d records', len(records))
+            source_times, n_loaded = _insert_records(cur, records, chunk_size, on_conflict)
 
-        return map_external_to_tdm_id
+    if result_cache.enabled:
+        result_cache.invalidate(source_times)
 
-    def gen_record_tuple(d, id_to_tdmq_id):
-        s_time = d['time']
-        tdmq_id = d['tdmq_id'] if 'tdmq_id' in d else id_to_tdmq_id[d['source']]
-        footprint = json.dumps(d.get('footprint')) if d.get('footprint') else None
+    logger.debug('load_records: done.')
+    return n_loaded
 
-        return (s_time, tdmq_id, footprint, psycopg2.extras.Json(d['data']))
 
-    sql = "INSERT INTO record (time, source_id, footprint, data) VALUES %s"
-    template = "(%s, %s, ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326), 3003), %s)"
+def load_record_batches(batches, commit_each_batch=False, chunk_size=500, on_batch=None, on_conflict=None):
+    return load_record_batches_conn(get_db(), batches, commit_each_batch, chunk_size, on_batch, on_conflict)
+
+
+def load_record_batches_conn(conn, batches, commit_each_batch=False, chunk_size=500, on_batch=None,
+                             on_conflict=None, batch_on_conflict=None):
+    """
+    Load the records in `batches`, an iterable of lists of records (see
+    load_records_conn), consuming one batch at a time.
+
+    By default, all the batches are loaded in one transaction.  If
+    `commit_each_batch` is True, the transaction is committed after each
+    batch:  if a batch fails, the previous ones stay loaded.
+
+    `on_batch(n)` is called after each batch is loaded (and committed, if
+    `commit_each_batch`), with the number of records loaded from the batch.
+    `on_conflict` is as in load_records_conn;  `batch_on_conflict`, if
+    given, is an iterable of the `on_conflict` mode of each batch.
+
+    Returns the list of the number of records loaded from each batch.
+    """
+    counts = []
+    if batch_on_conflict is None:
+        batch_on_conflict = itertools.repeat(on_conflict)
+
+    def batch_loaded(n):
+        counts.append(n)
+        if on_batch is not None:
+            on_batch(n)
+
+    if commit_each_batch:
+        for batch, mode in zip(batches, batch_on_conflict):
+            with conn:
+                with conn.cursor() as cur:
+                    source_times, n_loaded = _insert_records(cur, batch, chunk_size, mode)
+            if result_cache.enabled:
+                result_cache.invalidate(source_times)
+            batch_loaded(n_loaded)
+    else:
+        time_ranges = dict()
+        with conn:
+            with conn.cursor() as cur:
+                for batch, mode in zip(batches, batch_on_conflict):
+                    source_times, n_loaded = _insert_records(cur, batch, chunk_size, mode)
+                    if result_cache.enabled:
+                        result_cache.time_ranges(source_times, time_ranges)
+                    batch_loaded(n_loaded)
+        if result_cache.enabled:
+            result_cache.invalidate_ranges(time_ranges)
+
+    logger.debug('load_record_batches: loaded %s records in %s batches', sum(counts), len(counts))
+    return counts
+
+
+def _get_required_internal_source_id_map(cursor, data):
+    external_ids = tuple(set(d['source'] for d in data if 'tdmq_id' not in d))
+    if external_ids:
+        #  If we get a lot of external_ids, using the IN clause might not be so efficient
+        q = "SELECT external_id, tdmq_id FROM source WHERE external_id IN %s"
+        cursor.execute(q, (external_ids,))
+        # The following `fetchall` and transforming the result to a dict is also at risk
+        # of explosion
+        map_external_to_tdm_id = dict(cursor.fetchall())  # creates a mapping external_ids -> tdmq_id
+    else:
+        map_external_to_tdm_id = dict()
+
+    return map_external_to_tdm_id
+
+
+def _gen_record_tuple(d, id_to_tdmq_id):
+    s_time = d['time']
+    tdmq_id = d['tdmq_id'] if 'tdmq_id' in d else id_to_tdmq_id[d['source']]
+    footprint = json.dumps(d.get('footprint')) if d.get('footprint') else None
+
+    return (s_time, tdmq_id, footprint, psycopg2.extras.Json(d['data']))
+
+
+# Ways to handle records with the same source and time as an existing
+# record.  They require the unique index on record (source_id, time), which
+# is opt-in:  see create_record_unique_index.
+#   ignore:  skip the new record;
+#   update:  merge the data of the new record into the existing one.
+ON_CONFLICT_MODES = {
+    'ignore': "ON CONFLICT (source_id, time) DO NOTHING",
+    'update': """ON CONFLICT (source_id, time) DO UPDATE
+                 SET data = record.data || EXCLUDED.data,
+                     footprint = COALESCE(EXCLUDED.footprint, record.footprint)""",
+}
+
+RECORD_UNIQUE_INDEX = 'record_source_id_time_key'
+
+# Plain index on record (source_id, time), created by the migrations
+RECORD_INDEX = 'record_source_id_time_idx'
+
+# Set once the unique index is found
+_record_unique_index_exists = False
+
+
+def has_record_unique_index(cursor) -> bool:
+    global _record_unique_index_exists
+    if not _record_unique_index_exists:
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE tablename = 'record' AND indexname = %s",
+                       (RECORD_UNIQUE_INDEX,))
+        _record_unique_index_exists = cursor.fetchone() is not None
+    return _record_unique_index_exists
+
+
+def _replace_record_index(cursor, new_index: str, unique: bool, old_index: str) -> None:
+    # The reorder policy of the record hypertable (see migration
+    # cc88f3768771) is bound to the index:  move it to the new one.
+    cursor.execute("SELECT remove_reorder_policy('record', if_exists => true)")
+    cursor.execute(sql.SQL("CREATE {} INDEX IF NOT EXISTS {} ON record (source_id, time DESC)").format(
+        sql.SQL("UNIQUE" if unique else ""), sql.Identifier(new_index)))
+    cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(old_index)))
+    cursor.execute("SELECT add_reorder_policy('record', %s)", (new_index,))
+
+
+def create_record_unique_index(conn, deduplicate=False) -> int:
+    """
+    Create the unique index on record (source_id, time), which replaces the
+    plain index on the same columns and enables the `on_conflict` modes of
+    load_records_conn.  Once it exists, records with the same source and
+    time as a stored record are rejected, unless `on_conflict` is used.
+
+    If `deduplicate`, the existing records with the same source and time
+    are first merged into one, the data of each being merged as in the
+    'update' mode (in no particular order).  Otherwise, the index can't be
+    created if there are such records.
+
+    Returns the number of records removed by the deduplication.
+    """
+    removed = 0
     with conn:
         with conn.cursor() as cur:
-            id_to_tdmq_id = get_required_internal_source_id_map(cur, records)
-            tuples = [gen_record_tuple(t, id_to_tdmq_id) for t in records]
-            logger.debug('load_records: start loading %d records', len(records))
-            psycopg2.extras.execute_values(cur, sql, tuples, template=template, page_size=chunk_size)
+            if deduplicate:
+                cur.execute("""
+                    CREATE TEMPORARY TABLE record_duplicates ON COMMIT DROP AS
+                    SELECT r.source_id, r.time,
+                           (array_agg(r.footprint) FILTER (WHERE r.footprint IS NOT NULL))[1] AS footprint,
+                           COALESCE(jsonb_object_agg(kv.key, kv.value) FILTER (WHERE kv.key IS NOT NULL),
+                                    '{}'::jsonb) AS data
+                    FROM (SELECT source_id, time FROM record GROUP BY source_id, time HAVING count(*) > 1) AS d
+                    JOIN record AS r ON r.source_id = d.source_id AND r.time = d.time
+                    LEFT JOIN LATERAL jsonb_each(r.data) AS kv ON TRUE
+                    GROUP BY r.source_id, r.time""")
+                cur.execute("""
+                    DELETE FROM record AS r USING record_duplicates AS d
+                    WHERE r.source_id = d.source_id AND r.time = d.time""")
+                removed = cur.rowcount
+                cur.execute("""
+                    INSERT INTO record (time, source_id, footprint, data)
+                    SELECT time, source_id, footprint, data FROM record_duplicates""")
+                removed -= cur.rowcount
+                logger.info("Merged %s duplicate records", removed)
+            _replace_record_index(cur, RECORD_UNIQUE_INDEX, True, RECORD_INDEX)
+    return removed
+
+
+def drop_record_unique_index(conn) -> None:
+    """
+    Replace the unique index on record (source_id, time) with the plain one,
+    disabling the `on_conflict` modes.
+    """
+    global _record_unique_index_exists
+    with conn:
+        with conn.cursor() as cur:
+            _replace_record_index(cur, RECORD_INDEX, False, RECORD_UNIQUE_INDEX)
+    _record_unique_index_exists = False
 
-    logger.debug('load_records: done.')
-    return len(records)
+
+def _merge_duplicate_tuples(tuples):
+    """
+    Merge the record tuples with the same source and time, as the 'update'
+    mode would:  a single INSERT can't update the same row twice.
+    """
+    merged = dict()
+    for t in tuples:
+        key = (str(t[1]), t[0])
+        prev = merged.get(key)
+        if prev is None:
+            merged[key] = t
+        else:
+            merged[key] = (t[0], t[1], t[2] or prev[2], psycopg2.extras.Json({**prev[3].adapted, **t[3].adapted}))
+    return list(merged.values())
+
+
+def _check_on_conflict(cursor, on_conflict) -> None:
+    if on_conflict not in ON_CONFLICT_MODES:
+        raise tdmq.errors.TdmqBadRequestException(f"Unknown/unsupported on_conflict mode {on_conflict}")
+    if not has_record_unique_index(cursor):
+        raise tdmq.errors.UnsupportedFunctionality(
+            "on_conflict requires the unique index on the records.  Create it with `flask db record-index`")
+
+
+def check_on_conflict(on_conflict) -> None:
+    """
+    Raise the error that loading records with `on_conflict` would raise, if
+    any.  Doesn't commit the transaction in progress, if any.
+    """
+    if on_conflict is None:
+        return
+    conn = get_db()
+    in_transaction = conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    with conn.cursor() as cur:
+        _check_on_conflict(cur, on_conflict)
+    if not in_transaction:
+        conn.commit()
+
+
+def _insert_records(cursor, records, chunk_size=500, on_conflict=None):
+    """
+    Insert `records` in the current transaction of `cursor` and update the
+    ingest log.  Returns the (tdmq_id, time) pairs of the records and the
+    number of records loaded (see load_records_conn for `on_conflict`).
+    """
+    sql = "INSERT INTO record (time, source_id, footprint, data) VALUES %s"
+    template = "(%s, %s, ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326), 3003), %s)"
+    id_to_tdmq_id = _get_required_internal_source_id_map(cursor, records)
+    tuples = [_gen_record_tuple(t, id_to_tdmq_id) for t in records]
+    source_times = [ (t[1], t[0]) for t in tuples ]
+    if on_conflict is None:
+        psycopg2.extras.execute_values(cursor, sql, tuples, template=template, page_size=chunk_size)
+        n_loaded = len(tuples)
+    else:
+        _check_on_conflict(cursor, on_conflict)
+        if on_conflict == 'update':
+            tuples = _merge_duplicate_tuples(tuples)
+        # xmax is 0 only for the rows inserted, rather than updated
+        sql += f" {ON_CONFLICT_MODES[on_conflict]} RETURNING (xmax = 0)"
+        rows = psycopg2.extras.execute_values(
+            cursor, sql, tuples, template=template, page_size=chunk_size, fetch=True)
+        n_loaded = sum(1 for (inserted,) in rows if inserted)
+    _update_ingest_log(cursor, source_times, chunk_size)
+    return source_times, n_loaded
+
+
+def _update_ingest_log(cursor, source_times, chunk_size=500):
+    """
+    Mark the days of the (source_id, time) pairs in `source_times` as
+    modified by the current transaction.
+    """
+    # Reduce the pairs sent to the DB.  For ISO timestamp strings, the first
+    # 10 characters are the date that PostgreSQL casts them to.
+    distinct = dict()
+    for source_id, t in source_times:
+        key = (str(source_id), str(t)[:10])
+        distinct.setdefault(key, (source_id, t))
+
+    # The rows are upserted (and locked) in the order of the primary key, so
+    # that concurrent ingestions don't deadlock
+    q = """
+        INSERT INTO ingest_log (source_id, day)
+        SELECT DISTINCT v.source_id::uuid, v.time::timestamp::date
+        FROM (VALUES %s) AS v(source_id, time)
+        ORDER BY 1, 2
+        ON CONFLICT (source_id, day) DO UPDATE
+        SET last_ingest = clock_timestamp() AT TIME ZONE 'UTC'"""
+    psycopg2.extras.execute_values(cursor, q, [ distinct[k] for k in sorted(distinct) ], page_size=chunk_size)
 
 
 loader = {}
@@ -447,6 +758,40 @@ supported_bucket_ops = {
     "var_samp"
 }
 
+# Percentile bucket operations, in addition to supported_bucket_ops:
+#   * pNN:        exact percentile (percentile_cont), e.g., p50, p95, p99.9.
+#                 The values in each bucket are sorted, so the cost grows with
+#                 the number of records per bucket:  on long ranges with wide
+#                 buckets prefer the approximate version.
+#   * approx_pNN: approximate percentile computed from a mergeable UddSketch
+#                 (percentile_agg) of the values in the bucket.  Constant memory
+#                 per bucket;  sketches can be merged with rollup(), so they can
+#                 also be stored in continuous aggregates.  Requires the
+#                 timescaledb_toolkit extension.
+_percentile_op_re = re.compile(r'^(approx_)?p(\d{1,2}(?:\.\d+)?|100)$')
+
+
+def _parse_percentile_op(bucket_op):
+    """
+    Returns (fraction, approximate) if `bucket_op` is a percentile operation;
+    None otherwise.
+    """
+    m = _percentile_op_re.match(bucket_op) if isinstance(bucket_op, str) else None
+    if m is None:
+        return None
+    return Decimal(m.group(2)) / 100, m.group(1) is not None
+
+
+def is_supported_bucket_op(bucket_op):
+    return bucket_op in supported_bucket_ops or _parse_percentile_op(bucket_op) is not None
+
+
+def _check_toolkit_available():
+    q = sql.SQL("SELECT 1 FROM pg_extension WHERE extname = 'timescaledb_toolkit'")
+    if query_db_all(q, one=True) is None:
+        raise tdmq.errors.UnsupportedFunctionality(
+            "Approximate percentiles require the timescaledb_toolkit extension, which is not installed")
+
 
 def get_source_info(tdmq_id):
     q = sql.SQL("""
@@ -462,8 +807,30 @@ def get_source_info(tdmq_id):
     return dict(description=row[0], public=row[1])
 
 
-def _timeseries_select(properties):
-    select_list = [sql.SQL("EXTRACT(epoch FROM record.time), record.footprint")]
+# Representations of the time column of timeseries:  seconds since the epoch
+# (float), or milliseconds or microseconds since the epoch (integer).  The
+# mapping is to the number of units per second.
+supported_time_formats = {
+    'epoch': 1,
+    'epoch_ms': 1000,
+    'epoch_us': 1000000,
+}
+
+
+def _time_expression(time_column, time_format='epoch'):
+    """
+    SQL expression converting `time_column` to `time_format`.  The result is
+    cast to double precision or bigint, which psycopg2 converts to float or
+    int -- rather than numeric, which would be converted to Decimal.
+    """
+    if time_format == 'epoch':
+        return sql.SQL("EXTRACT(epoch FROM {})::double precision").format(time_column)
+    return sql.SQL("(EXTRACT(epoch FROM {}) * {})::bigint").format(
+        time_column, sql.Literal(supported_time_formats[time_format]))
+
+
+def _timeseries_select(properties, time_format='epoch'):
+    select_list = [sql.SQL("{}, record.footprint").format(_time_expression(sql.SQL("record.time"), time_format))]
     # select_list.append( sql.SQL("record.time, record.footprint") )
     select_list.extend(
         [sql.SQL("data->{} AS {}").format(sql.Literal(field), sql.Identifier(field))
@@ -474,73 +841,163 @@ def _timeseries_select(properties):
     return dict(select_list=sql.SQL(", ").join(select_list), grouping_clause=grouping_clause)
 
 
-def _bucketed_timeseries_select(properties, bucket_interval, bucket_op):
-    select_list = []
-    # select_list.append( sql.SQL("time_bucket({}, record.time) AS time_bucket").format(sql.Literal(bucket_interval)) )
-    select_list.append(sql.SQL("EXTRACT(epoch FROM time_bucket({}, record.time)) AS time_bucket").format(sql.Literal(bucket_interval)))
-    select_list.append(sql.SQL("ST_AsGeoJSON(ST_Transform(ST_Collect(record.footprint), 4326))::json AS footprint_centroid"))
+supported_fill_modes = {
+    "null",
+    "locf",
+    "linear"
+}
 
+
+def _bucket_op_expression(bucket_op, field):
     if bucket_op == 'string_agg':
-        operation_args = "(data->>{}), ','"
-    elif bucket_op == 'jsonb_agg':
-        operation_args = "(data->{})"
+        return sql.SQL("string_agg( (data->>{}), ',' )").format(sql.Literal(field))
+    if bucket_op == 'jsonb_agg':
+        return sql.SQL("jsonb_agg( (data->{}) )").format(sql.Literal(field))
+    if bucket_op == 'count_records':
+        return sql.SQL("count(*)")
+    if bucket_op == 'count_values':
+        return sql.SQL("count( NULLIF (data->{}, 'null') )").format(sql.Literal(field))
+    percentile = _parse_percentile_op(bucket_op)
+    if percentile is not None:
+        fraction, approximate = percentile
+        if approximate:
+            return sql.SQL("approx_percentile( {}, percentile_agg( ( NULLIF (data->{}, '\"\"') )::double precision ) )").format(
+                sql.Literal(fraction), sql.Literal(field))
+        return sql.SQL("percentile_cont( {} ) WITHIN GROUP (ORDER BY ( NULLIF (data->{}, '\"\"') )::real )").format(
+            sql.Literal(fraction), sql.Literal(field))
+    return sql.SQL("{}( ( NULLIF (data->{}, '\"\"') )::real )").format(
+        sql.Identifier(bucket_op), sql.Literal(field))
+
+
+def _bucketed_timeseries_select(columns, bucket_interval, fill=None, start=None, finish=None,
+                                time_format='epoch'):
+    """
+    `columns` is a list of (field, op) pairs:  all the aggregations are
+    computed in the same pass over the records.  The start of the buckets is
+    returned in `time_format` (see supported_time_formats).
+
+    If `fill` is specified, all the buckets in the interval [start, finish)
+    are returned -- including the ones without records.  The values in the
+    empty buckets are:
+      * null:   NULL;
+      * locf:   the last value observed (last observation carried forward);
+      * linear: linearly interpolated from the neighbouring buckets.
+    """
+    select_list = []
+    if fill is None:
+        select_list.append(sql.SQL("{} AS time_bucket").format(
+            _time_expression(sql.SQL("time_bucket({}, record.time)").format(sql.Literal(bucket_interval)), time_format)))
     else:
-        operation_args = "( NULLIF (data->{}, '\"\"') )::real"
+        # time_bucket_gapfill must be a top-level expression in its query, so
+        # the conversion to epoch is done by an outer query (see outer_select).
+        select_list.append(sql.SQL("time_bucket_gapfill({}, record.time, {}::timestamp, {}::timestamp) AS time_bucket").format(
+            sql.Literal(bucket_interval), sql.Literal(start), sql.Literal(finish)))
+    select_list.append(sql.SQL("ST_AsGeoJSON(ST_Transform(ST_Collect(record.footprint), 4326))::json AS footprint_centroid"))
 
-    access_template = "{}( " + operation_args + " ) AS {}"
+    if fill == 'locf':
+        access_template = sql.SQL("locf({}) AS {}")
+    elif fill == 'linear':
+        access_template = sql.SQL("interpolate({}) AS {}")
+    else:
+        access_template = sql.SQL("{} AS {}")
 
+    identifiers = [ sql.Identifier(f"{bucket_op}_{field}") for field, bucket_op in columns ]
     select_list.extend(
-        [sql.SQL(access_template).format(
-            sql.Identifier(bucket_op),
-            sql.Literal(field),
-            sql.Identifier(f"{bucket_op}_{field}"))
-         for field in properties])
+        [access_template.format(_bucket_op_expression(bucket_op, field), identifier)
+         for (field, bucket_op), identifier in zip(columns, identifiers)])
 
     grouping_clause = sql.SQL("""
         GROUP BY time_bucket
         ORDER BY time_bucket ASC""")
 
-    return dict(select_list=sql.SQL(", ").join(select_list), grouping_clause=grouping_clause)
+    clauses = dict(select_list=sql.SQL(", ").join(select_list), grouping_clause=grouping_clause)
+    if fill is not None:
+        clauses['outer_select'] = sql.SQL(", ").join(
+            [sql.SQL("{} AS time_bucket").format(_time_expression(sql.Identifier('time_bucket'), time_format)),
+             sql.SQL("footprint_centroid")] + identifiers)
+    return clauses
 
 
-# TODO:  change args to **kwargs
-def get_timeseries(tdmq_id, args=None):
+def _parse_bucket_ops(ops):
     """
-     :query after: consider only sensors reporting strictly after
-                   this time, e.g., '2019-02-21T11:03:25Z'
-
-     :query before: consider only sensors reporting strictly before
-                    this time, e.g., '2019-02-22T11:03:25Z'
-
-     :query bucket: time bucket for data aggregation, e.g., '20 min'
-
-     :query op: aggregation operation on data contained in bucket. One of the
-                values in supported_bucket_ops
+    Parse a per-field list of operations, given as 'field:op' strings or
+    (field, op) pairs, into a list of (field, op) pairs.
+    """
+    pairs = []
+    for item in ops:
+        if isinstance(item, str):
+            field, sep, bucket_op = item.partition(':')
+            if not sep or not field or not bucket_op:
+                raise tdmq.errors.TdmqBadRequestException(f"Bad per-field operation '{item}'.  Expected 'field:op'")
+        else:
+            field, bucket_op = item
+        pairs.append((field, bucket_op))
+    return pairs
 
-     :query fields: list of controlledProperties from the source,
-                    or nothing to select all of them.
 
-     :returns: array of arrays: time, footprint, field+
-               Fields are in the same order as specified in args.
+def _timeseries_columns(description, args):
     """
+    Compute the data columns of the timeseries requested by `args`.
 
-    info = get_source_info(tdmq_id)
-    description = info['description']
-    source_is_private = not info.get('public', False)
-    logger.debug("get_timeseries for source %s", tdmq_id)
-
+    Returns a list of (field, op, name) tuples, where `op` is the bucketing
+    operation (None if the timeseries is not bucketed) and `name` is the name
+    of the column in the result.  Columns are named after their field, unless
+    more than one operation is requested (`op` is a list, or `ops` is given):
+    in that case they are named 'field:op'.
+    """
     if description.get('shape'):
-        properties = ['tiledb_index']
+        if args.get('ops') or isinstance(args.get('op'), (list, tuple)):
+            raise tdmq.errors.TdmqBadRequestException("Multiple bucketing operations are not supported for non-scalar sources")
+        return [('tiledb_index', 'jsonb_agg' if args.get('bucket') else None, 'tiledb_index')]
+
+    controlled_properties = description['controlledProperties']
+    if args.get('ops'):
+        if not args.get('bucket'):
+            raise tdmq.errors.TdmqBadRequestException("Per-field operations require a bucket")
+        if args.get('fields'):
+            raise tdmq.errors.TdmqBadRequestException("'fields' and 'ops' are mutually exclusive")
+        pairs = _parse_bucket_ops(args['ops'])
+        fields = list(dict.fromkeys(field for field, _ in pairs))
+        multi_op = True
     else:
-        properties = description['controlledProperties']
-        if args and args.get('fields', []):
-            fields = args['fields']
-            # keep the order specified in fields
-            properties = [f for f in fields if f in properties]
-            if fields != properties:
-                unknown_fields = ', '.join(set(fields).difference(properties))
-                raise tdmq.errors.TdmqBadRequestException(f"The following field(s) requested for source do not exist: {unknown_fields}")
+        fields = args.get('fields') or controlled_properties
+        pairs = None
+        multi_op = False
+
+    # keep the order specified in fields
+    properties = [f for f in fields if f in controlled_properties]
+    if fields != properties:
+        unknown_fields = ', '.join(set(fields).difference(properties))
+        raise tdmq.errors.TdmqBadRequestException(f"The following field(s) requested for source do not exist: {unknown_fields}")
+
+    if not args.get('bucket'):
+        return [ (field, None, field) for field in properties ]
+
+    if pairs is None:
+        bucket_op = args.get('op')
+        if isinstance(bucket_op, (list, tuple)):
+            multi_op = True
+            pairs = [ (field, op) for field in properties for op in bucket_op ]
+        else:
+            pairs = [ (field, bucket_op) for field in properties ]
+
+    for _, bucket_op in pairs:
+        if not is_supported_bucket_op(bucket_op):
+            raise tdmq.errors.TdmqBadRequestException(f"Unsupported bucketing operation '{bucket_op}'")
+    if any(bucket_op.startswith('approx_') for _, bucket_op in pairs):
+        _check_toolkit_available()
+    if len(set(pairs)) != len(pairs):
+        raise tdmq.errors.TdmqBadRequestException("Duplicate bucketing operations requested")
 
+    return [ (field, bucket_op, f"{field}:{bucket_op}" if multi_op else field) for field, bucket_op in pairs ]
+
+
+def _timeseries_query(tdmq_id, description, columns, args):
+    """
+    Build the query that extracts the timeseries `columns` (as returned by
+    `_timeseries_columns`) for source `tdmq_id`.  See `get_timeseries_result`
+    for the supported `args`.
+    """
     query_template = sql.SQL("""
         SELECT {select_list}
         FROM record
@@ -548,31 +1005,117 @@ def get_timeseries(tdmq_id, args=None):
         {where_clause}
         {grouping_clause}""")
 
-    if args and args.get('bucket'):
-        bucket_interval = args['bucket']
+    time_format = args.get('time_format') or 'epoch'
+    if time_format not in supported_time_formats:
+        raise tdmq.errors.TdmqBadRequestException(f"Unsupported time format '{time_format}'")
 
-        if description.get('shape'):
-            bucket_op = 'jsonb_agg'
-        else:
-            bucket_op = args['op']
-            if bucket_op not in supported_bucket_ops:
-                raise tdmq.errors.TdmqBadRequestException(f"Unsupported bucketing operation '{bucket_op}'")
+    if args.get('bucket'):
+        bucket_interval = args['bucket']
 
-        clauses = _bucketed_timeseries_select(properties, bucket_interval, bucket_op)
+        fill = args.get('fill')
+        if fill is not None:
+            if fill not in supported_fill_modes:
+                raise tdmq.errors.TdmqBadRequestException(f"Unsupported fill mode '{fill}'")
+            if description.get('shape'):
+                raise tdmq.errors.TdmqBadRequestException("Gap filling is not supported for non-scalar sources")
+            if not (args.get('after') and args.get('before')):
+                raise tdmq.errors.TdmqBadRequestException("Gap filling requires both 'after' and 'before'")
+            for _, bucket_op, _ in columns:
+                if fill == 'linear' and bucket_op == 'string_agg':
+                    raise tdmq.errors.TdmqBadRequestException(f"Linear interpolation is not supported for operation '{bucket_op}'")
+
+        clauses = _bucketed_timeseries_select([ (field, bucket_op) for field, bucket_op, _ in columns ],
+                                              bucket_interval, fill, args.get('after'), args.get('before'),
+                                              time_format)
     else:
-        bucket_op = None
-        clauses = _timeseries_select(properties)
+        if args.get('fill'):
+            raise tdmq.errors.TdmqBadRequestException("Gap filling requires a bucket")
+        clauses = _timeseries_select([ field for field, _, _ in columns ], time_format)
 
     where = [sql.SQL("source_id = {}").format(sql.Literal(tdmq_id))]
-    if args and args.get('after'):
+    if args.get('after'):
         where.append(sql.SQL("record.time >= {}").format(sql.Literal(args['after'])))
-    if args and args.get('before'):
+    if args.get('before'):
         where.append(sql.SQL("record.time < {}").format(sql.Literal(args['before'])))
 
     clauses['where_clause'] = sql.SQL(" AND ").join(where)
 
+    outer_select = clauses.pop('outer_select', None)
     query = query_template.format(**clauses)
-    rows = query_db_all(query)
+    if outer_select is not None:
+        query = sql.SQL("""
+            SELECT {} FROM ({}) AS bucketed
+            ORDER BY bucketed.time_bucket ASC""").format(outer_select, query)
+    return query
+
+
+def _query_timeseries_rows(tdmq_id, description, columns, args):
+    """
+    Run the timeseries query and return all its rows.  Bucketed queries go
+    through the result cache, if it's enabled.
+    """
+    def run_query(query_args):
+        return query_db_all(_timeseries_query(tdmq_id, description, columns, query_args))
+
+    if args.get('bucket') and result_cache.enabled:
+        time_scale = supported_time_formats.get(args.get('time_format') or 'epoch', 1)
+        return result_cache.fetch(tdmq_id, args, run_query, time_scale)
+    return run_query(args)
+
+
+def _row_batches(rows: Iterator[Tuple], batch_size: int) -> Iterator[List[Tuple]]:
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+# TODO:  change args to **kwargs
+def get_timeseries(tdmq_id, args=None):
+    """
+     :query after: consider only sensors reporting strictly after
+                   this time, e.g., '2019-02-21T11:03:25Z'
+
+     :query before: consider only sensors reporting strictly before
+                    this time, e.g., '2019-02-22T11:03:25Z'
+
+     :query bucket: time bucket for data aggregation, e.g., '20 min'
+
+     :query op: aggregation operation on data contained in bucket. One of the
+                values in supported_bucket_ops or a percentile ('pNN' or
+                'approx_pNN', e.g., 'p95'), or a list of them to compute
+                several aggregations in the same query.  With a list, the
+                fields in the result are named 'field:op'.
+
+     :query ops: per-field aggregation operations, as a list of 'field:op'
+                 strings, e.g., ['temperature:avg', 'rain:sum'].  Replaces
+                 `op` and `fields`;  the fields in the result are named 'field:op'.
+
+     :query fill: return also the empty buckets in [after, before), filling
+                  them as specified by one of the values in supported_fill_modes.
+                  Requires `bucket`, `after` and `before`.
+
+     :query fields: list of controlledProperties from the source,
+                    or nothing to select all of them.
+
+     :query time_format: representation of time, one of the keys of
+                         supported_time_formats.  Default: 'epoch'.
+
+     :returns: array of arrays: time, footprint, field+
+               Fields are in the same order as specified in args.
+    """
+
+    info = get_source_info(tdmq_id)
+    description = info['description']
+    source_is_private = not info.get('public', False)
+    logger.debug("get_timeseries for source %s", tdmq_id)
+
+    args = args or {}
+    columns = _timeseries_columns(description, args)
+    properties = [ name for _, _, name in columns ]
+
+    rows = _query_timeseries_rows(tdmq_id, description, columns, args)
 
     return dict(source_info=description,
                 public=(not source_is_private),
@@ -621,11 +1164,25 @@ def get_timeseries_result(tdmq_id, batch_size: int = None, **kwargs):
      :query bucket: time bucket for data aggregation, e.g., '20 min'
 
      :query op: aggregation operation on data contained in bucket. One of the
-                values in supported_bucket_ops
+                values in supported_bucket_ops or a percentile ('pNN' or
+                'approx_pNN', e.g., 'p95'), or a list of them to compute
+                several aggregations in the same query.  With a list, the
+                fields in the result are named 'field:op'.
+
+     :query ops: per-field aggregation operations, as a list of 'field:op'
+                 strings, e.g., ['temperature:avg', 'rain:sum'].  Replaces
+                 `op` and `fields`;  the fields in the result are named 'field:op'.
+
+     :query fill: return also the empty buckets in [after, before), filling
+                  them as specified by one of the values in supported_fill_modes.
+                  Requires `bucket`, `after` and `before`.
 
      :query fields: list of controlledProperties from the source,
                     or nothing to select all of them.
 
+     :query time_format: representation of time, one of the keys of
+                         supported_time_formats.  Default: 'epoch'.
+
      :returns: array of arrays: time, footprint, field+
                Fields are in the same order as specified in args.
     """
@@ -635,55 +1192,186 @@ def get_timeseries_result(tdmq_id, batch_size: int = None, **kwargs):
     source_is_private = not info.get('public', False)
     logger.debug("get_timeseries_batches for source %s", tdmq_id)
 
-    if description.get('shape'):
-        properties = ['tiledb_index']
+    columns = _timeseries_columns(description, kwargs)
+    properties = [ name for _, _, name in columns ]
+
+    if kwargs.get('bucket') and result_cache.enabled:
+        # The rows are streamed through the cache
+        def run_query(query_args):
+            query = _timeseries_query(tdmq_id, description, columns, query_args)
+            for batch in query_db_batches(query, batch_size=batch_size or 2500, server_side=True):
+                yield from batch
+        time_scale = supported_time_formats.get(kwargs.get('time_format') or 'epoch', 1)
+        rows = result_cache.fetch_iter(tdmq_id, kwargs, run_query, time_scale)
+        batch_row_iterator = _row_batches(rows, batch_size)
     else:
-        properties = description['controlledProperties']
-        if kwargs.get('fields'):
-            fields = kwargs['fields']
-            # keep the order specified in fields
-            properties = [f for f in fields if f in properties]
-            if fields != properties:
-                unknown_fields = ', '.join(set(fields).difference(properties))
-                raise tdmq.errors.TdmqBadRequestException(f"The following field(s) requested for source do not exist: {unknown_fields}")
+        query = _timeseries_query(tdmq_id, description, columns, kwargs)
+        batch_row_iterator = query_db_batches(query, batch_size=batch_size)
 
-    query_template = sql.SQL("""
-        SELECT {select_list}
-        FROM record
-        WHERE
-        {where_clause}
-        {grouping_clause}""")
+    return TimeseriesResult(
+        source_info=description,
+        is_public=(not source_is_private),
+        fields=['time', 'footprint'] + properties,
+        batch_row_iterator=batch_row_iterator)
 
-    if kwargs.get('bucket'):
-        bucket_interval = kwargs['bucket']
 
-        if description.get('shape'):
-            bucket_op = 'jsonb_agg'
-        else:
-            bucket_op = kwargs['op']
-            if bucket_op not in supported_bucket_ops:
-                raise tdmq.errors.TdmqBadRequestException(f"Unsupported bucketing operation '{bucket_op}'")
+# Maximum number of arguments of a PostgreSQL function (FUNC_MAX_ARGS),
+# which limits the number of fields that json_build_array and
+# jsonb_build_object can serialize.
+_PG_FUNC_MAX_ARGS = 100
 
-        clauses = _bucketed_timeseries_select(properties, bucket_interval, bucket_op)
-    else:
-        bucket_op = None
-        clauses = _timeseries_select(properties)
 
-    where = [sql.SQL("source_id = {}").format(sql.Literal(tdmq_id))]
-    if kwargs and kwargs.get('after'):
-        where.append(sql.SQL("record.time >= {}").format(sql.Literal(kwargs['after'])))
-    if kwargs and kwargs.get('before'):
-        where.append(sql.SQL("record.time < {}").format(sql.Literal(kwargs['before'])))
+def _format_json_rows(rows, fields, sparse: bool) -> str:
+    if sparse:
+        return ','.join(
+            json.dumps({ f: v for f, v in zip(fields, row) if v is not None }) for row in rows)
+    return ','.join(json.dumps(row) for row in rows)
 
-    clauses['where_clause'] = sql.SQL(" AND ").join(where)
 
-    query = query_template.format(**clauses)
+def get_timeseries_json_result(tdmq_id, batch_size: int = 2500, sparse: bool = False,
+                               anonymize_private: bool = True, **kwargs):
+    """
+    Like get_timeseries_result, but the rows are serialized to JSON by the
+    database.  Each batch produced by the result is a string containing the
+    comma-separated JSON representation of up to `batch_size` rows:  arrays
+    in the dense format, objects without null fields in the sparse one.  The
+    rows are read through a server-side cursor, as the query produces them.
+
+    If `anonymize_private` is True and the source is private, the footprint
+    of the records is replaced by null.
+
+    Sources with too many fields to be serialized by a single SQL function
+    call are serialized in Python, with the same output.
+    """
+    assert batch_size > 0
+    info = get_source_info(tdmq_id)
+    description = info['description']
+    source_is_private = not info.get('public', False)
+    logger.debug("get_timeseries_json_result for source %s", tdmq_id)
+
+    columns = _timeseries_columns(description, kwargs)
+    fields = ['time', 'footprint'] + [ name for _, _, name in columns ]
+    query = _timeseries_query(tdmq_id, description, columns, kwargs)
+    hide_footprint = anonymize_private and source_is_private
+
+    n_args = 2 * len(fields) if sparse else len(fields)
+    if n_args > _PG_FUNC_MAX_ARGS:
+        logger.debug("Too many fields (%s) for SQL JSON serialization.  Serializing in Python", len(fields))
+
+        def python_json_batches():
+            for batch in query_db_batches(query, batch_size=batch_size):
+                if hide_footprint:
+                    batch = [ (row[0], None, *row[2:]) for row in batch ]
+                yield _format_json_rows(batch, fields, sparse)
+        batch_iterator = python_json_batches()
+    else:
+        column_ids = [ sql.Identifier(f"c{i}") for i in range(len(fields)) ]
+        values = list(column_ids)
+        if hide_footprint:
+            values[1] = sql.SQL("NULL")
+        elif not kwargs.get('bucket'):
+            # Raw footprints are sent as their text (hex EWKB) representation,
+            # which is what psycopg2 returns for geometry columns.
+            values[1] = sql.SQL("{}::text").format(column_ids[1])
+
+        if sparse:
+            # Only drop the top-level null values (jsonb_strip_nulls would
+            # also drop the ones nested in the values of the fields)
+            row_expr = sql.SQL("""(
+                SELECT jsonb_object_agg(key, value) FROM jsonb_each(jsonb_build_object({}))
+                WHERE value <> 'null'::jsonb)::text""").format(
+                sql.SQL(", ").join(
+                    sql.SQL("{}, {}").format(sql.Literal(f), v) for f, v in zip(fields, values)))
+        else:
+            row_expr = sql.SQL("json_build_array({})::text").format(sql.SQL(", ").join(values))
+
+        json_query = sql.SQL("""
+            SELECT {row_expr}
+            FROM ({query}) AS ts({column_list})
+            ORDER BY {time_column}""").format(
+                time_column=column_ids[0],
+                row_expr=row_expr,
+                query=query,
+                column_list=sql.SQL(", ").join(column_ids))
+
+        # The rows are serialized as the server-side cursor produces them
+        batch_iterator = ( ','.join(row_json for (row_json,) in batch)
+                           for batch in query_db_batches(json_query, batch_size=batch_size, server_side=True) )
 
     return TimeseriesResult(
         source_info=description,
         is_public=(not source_is_private),
-        fields=['time', 'footprint'] + properties,
-        batch_row_iterator=query_db_batches(query, batch_size=batch_size))
+        fields=fields,
+        batch_row_iterator=batch_iterator)
+
+
+def get_timeseries_summary(tdmq_id, after=None, before=None, time_format='epoch'):
+    """
+    Returns a dict { 'count': number of records, 'first': timestamp, 'last': timestamp }
+    for the records of source `tdmq_id` in the time interval [after, before).
+    Timestamps are in `time_format` (see supported_time_formats); they are
+    None if there are no records in the interval.
+    """
+    time_format = time_format or 'epoch'
+    if time_format not in supported_time_formats:
+        raise tdmq.errors.TdmqBadRequestException(f"Unsupported time format '{time_format}'")
+    where = [sql.SQL("source_id = {}").format(sql.Literal(tdmq_id))]
+    if after:
+        where.append(sql.SQL("record.time >= {}").format(sql.Literal(after)))
+    if before:
+        where.append(sql.SQL("record.time < {}").format(sql.Literal(before)))
+
+    query = sql.SQL("""
+        SELECT
+            COUNT(*) AS count,
+            {} AS first,
+            {} AS last
+        FROM record
+        WHERE {}""").format(
+        _time_expression(sql.SQL("MIN(record.time)"), time_format),
+        _time_expression(sql.SQL("MAX(record.time)"), time_format),
+        sql.SQL(" AND ").join(where))
+
+    return query_db_all(query, one=True, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+def get_timeseries_version(tdmq_id, after=None, before=None):
+    """
+    Returns a dict describing the state of the records of source `tdmq_id`
+    in the time interval [after, before):
+
+      * public:      whether the source is public;
+      * version:     opaque string that changes whenever records in the
+                     interval are ingested;
+      * last_ingest: time of the last ingestion of records in the interval
+                     (naive UTC datetime), or None.
+
+    Ingestion is tracked by day of data (see the ingest_log table), so the
+    version also changes when records are ingested in the same days as the
+    interval, but outside of it.
+    """
+    join_conditions = [sql.SQL("ingest_log.source_id = source.tdmq_id")]
+    if after:
+        join_conditions.append(sql.SQL("ingest_log.day >= date_trunc('day', {}::timestamp)").format(sql.Literal(after)))
+    if before:
+        join_conditions.append(sql.SQL("ingest_log.day < {}::timestamp").format(sql.Literal(before)))
+
+    query = sql.SQL("""
+        SELECT
+            source.public AS public,
+            md5(COALESCE(string_agg(ingest_log.day::text || '@' || ingest_log.last_ingest::text, ','
+                                    ORDER BY ingest_log.day), '')) AS version,
+            MAX(ingest_log.last_ingest) AS last_ingest
+        FROM source
+        LEFT JOIN ingest_log ON {}
+        WHERE source.tdmq_id = {}
+        GROUP BY source.public""").format(
+            sql.SQL(" AND ").join(join_conditions), sql.Literal(tdmq_id))
+
+    row = query_db_all(query, one=True, cursor_factory=psycopg2.extras.RealDictCursor)
+    if row is None:
+        raise tdmq.errors.ItemNotFoundException(f"tdmq_id {tdmq_id} not found in DB")
+    return dict(row)
 
 
 def get_latest_activity(tdmq_id):
@@ -747,4 +1435,24 @@ def add_db_cli(app):
         n = dump_field(field, path)
         click.echo('Dumped {} records'.format(n))
 
+    @db_cli.command('record-index')
+    @click.option('--deduplicate', default=False, is_flag=True,
+                  help="Merge the existing records with the same source and time")
+    @click.option('--drop', default=False, is_flag=True,
+                  help="Replace the unique index with the plain one")
+    def db_record_index(deduplicate, drop):
+        """Create the unique index on the source and time of the records."""
+        conn = tdmq.db_manager.db_connect(conn_params())
+        try:
+            if drop:
+                drop_record_unique_index(conn)
+                click.echo('Dropped the unique index on the records.')
+                return
+            removed = create_record_unique_index(conn, deduplicate)
+        finally:
+            conn.close()
+        if deduplicate:
+            click.echo(f'Merged {removed} duplicate records')
+        click.echo('Created the unique index on the records.')
+
     app.cli.add_command(db_cli)
@@ -0,0 +1,273 @@
+"""
+Visual downsampling of timeseries rows.
+
+The functions in this module work on the row batches produced by
+`tdmq.db.get_timeseries_result`:  each row is a tuple
+(time, footprint, field_1, ..., field_n), with time expressed as seconds
+since the epoch and rows ordered by time.
+
+Rows are assigned to bins by their position in the result set, so the total
+number of rows must be known in advance (see `tdmq.db.get_timeseries_summary`).
+Only the rows in one (minmax) or two (lttb) bins are kept in memory at any
+given time.  The selected rows are returned whole, so the output is still a
+valid timeseries in the same layout as the input.
+"""
+
+import abc
+import logging
+from numbers import Number
+from typing import Iterable, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+supported_methods = ('lttb', 'minmax')
+
+# Index of the first data field in a timeseries row
+FIRST_FIELD = 2
+
+
+def _numeric(value):
+    if isinstance(value, Number) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+class _Downsampler(abc.ABC):
+    def __init__(self, n_rows: int, n_bins: int, n_fields: int):
+        assert n_bins > 0
+        self._n_rows = n_rows
+        self._n_bins = n_bins
+        self._n_fields = n_fields
+        self._next_index = 0
+        self._last = None  # last row seen, as (index, row)
+
+    def _bin_of(self, index: int) -> int:
+        # The first and the last row are handled separately, so the rows
+        # with index in [1, n_rows - 2] are spread over n_bins bins.
+        inner_rows = max(self._n_rows - 2, 1)
+        return min((index - 1) * self._n_bins // inner_rows, self._n_bins - 1)
+
+    def process(self, batch: Iterable[Tuple]) -> List[Tuple]:
+        out = []
+        for row in batch:
+            index = self._next_index
+            self._next_index += 1
+            if index == 0:
+                out.extend(self._first(row))
+                continue
+            if self._last is not None:
+                out.extend(self._add(*self._last))
+            self._last = (index, row)
+        return out
+
+    def finish(self) -> List[Tuple]:
+        return self._finish(self._last)
+
+    @abc.abstractmethod
+    def _first(self, row) -> List[Tuple]:
+        """
+        Process the first row of the series.  Returns the rows selected.
+        """
+
+    @abc.abstractmethod
+    def _add(self, index, row) -> List[Tuple]:
+        """
+        Process the row at position `index`, which is not the first nor,
+        as far as we know, the last one.  Returns the rows selected.
+        """
+
+    @abc.abstractmethod
+    def _finish(self, last) -> List[Tuple]:
+        """
+        Process the end of the series.  `last` is the last row, as (index,
+        row), or None if the series has a single row.  Returns the rows
+        selected.
+        """
+
+    @staticmethod
+    def _rows_by_index(selected) -> List[Tuple]:
+        return [ row for _, row in sorted(dict(selected).items()) ]
+
+
+class MinMaxDownsampler(_Downsampler):
+    """
+    Keeps, for each bin and each field, the rows with the minimum and
+    maximum value.  The first and last row of the series are always kept.
+    """
+    def __init__(self, n_rows: int, max_points: int, n_fields: int):
+        super().__init__(n_rows, max(1, (max_points - 2) // 2), n_fields)
+        self._bin = None
+        self._extremes = [None] * n_fields  # per field: [(v, index, row) min, (v, index, row) max]
+
+    def _first(self, row):
+        return [row]
+
+    def _flush_bin(self):
+        selected = []
+        for extremes in self._extremes:
+            if extremes is not None:
+                selected.extend((index, row) for _, index, row in extremes)
+        self._extremes = [None] * self._n_fields
+        return self._rows_by_index(selected)
+
+    def _add(self, index, row):
+        out = []
+        b = self._bin_of(index)
+        if b != self._bin:
+            out = self._flush_bin()
+            self._bin = b
+        for f in range(self._n_fields):
+            v = _numeric(row[FIRST_FIELD + f])
+            if v is None:
+                continue
+            extremes = self._extremes[f]
+            if extremes is None:
+                self._extremes[f] = [(v, index, row), (v, index, row)]
+            elif v < extremes[0][0]:
+                extremes[0] = (v, index, row)
+            elif v > extremes[1][0]:
+                extremes[1] = (v, index, row)
+        return out
+
+    def _finish(self, last):
+        out = self._flush_bin()
+        if last is not None:
+            out.append(last[1])
+        return out
+
+
+class LTTBDownsampler(_Downsampler):
+    """
+    Largest-Triangle-Three-Buckets downsampling, applied independently to
+    each field.
+
+    For each bin, the point selected is the one that forms the largest triangle
+    with the point selected in the previous bin and the average point of the
+    following bin.  To do this, the rows of two consecutive bins are buffered.
+    """
+    def __init__(self, n_rows: int, max_points: int, n_fields: int):
+        super().__init__(n_rows, max(1, max_points - 2), n_fields)
+        self._anchors = [None] * n_fields  # last point selected for each field, as (t, v)
+        self._current = []  # (index, row) in the bin awaiting selection
+        self._next = []     # (index, row) in the bin following self._current
+        self._next_bin = None
+
+    def _first(self, row):
+        t = float(row[0])
+        for f in range(self._n_fields):
+            v = _numeric(row[FIRST_FIELD + f])
+            if v is not None:
+                self._anchors[f] = (t, v)
+        return [row]
+
+    def _field_average(self, rows, f):
+        n, sum_t, sum_v = 0, 0.0, 0.0
+        for _, row in rows:
+            v = _numeric(row[FIRST_FIELD + f])
+            if v is not None:
+                n += 1
+                sum_t += float(row[0])
+                sum_v += v
+        if n == 0:
+            return None
+        return (sum_t / n, sum_v / n)
+
+    def _select(self, rows, following):
+        """
+        Select the rows to keep from `rows`.  `following` is a function that
+        returns the reference point for field `f` after this bin (or None).
+        """
+        selected = []
+        for f in range(self._n_fields):
+            best, best_area = None, -1.0
+            anchor = self._anchors[f]
+            after = following(f) if anchor is not None else None
+            for index, row in rows:
+                v = _numeric(row[FIRST_FIELD + f])
+                if v is None:
+                    continue
+                t = float(row[0])
+                if anchor is None:
+                    # no previous point for this field:  start from here
+                    best = (index, row, t, v)
+                    break
+                if after is None:
+                    area = abs(v - anchor[1])
+                else:
+                    area = abs((anchor[0] - after[0]) * (v - anchor[1]) -
+                               (anchor[0] - t) * (after[1] - anchor[1]))
+                if area > best_area:
+                    best, best_area = (index, row, t, v), area
+            if best is not None:
+                selected.append(best[:2])
+                self._anchors[f] = best[2:]
+        return self._rows_by_index(selected)
+
+    def _add(self, index, row):
+        out = []
+        b = self._bin_of(index)
+        if b != self._next_bin:
+            if self._current:
+                out = self._select(self._current, lambda f: self._field_average(self._next, f))
+            self._current = self._next
+            self._next, self._next_bin = [], b
+        self._next.append((index, row))
+        return out
+
+    def _finish(self, last):
+        out = []
+        if last is None:
+            return out
+
+        _, last_row = last
+        t_last = float(last_row[0])
+
+        def last_point(f):
+            v = _numeric(last_row[FIRST_FIELD + f])
+            return None if v is None else (t_last, v)
+
+        if self._current:
+            def following(f):
+                return self._field_average(self._next, f) or last_point(f)
+            out.extend(self._select(self._current, following))
+        if self._next:
+            out.extend(self._select(self._next, last_point))
+        out.append(last_row)
+        return out
+
+
+def _downsampling_gen(batches, sampler):
+    for batch in batches:
+        out = sampler.process(batch)
+        if out:
+            yield out
+    out = sampler.finish()
+    if out:
+        yield out
+
+
+def downsample_batches(batches: Iterator[List[Tuple]], n_rows: int, max_points: int,
+                       n_fields: int, method: str = 'lttb') -> Iterator[List[Tuple]]:
+    """
+    Downsample the row `batches` to roughly `max_points` points per field.
+
+    :param n_rows: total number of rows that `batches` will produce.
+    :param n_fields: number of data fields in each row (i.e., excluding
+                     time and footprint).
+    """
+    if method not in supported_methods:
+        raise ValueError(f"Unsupported downsampling method '{method}'")
+    if max_points < 3:
+        raise ValueError("max_points must be >= 3")
+
+    if n_rows <= max_points:
+        logger.debug("downsample_batches: %s rows <= max_points.  Nothing to do", n_rows)
+        return iter(batches)
+
+    logger.debug("downsample_batches: reducing %s rows to about %s points per field with %s",
+                 n_rows, max_points, method)
+    if method == 'lttb':
+        sampler = LTTBDownsampler(n_rows, max_points, n_fields)
+    else:
+        sampler = MinMaxDownsampler(n_rows, max_points, n_fields)
+    return _downsampling_gen(batches, sampler)
@@ -33,6 +33,16 @@ class TdmqBadRequestException(TdmqError):
         super().__init__("Bad Request", status, msg)
 
 
+class RecordValidationError(TdmqBadRequestException):
+    """
+    Some records don't conform to the schema of their entity type.
+    `errors` is the list of the reports of the invalid records.
+    """
+    def __init__(self, msg: str = None, errors: list = None, status: int = 400):
+        super().__init__(msg, status)
+        self.errors = errors or []
+
+
 class DuplicateItemException(TdmqError):
     def __init__(self, msg: str = None, status: int = 409):
         super().__init__("Duplicate entity", status, msg)
@@ -70,3 +80,10 @@ class UnsupportedFunctionality(TdmqError):
 
 class DBOperationalError(InternalServerError):
     pass
+
+
+class ColumnTypeError(InternalServerError):
+    """
+    A value doesn't fit the type of its column in a typed (Arrow or
+    Parquet) timeseries.
+    """
@@ -0,0 +1,335 @@
+"""
+Asynchronous ingestion of records with group commit.
+
+When the ingest queue is enabled (INGEST_QUEUE = 'sqlite:///path/to/queue.db'),
+`POST /records` appends the validated records to a durable local spool -- a
+SQLite database shared by the worker processes on the host -- and returns
+202 (Accepted).  A flusher loads the queued records into the database:  the
+records of many requests are coalesced into one transaction of up to
+INGEST_FLUSH_MAX_RECORDS records, every INGEST_FLUSH_INTERVAL seconds (or
+as soon as that many records are waiting).
+
+The flusher is a background thread in each worker process, started by its
+first request (INGEST_QUEUE_FLUSHER = 'worker'), or a dedicated process run
+with `flask ingest-queue run` (INGEST_QUEUE_FLUSHER = 'external').  CLI
+commands don't start a flusher.
+
+Each flush claims a group of requests from the spool, loads them and then
+deletes them, so records are loaded at least once:  if a flusher dies
+between the database commit and the deletion, its claim expires after
+INGEST_CLAIM_TIMEOUT seconds and the records are loaded again.  If a group
+can't be loaded, its requests are loaded one at a time and the failing ones
+are logged and moved to the `failed` table of the spool.  A group is loaded
+in a single transaction, whatever the `on_conflict` modes of its requests,
+so that it's either stored or not at all.  Connection errors
+don't fail the requests:  they stay queued and the flusher backs off.
+
+Requests are validated before they are queued (see api.records_post), so
+records should only fail to load if the sources are deleted meanwhile.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import psycopg2
+
+import tdmq.db
+import tdmq.db_manager
+
+_logger = logging.getLogger(__name__)
+
+SQLITE_PREFIX = 'sqlite:///'
+
+
+class IngestQueue:
+    def __init__(self, app=None):
+        self._path = None
+        self._local = threading.local()
+        self._db_settings = None
+        self._flush_interval = None
+        self._flush_max_records = None
+        self._claim_timeout = None
+        self._flusher_mode = None
+        self._flusher = None
+        self._flusher_pid = None
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._pg_conn = None
+        self._depth_gauge = None
+        self._commit_histogram = None
+        if app:
+            self.init_app(app)
+
+    @property
+    def enabled(self) -> bool:
+        return self._path is not None
+
+    def init_app(self, flask_app, depth_gauge=None, commit_histogram=None):
+        """
+        :param depth_gauge: prometheus Gauge set to the number of queued records.
+        :param commit_histogram: prometheus Histogram observing the duration
+                                 of the group commits.
+        """
+        self.stop()
+        if self._pg_conn is not None:
+            self._pg_conn.close()
+            self._pg_conn = None
+        setting = flask_app.config.get('INGEST_QUEUE')
+        if not setting:
+            self._path = None
+            _logger.info("Ingest queue disabled")
+            return
+        if not setting.startswith(SQLITE_PREFIX):
+            raise ValueError(f"Invalid INGEST_QUEUE value '{setting}'")
+
+        self._path = setting[len(SQLITE_PREFIX):]
+        self._db_settings = tdmq.db.get_db_settings(flask_app.config)
+        self._flush_interval = flask_app.config.get('INGEST_FLUSH_INTERVAL', 1.0)
+        self._flush_max_records = flask_app.config.get('INGEST_FLUSH_MAX_RECORDS', 10000)
+        self._claim_timeout = flask_app.config.get('INGEST_CLAIM_TIMEOUT', 300)
+        self._flusher_mode = flask_app.config.get('INGEST_QUEUE_FLUSHER', 'worker')
+        if self._flusher_mode not in ('worker', 'external'):
+            raise ValueError(f"Invalid INGEST_QUEUE_FLUSHER value '{self._flusher_mode}'")
+        self._depth_gauge = depth_gauge
+        self._commit_histogram = commit_histogram
+
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    records TEXT NOT NULL,
+                    n_records INTEGER NOT NULL,
+                    on_conflict TEXT,
+                    received REAL NOT NULL,
+                    claim TEXT,
+                    claimed_at REAL)""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS failed (
+                    id INTEGER PRIMARY KEY,
+                    records TEXT NOT NULL,
+                    on_conflict TEXT,
+                    error TEXT,
+                    failed_at REAL NOT NULL)""")
+        _logger.info("Using ingest queue %s with %s flusher", self._path, self._flusher_mode)
+        if self._flusher_mode == 'worker':
+            # Started by the serving processes only:  records queued before a
+            # restart are loaded without waiting for new ones
+            flask_app.before_request(self._ensure_flusher)
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared by threads, nor inherited by forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def enqueue(self, records: List[Dict], on_conflict: str = None) -> int:
+        """
+        Append `records` to the spool, to be loaded with the `on_conflict`
+        mode of tdmq.db.load_records_conn.  Returns the number of records
+        queued.
+        """
+        with self._connection() as conn:
+            conn.execute("INSERT INTO pending (records, n_records, on_conflict, received) VALUES (?, ?, ?, ?)",
+                         (json.dumps(records), len(records), on_conflict, time.time()))
+        self._update_depth()
+        if self._flusher_mode == 'worker':
+            self._ensure_flusher()
+        return len(records)
+
+    def depth(self) -> int:
+        """
+        Number of records waiting to be loaded.
+        """
+        row = self._connection().execute("SELECT COALESCE(SUM(n_records), 0) FROM pending").fetchone()
+        return row[0]
+
+    def _update_depth(self):
+        if self._depth_gauge is not None:
+            self._depth_gauge.set(self.depth())
+
+    def _claim(self):
+        """
+        Claim the oldest queued requests, up to INGEST_FLUSH_MAX_RECORDS records
+        (but at least one request).  Returns (claim, list of (id, records, on_conflict)).
+        """
+        claim = uuid.uuid4().hex
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("""
+                SELECT id, n_records FROM pending
+                WHERE claim IS NULL OR claimed_at < ?
+                ORDER BY id""", (now - self._claim_timeout,))
+            ids, n = [], 0
+            for row_id, n_records in rows:
+                if ids and n + n_records > self._flush_max_records:
+                    break
+                ids.append(row_id)
+                n += n_records
+            conn.executemany("UPDATE pending SET claim = ?, claimed_at = ? WHERE id = ?",
+                             [ (claim, now, row_id) for row_id in ids ])
+        if not ids:
+            return claim, []
+        rows = self._connection().execute(
+            "SELECT id, records, on_conflict FROM pending WHERE claim = ? ORDER BY id", (claim,)).fetchall()
+        return claim, [ (row_id, json.loads(records), on_conflict) for row_id, records, on_conflict in rows ]
+
+    def _release(self, claim, ids) -> None:
+        """
+        Return the claimed requests `ids` to the queue, to be loaded again.
+        """
+        with self._connection() as conn:
+            conn.executemany("UPDATE pending SET claim = NULL, claimed_at = NULL WHERE claim = ? AND id = ?",
+                             [ (claim, row_id) for row_id in ids ])
+
+    def _pg_connection(self):
+        if self._pg_conn is None or self._pg_conn.closed != 0:
+            self._pg_conn = tdmq.db_manager.db_connect(self._db_settings)
+        return self._pg_conn
+
+    @staticmethod
+    def _is_transient(e: Exception) -> bool:
+        # Lost or refused connections:  the records may load on the next try
+        return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def _load(self, requests) -> None:
+        # One transaction for the whole group, whatever the on_conflict mode
+        # of each request:  the group is either loaded or not at all.
+        start = time.perf_counter()
+        tdmq.db.load_record_batches_conn(
+            self._pg_connection(), [ records for _, records, _ in requests ],
+            batch_on_conflict=[ on_conflict for _, _, on_conflict in requests ])
+        if self._commit_histogram is not None:
+            self._commit_histogram.observe(time.perf_counter() - start)
+
+    def flush(self) -> int:
+        """
+        Load one group of queued records into the database.  Returns the
+        number of records loaded.
+        """
+        with self._flush_lock:
+            claim, requests = self._claim()
+            if not requests:
+                return 0
+
+            n_records = sum(len(request[1]) for request in requests)
+            failed = []
+            try:
+                self._load(requests)
+            except Exception as e:  # pylint: disable=broad-except
+                if self._is_transient(e):
+                    self._release(claim, [ request[0] for request in requests ])
+                    raise
+                _logger.warning("Loading %s queued requests failed.  Loading them one at a time",
+                                len(requests), exc_info=True)
+                for i, request in enumerate(requests):
+                    try:
+                        self._load([request])
+                    except Exception as e:  # pylint: disable=broad-except
+                        if self._is_transient(e):
+                            # keep the requests not loaded yet, drop the others
+                            self._release(claim, [ r[0] for r in requests[i:] ])
+                            n_records -= sum(len(r[1]) for r in requests[i:])
+                            break
+                        _logger.error("Failed to load queued request %s (%s records): %s",
+                                      request[0], len(request[1]), e)
+                        failed.append((request, str(e)))
+                        n_records -= len(request[1])
+
+            with self._connection() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO failed (id, records, on_conflict, error, failed_at) VALUES (?, ?, ?, ?, ?)",
+                    [ (row_id, json.dumps(records), on_conflict, error, time.time())
+                      for (row_id, records, on_conflict), error in failed ])
+                conn.execute("DELETE FROM pending WHERE claim = ?", (claim,))
+            self._update_depth()
+            _logger.debug("Ingest queue: loaded %s records from %s requests", n_records, len(requests))
+            return n_records
+
+    def run(self) -> None:
+        """
+        Flush the queue every INGEST_FLUSH_INTERVAL seconds until `stop` is
+        called.  Full groups are flushed without waiting.
+        """
+        _logger.info("Ingest queue flusher started")
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                while self.flush() >= self._flush_max_records and not self._stop.is_set():
+                    pass
+                failures = 0
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception("Ingest queue flush failed")
+                failures += 1
+            # back off while the database is unavailable
+            self._stop.wait(min(self._flush_interval * 2 ** failures, self._claim_timeout))
+        _logger.info("Ingest queue flusher stopped")
+
+    def _ensure_flusher(self):
+        if not self.enabled or self._flusher_mode != 'worker':
+            return
+        if self._flusher is not None and self._flusher_pid == os.getpid() and self._flusher.is_alive():
+            return
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self.run, name='ingest-queue-flusher', daemon=True)
+        self._flusher_pid = os.getpid()
+        self._flusher.start()
+
+    def stop(self) -> None:
+        """
+        Stop the flusher thread of this process, if any.
+        """
+        self._stop.set()
+        if self._flusher is not None and self._flusher_pid == os.getpid():
+            self._flusher.join()
+        self._flusher = None
+
+
+ingest_queue = IngestQueue()
+
+
+def add_ingest_queue_cli(app):
+    import click
+    import flask
+    queue_cli = flask.cli.AppGroup('ingest-queue')
+
+    @queue_cli.command('run')
+    def queue_run():
+        """Run the flusher of the ingest queue in the foreground."""
+        if not ingest_queue.enabled:
+            raise click.ClickException("The ingest queue is not enabled (INGEST_QUEUE)")
+        try:
+            ingest_queue.run()
+        except KeyboardInterrupt:
+            pass
+
+    @queue_cli.command('flush')
+    def queue_flush():
+        """Load all the queued records."""
+        if not ingest_queue.enabled:
+            raise click.ClickException("The ingest queue is not enabled (INGEST_QUEUE)")
+        total = 0
+        delay = ingest_queue._flush_interval  # pylint: disable=protected-access
+        while True:
+            n = ingest_queue.flush()
+            total += n
+            if n > 0:
+                continue
+            if ingest_queue.depth() == 0:
+                break
+            # The remaining records are claimed by a flusher:  wait until
+            # it loads them, or its claim expires
+            time.sleep(delay)
+            delay = min(2 * delay, 30)
+        click.echo(f'Loaded {total} records')
+
+    app.cli.add_command(queue_cli)
@@ -3,7 +3,7 @@
 from __future__ import annotations
 
 import logging
-from typing import Any, Dict, Generator, Iterable, List
+from typing import Any, Callable, Dict, Generator, Iterable, List
 
 import psycopg2.errors as pgerrors
 import pyproj
@@ -11,7 +11,8 @@ import shapely.geometry as sg
 from shapely.ops import transform as shapely_transform
 
 import tdmq.db as db
-from .errors import TdmqBadRequestException
+from .downsampling import downsample_batches
+from .errors import DuplicateItemException, TdmqBadRequestException
 from .loc_anonymizer import loc_anonymizer
 
 logger = logging.getLogger(__name__)
@@ -235,59 +236,55 @@ class Source:
 
 
 class Timeseries:
+    # Accepted values of the `on_conflict` argument of the store methods
+    OnConflictModes = frozenset(db.ON_CONFLICT_MODES)
+
+    @staticmethod
+    def check_on_conflict(on_conflict: str) -> None:
+        """
+        Check that records can be stored with `on_conflict`.  See
+        db.check_on_conflict.
+        """
+        db.check_on_conflict(on_conflict)
+
+    @staticmethod
+    def unknown_sources(data: List[dict]) -> List[str]:
+        """
+        The sources (tdmq_id or external id) referenced by the records in
+        `data` that don't exist.
+        """
+        tdmq_ids = { str(r['tdmq_id']) for r in data if 'tdmq_id' in r }
+        external_ids = { r['source'] for r in data if 'tdmq_id' not in r }
+        for tdmq_id, external_id, _, _ in db.get_source_entity_types(tdmq_ids, external_ids):
+            tdmq_ids.discard(str(tdmq_id))
+            external_ids.discard(external_id)
+        return sorted(tdmq_ids) + sorted(external_ids)
+
     @staticmethod
-    def store_new_records(data: Iterable[dict]) -> int:
+    def store_new_records(data: Iterable[dict], on_conflict: str = None) -> int:
+        """
+        Store the records in `data`.  Returns the number of records stored.
+        See db.load_records_conn for `on_conflict`.
+        """
         try:
-            return db.load_records(data)
+            return db.load_records(data, on_conflict=on_conflict)
         except pgerrors.DataError as e:
             raise TdmqBadRequestException(e.pgerror)
+        except pgerrors.UniqueViolation as e:
+            raise DuplicateItemException(e.pgerror)
 
     @staticmethod
-    def _restructure_timeseries(rows: List[list], properties: List[str]) -> Dict[str, Any]:
-        # The arrays time and footprint define the scaffolding on which
-        # the actual data (properties) are defined.
-        result = {'coords': None, 'data': None}
-        transpose = zip(*rows) if len(rows) > 0 else iter([[]] * (2 + len(properties)))
-        result['coords'] = dict((p, next(transpose)) for p in ['time', 'footprint'])
-        result['data'] = dict((p, next(transpose)) for p in properties)
-
-        # remove the arrays that are all None values
-        if len(result['coords']['time']) > 0:
-            if all(x is None for x in result['coords']['footprint']):
-                result['coords']['footprint'] = None
-            for k in [ k for k in result['data'].keys() ]:  # materialize it since we need to change the dict
-                if all(x is None for x in result['data'][k]):
-                    result['data'][k] = None
-
-        return result
-
-    @classmethod
-    def get_one(cls, tdmq_id: str, anonymize_private: bool = True, args: Dict[str, Any] = None) -> Dict[str, Any]:
-        if not args:
-            args = dict()
-
-        db_result = db.get_timeseries(tdmq_id, args)
-
-        struct = cls._restructure_timeseries(db_result['rows'], db_result['properties'])
-        struct["tdmq_id"] = tdmq_id
-        struct["shape"] = db_result['source_info']['shape']
-        if args['bucket']:
-            struct["bucket"] = {
-                "interval": args['bucket'].total_seconds(), "op": args.get("op")}
-        else:
-            struct['bucket'] = None
-
-        # If private data is not to be returned, we erase the mobile footprint
-        # from the result by replacing it with nulls.  Otherwise, we leave
-        # location data in the result: i.e., # the default_footprint and the
-        # timestamped footprint.
-        if anonymize_private and not db_result.get('public'):
-            # pylint: disable=unsubscriptable-object,unsupported-assignment-operation
-            struct["coords"]["footprint"] = None
-        else:
-            struct["default_footprint"] = db_result['source_info']['default_footprint']
-
-        return struct
+    def store_new_record_batches(batches: Iterable[List[dict]], commit_each_batch: bool = False,
+                                 on_batch: Callable[[int], None] = None, on_conflict: str = None) -> List[int]:
+        """
+        Store the records in `batches`.  See db.load_record_batches.
+        """
+        try:
+            return db.load_record_batches(batches, commit_each_batch, on_batch=on_batch, on_conflict=on_conflict)
+        except pgerrors.DataError as e:
+            raise TdmqBadRequestException(e.pgerror)
+        except pgerrors.UniqueViolation as e:
+            raise DuplicateItemException(e.pgerror)
 
     class QueryResult:
         def __init__(self,
@@ -340,17 +337,123 @@ class Timeseries:
                 row_batch = [ (row[0], None, *row[2:]) for row in row_batch ]
             return row_batch
 
+    class JsonQueryResult(QueryResult):
+        """
+        QueryResult whose batches are strings with the JSON representation of
+        the rows, already anonymized by the database.
+        """
+        sparse = False
+
+        def __next__(self):
+            return next(self._db_query_result)
+
+    @staticmethod
+    def _downsample(tdmq_id: str, ts_result: db.TimeseriesResult, args: Dict[str, Any]) -> db.TimeseriesResult:
+        # The downsamplers assign rows to bins by position, so they need the
+        # number of rows before the first one is read.  The rows are
+        # streamed, so the timeseries query can't provide it (a count(*)
+        # OVER () would make the database materialize the whole result);
+        # the summary query instead counts the records on the (source_id,
+        # time) index, at the cost of one more round trip.  Records ingested
+        # in between just end up in the last bin.
+        summary = db.get_timeseries_summary(tdmq_id, args.get('after'), args.get('before'))
+        try:
+            batch_iterator = downsample_batches(
+                ts_result, summary['count'], args['max_points'],
+                len(ts_result.fields) - 2, args.get('method') or 'lttb')
+        except ValueError as e:
+            raise TdmqBadRequestException(str(e))
+
+        return db.TimeseriesResult(
+            source_info=ts_result.source_info,
+            is_public=ts_result.is_public,
+            fields=ts_result.fields,
+            batch_row_iterator=batch_iterator)
+
+    @staticmethod
+    def get_version(tdmq_id: str, after: str = None, before: str = None) -> Dict[str, Any]:
+        """
+        State of the records of the source in [after, before).  See
+        db.get_timeseries_version.
+        """
+        return db.get_timeseries_version(tdmq_id, after, before)
+
+    @staticmethod
+    def get_property_types(tdmq_id: str) -> Dict[str, str]:
+        """
+        JSON schema types of the properties of the source, as declared by the
+        schema of its entity type.  Properties without a single declared
+        type are omitted.
+        """
+        schema = db.get_source_entity_type_schema(tdmq_id)
+        types = dict()
+        for prop, spec in ((schema or {}).get('properties') or {}).items():
+            t = spec.get('type') if isinstance(spec, dict) else None
+            if isinstance(t, list):
+                t = [ x for x in t if x != 'null' ]
+                t = t[0] if len(t) == 1 else None
+            if isinstance(t, str):
+                types[prop] = t
+        return types
+
+    @staticmethod
+    def get_summary(tdmq_id: str, after: str = None, before: str = None,
+                    time_format: str = None) -> Dict[str, Any]:
+        """
+        Number of records of the source in [after, before) and the times of
+        the first and the last one.  None if the source does not exist.  See
+        db.get_timeseries_summary.
+        """
+        if not db.get_sources([tdmq_id]):
+            return None
+        summary = db.get_timeseries_summary(tdmq_id, after, before, time_format)
+        return dict(tdmq_id=tdmq_id, **summary)
+
     @classmethod
     def get_one_by_batch(cls, tdmq_id: str, anonymize_private: bool = True,
                          batch_size: int = None, args: Dict[str, Any] = None) -> Generator[Dict[str, Any]]:
         if not args:
             args = dict()
+        if args.get('max_points') and args.get('bucket'):
+            raise TdmqBadRequestException("Downsampling (max_points) cannot be combined with bucketing")
+
+        db_args = { k: v for k, v in args.items() if k not in ('max_points', 'method') }
+        ts_result = db.get_timeseries_result(tdmq_id, batch_size, **db_args)
 
-        ts_result = db.get_timeseries_result(tdmq_id, batch_size, **args)
+        if args.get('max_points'):
+            ts_result = cls._downsample(tdmq_id, ts_result, args)
 
+        return cls._make_query_result(cls.QueryResult, tdmq_id, anonymize_private, args, ts_result)
+
+    @classmethod
+    def get_one_json_by_batch(cls, tdmq_id: str, anonymize_private: bool = True,
+                              batch_size: int = 2500, args: Dict[str, Any] = None,
+                              sparse: bool = False) -> "Timeseries.JsonQueryResult":
+        """
+        Like get_one_by_batch, but the rows are serialized to JSON by the
+        database (see db.get_timeseries_json_result).  Downsampling is not
+        supported.
+        """
+        if not args:
+            args = dict()
+        if args.get('max_points'):
+            raise TdmqBadRequestException("Downsampling is not supported with database-side JSON serialization")
+
+        ts_result = db.get_timeseries_json_result(tdmq_id, batch_size, sparse, anonymize_private, **args)
+        result = cls._make_query_result(cls.JsonQueryResult, tdmq_id, anonymize_private, args, ts_result)
+        result.sparse = sparse
+        return result
+
+    @staticmethod
+    def _make_query_result(result_class, tdmq_id: str, anonymize_private: bool,
+                           args: Dict[str, Any], ts_result: db.TimeseriesResult):
         if args['bucket']:
             bucket = {
                 "interval": args['bucket'].total_seconds(), "op": args.get("op")}
+            if args.get('ops'):
+                bucket['ops'] = args['ops']
+            if args.get('fill'):
+                bucket['fill'] = args['fill']
         else:
             bucket = None
 
@@ -360,10 +463,9 @@ class Timeseries:
         else:
             default_footprint = None
 
-        result = cls.QueryResult(tdmq_id=tdmq_id,
-                                 shape=ts_result.source_info['shape'],
-                                 bucket=bucket,
-                                 default_footprint=default_footprint,
-                                 db_query_result=ts_result,
-                                 anonymize_private=anonymize_private)
-        return result
+        return result_class(tdmq_id=tdmq_id,
+                            shape=ts_result.source_info['shape'],
+                            bucket=bucket,
+                            default_footprint=default_footprint,
+                            db_query_result=ts_result,
+                            anonymize_private=anonymize_private)
@@ -0,0 +1,161 @@
+"""
+Validation of records against the JSON schema of their entity type.
+
+The `schema` of an entity type (the `entity_type.schema` column) is a JSON
+schema describing the `data` of the records of its sources.  Schemas are
+compiled into validators once per process and reloaded from the database at
+most every RECORD_SCHEMA_REFRESH_INTERVAL seconds:  only the schemas that
+changed are recompiled.  The entity types of the sources are cached and
+refreshed along with the schemas.
+
+Records are validated a whole request (or NDJSON batch) at a time, before
+they are loaded, so that invalid data is rejected before any insert.  The
+error reports the invalid records one by one.  The lookups join the
+transaction in progress, if any, so NDJSON batches can be validated while
+the previous ones are being loaded in the same transaction.
+
+Validation requires the jsonschema package; without it, records are only
+checked for the mandatory fields.
+"""
+
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+import tdmq.db
+from tdmq.errors import RecordValidationError
+
+_logger = logging.getLogger(__name__)
+
+# Maximum number of invalid records reported in an error
+MAX_REPORTED_RECORDS = 100
+# Maximum number of errors reported for each invalid record
+MAX_RECORD_ERRORS = 10
+
+
+def _source_key(record) -> Tuple[str, str]:
+    if 'tdmq_id' in record:
+        return ('tdmq_id', str(record['tdmq_id']))
+    return ('source', record['source'])
+
+
+class RecordValidator:
+    def __init__(self, app=None):
+        self._enabled = False
+        self._refresh_interval = None
+        self._lock = threading.Lock()
+        self.invalidate()
+        if app:
+            self.init_app(app)
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def init_app(self, flask_app):
+        self._enabled = flask_app.config.get('RECORD_SCHEMA_VALIDATION', True)
+        self._refresh_interval = flask_app.config.get('RECORD_SCHEMA_REFRESH_INTERVAL', 60)
+        if self._enabled and jsonschema is None:
+            _logger.warning("The jsonschema package is not available.  Records won't be validated against "
+                            "the schemas of their entity types")
+            self._enabled = False
+        self.invalidate()
+        _logger.info("Record schema validation %s", "enabled" if self._enabled else "disabled")
+
+    def invalidate(self) -> None:
+        """
+        Reload the schemas and the entity types of the sources at the next
+        validation.
+        """
+        with self._lock:
+            # (entity_category, entity_type) -> (schema fingerprint, validator)
+            self._validators: Dict[Tuple[str, str], Tuple[str, object]] = dict()
+            # _source_key -> (entity_category, entity_type)
+            self._source_types: Dict[Tuple[str, str], Tuple[str, str]] = dict()
+            self._loaded_at = None
+
+    @staticmethod
+    def _compile(entity_type, schema) -> Optional[object]:
+        cls = jsonschema.validators.validator_for(schema)
+        try:
+            cls.check_schema(schema)
+        except jsonschema.SchemaError as e:
+            _logger.error("Ignoring invalid schema of entity type %s/%s: %s", *entity_type, e.message)
+            return None
+        _logger.debug("Compiled schema of entity type %s/%s", *entity_type)
+        return cls(schema)
+
+    def _refresh(self) -> None:
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self._refresh_interval:
+            return
+        validators = dict()
+        for category, etype, schema in tdmq.db.get_entity_type_schemas():
+            if schema is None:
+                continue
+            entity_type = (category, etype)
+            fingerprint = json.dumps(schema, sort_keys=True)
+            cached = self._validators.get(entity_type)
+            if cached is not None and cached[0] == fingerprint:
+                validators[entity_type] = cached
+            else:
+                validators[entity_type] = (fingerprint, self._compile(entity_type, schema))
+        self._validators = validators
+        self._source_types = dict()
+        self._loaded_at = now
+
+    def _entity_types(self, records) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        missing = { _source_key(r) for r in records } - self._source_types.keys()
+        if missing:
+            tdmq_ids = [ v for k, v in missing if k == 'tdmq_id' ]
+            external_ids = [ v for k, v in missing if k == 'source' ]
+            for tdmq_id, external_id, category, etype in tdmq.db.get_source_entity_types(tdmq_ids, external_ids):
+                self._source_types[('tdmq_id', str(tdmq_id))] = (category, etype)
+                self._source_types[('source', external_id)] = (category, etype)
+        return self._source_types
+
+    def validate(self, records: List[Dict], offset: int = 0) -> None:
+        """
+        Validate the `data` of `records` against the schemas of the entity
+        types of their sources.  Raises RecordValidationError, reporting the
+        invalid records by their position (plus `offset`), if any is invalid.
+        Records of unknown sources are not validated.
+        """
+        if not self._enabled or not records:
+            return
+        with self._lock:
+            self._refresh()
+            if not any(v for _, v in self._validators.values()):
+                return
+            source_types = self._entity_types(records)
+            validators = self._validators
+
+        reports = []
+        for i, record in enumerate(records):
+            _, validator = validators.get(source_types.get(_source_key(record)), (None, None))
+            if validator is None:
+                continue
+            errors = [ (f"{'/'.join(str(p) for p in e.absolute_path)}: " if e.absolute_path else '') + e.message
+                       for e in validator.iter_errors(record['data']) ]
+            if errors:
+                reports.append({
+                    "record": offset + i,
+                    "source": record.get('source', record.get('tdmq_id')),
+                    "errors": errors[:MAX_RECORD_ERRORS]})
+                if len(reports) >= MAX_REPORTED_RECORDS:
+                    break
+
+        if reports:
+            raise RecordValidationError(
+                f"{len(reports)}{'+' if len(reports) >= MAX_REPORTED_RECORDS else ''} records don't conform "
+                "to the schema of their entity type", reports)
+
+
+record_validator = RecordValidator()
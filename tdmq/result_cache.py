@@ -0,0 +1,356 @@
+"""
+Server-side cache of bucketed timeseries results.
+
+Dashboards tend to poll the same bucketed queries over and over.  The
+results of these queries are cached, keyed on the normalized query
+arguments, and invalidated only when records that fall in the cached time
+range of the source are loaded (see `ResultCache.invalidate`, called by
+`tdmq.db.load_records_conn`).
+
+Queries whose interval is open -- i.e., without `before` or with `before` in
+the future -- are cached too:  on a hit, only the buckets starting from the
+last cached one are recomputed, since new records can only change those.
+Gap-filled queries on open intervals are not cached.
+
+The rows of a query are streamed as they are read from the database, while
+they are collected for the cache:  results with more than
+RESULT_CACHE_MAX_ROWS rows, or larger than RESULT_CACHE_MAX_ENTRY_SIZE bytes
+(pickled), are not cached, so cache hits only hold small results in memory.
+
+Backends, selected by the RESULT_CACHE configuration value:
+  * 'memory':  an LRU dictionary private to each process.  Only the
+               records loaded through the same process invalidate its
+               entries, so use it with a single worker;
+  * 'sqlite:///path/to/cache.db':  a SQLite database, which can be shared
+               by the worker processes on the same host.
+"""
+
+import json
+import logging
+import math
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+SQLITE_PREFIX = 'sqlite:///'
+
+
+class CacheEntry(NamedTuple):
+    tdmq_id: str
+    # Records in [start, end) are covered by the entry:  loading records in
+    # this interval invalidates it.  For open entries, `end` is the start of
+    # the last cached bucket, which is recomputed at every hit.
+    start: float
+    end: float
+    is_open: bool
+    rows: List[Tuple]
+
+
+def to_epoch(t) -> Optional[float]:
+    """
+    Convert a timestamp (ISO string, datetime or seconds since the epoch)
+    to seconds since the epoch.  Naive timestamps are taken to be UTC.
+    """
+    if t is None:
+        return None
+    if isinstance(t, (int, float)):
+        return float(t)
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t.strip().replace('Z', '+00:00'))
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.timestamp()
+
+
+def _iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+def _normalize_arg(value):
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, datetime):
+        return to_epoch(value)
+    if isinstance(value, (list, tuple)):
+        return [ _normalize_arg(v) for v in value ]
+    return value
+
+
+def make_key(tdmq_id, args: Dict[str, Any]) -> str:
+    normalized = dict()
+    for k, v in args.items():
+        if v in (None, '', []):
+            continue
+        if k in ('after', 'before') and isinstance(v, str):
+            # The same instant can be written in many ways
+            try:
+                v = to_epoch(v)
+            except ValueError:
+                pass
+        normalized[k] = _normalize_arg(v)
+    return json.dumps([str(tdmq_id), normalized], sort_keys=True)
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()  # key -> CacheEntry
+        self._generations = dict()     # tdmq_id -> number of invalidations
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def generation(self, tdmq_id: str) -> int:
+        with self._lock:
+            return self._generations.get(tdmq_id, 0)
+
+    def put(self, key: str, entry: CacheEntry, generation: int) -> None:
+        with self._lock:
+            if self._generations.get(entry.tdmq_id, 0) != generation:
+                return  # invalidated while the query was running
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tdmq_id: str, t_min: float, t_max: float) -> int:
+        with self._lock:
+            self._generations[tdmq_id] = self._generations.get(tdmq_id, 0) + 1
+            stale = [ k for k, e in self._entries.items()
+                      if e.tdmq_id == tdmq_id and e.start <= t_max and t_min < e.end ]
+            for k in stale:
+                del self._entries[k]
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend:
+    """
+    Entries are evicted in insertion order when there are more than
+    `max_entries`.
+    """
+    def __init__(self, path: str, max_entries: int):
+        self._path = path
+        self._max_entries = max_entries
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    key TEXT PRIMARY KEY,
+                    source_id TEXT NOT NULL,
+                    start_time REAL NOT NULL,
+                    end_time REAL NOT NULL,
+                    is_open INTEGER NOT NULL,
+                    rows BLOB NOT NULL,
+                    stored REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS result_cache_source_idx ON result_cache (source_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache_generation (
+                    source_id TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL)""")
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared by threads, nor inherited by forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        row = self._connection().execute(
+            "SELECT source_id, start_time, end_time, is_open, rows FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(row[0], row[1], row[2], bool(row[3]), pickle.loads(row[4]))
+
+    @staticmethod
+    def _generation(conn, tdmq_id: str) -> int:
+        row = conn.execute(
+            "SELECT generation FROM result_cache_generation WHERE source_id = ?", (tdmq_id,)).fetchone()
+        return row[0] if row else 0
+
+    def generation(self, tdmq_id: str) -> int:
+        return self._generation(self._connection(), tdmq_id)
+
+    def put(self, key: str, entry: CacheEntry, generation: int) -> None:
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if self._generation(conn, entry.tdmq_id) != generation:
+                return  # invalidated while the query was running
+            conn.execute(
+                "INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, entry.tdmq_id, entry.start, entry.end, int(entry.is_open),
+                 pickle.dumps(entry.rows, pickle.HIGHEST_PROTOCOL), time.time()))
+            conn.execute("""
+                DELETE FROM result_cache WHERE key IN (
+                    SELECT key FROM result_cache ORDER BY stored DESC LIMIT -1 OFFSET ?)""",
+                         (self._max_entries,))
+
+    def invalidate(self, tdmq_id: str, t_min: float, t_max: float) -> int:
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO result_cache_generation (source_id, generation) VALUES (?, 1)
+                ON CONFLICT (source_id) DO UPDATE SET generation = generation + 1""", (tdmq_id,))
+            cursor = conn.execute(
+                "DELETE FROM result_cache WHERE source_id = ? AND start_time <= ? AND ? < end_time",
+                (tdmq_id, t_max, t_min))
+            return cursor.rowcount
+
+    def clear(self) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM result_cache")
+
+
+class ResultCache:
+    def __init__(self, app=None):
+        self._backend = None
+        self._max_rows = None
+        self._max_entry_size = None
+        if app:
+            self.init_app(app)
+
+    @property
+    def enabled(self) -> bool:
+        return self._backend is not None
+
+    def init_app(self, flask_app):
+        setting = flask_app.config.get('RESULT_CACHE')
+        max_entries = flask_app.config.get('RESULT_CACHE_MAX_ENTRIES', 1024)
+        self._max_rows = flask_app.config.get('RESULT_CACHE_MAX_ROWS', 100000)
+        self._max_entry_size = flask_app.config.get('RESULT_CACHE_MAX_ENTRY_SIZE', 2 * 1024 * 1024)
+        if not setting:
+            self._backend = None
+            _logger.info("Result cache disabled")
+        elif setting == 'memory':
+            self._backend = MemoryBackend(max_entries)
+            _logger.info("Using in-memory result cache")
+        elif setting.startswith(SQLITE_PREFIX):
+            path = setting[len(SQLITE_PREFIX):]
+            self._backend = SQLiteBackend(path, max_entries)
+            _logger.info("Using SQLite result cache %s", path)
+        else:
+            raise ValueError(f"Invalid RESULT_CACHE value '{setting}'")
+
+    def fetch(self, tdmq_id, args: Dict[str, Any],
+              run_query: Callable[[Dict[str, Any]], Iterable[Tuple]], time_scale: int = 1) -> List[Tuple]:
+        """
+        Return the rows of the bucketed timeseries query for source `tdmq_id`
+        with `args`, as a list.  See `fetch_iter`.
+        """
+        return list(self.fetch_iter(tdmq_id, args, run_query, time_scale))
+
+    def fetch_iter(self, tdmq_id, args: Dict[str, Any],
+                   run_query: Callable[[Dict[str, Any]], Iterable[Tuple]], time_scale: int = 1) -> Iterator[Tuple]:
+        """
+        Generator of the rows of the bucketed timeseries query for source
+        `tdmq_id` with `args`.  `run_query(args)` runs the query on the
+        database and returns (or streams) its rows:  it is called on a miss
+        or, for open intervals, to recompute the last bucket.  The rows must
+        be ordered by time, the first column being the start of the bucket in
+        seconds since the epoch multiplied by `time_scale`.
+
+        The rows read from the database are yielded as they arrive.  The
+        result is cached once all of it has been read, if it's small enough.
+        """
+        tdmq_id = str(tdmq_id)
+        start = to_epoch(args.get('after'))
+        start = -math.inf if start is None else start
+        before = to_epoch(args.get('before'))
+        is_open = before is None or before > time.time()
+        if is_open and args.get('fill'):
+            yield from run_query(args)
+            return
+
+        key = make_key(tdmq_id, args)
+        generation = self._backend.generation(tdmq_id)
+        entry = self._backend.get(key)
+        if entry is None:
+            _logger.debug("Result cache miss for %s", key)
+            rows, query_rows = [], run_query(args)
+        elif not entry.is_open:
+            _logger.debug("Result cache hit for %s", key)
+            yield from entry.rows
+            return
+        else:
+            _logger.debug("Result cache hit for %s.  Recomputing buckets from %s", key, entry.end)
+            rows = [ r for r in entry.rows if float(r[0]) / time_scale < entry.end ]
+            yield from rows
+            query_rows = run_query(dict(args, after=_iso(max(start, entry.end))))
+
+        cacheable = True
+        for row in query_rows:
+            if cacheable:
+                if len(rows) < self._max_rows:
+                    rows.append(row)
+                else:
+                    cacheable, rows = False, None
+            yield row
+
+        if cacheable and rows and self._entry_size(rows) <= self._max_entry_size:
+            end = float(rows[-1][0]) / time_scale if is_open else before
+            self._backend.put(key, CacheEntry(tdmq_id, start, end, is_open, rows), generation)
+
+    @staticmethod
+    def _entry_size(rows: List[Tuple]) -> int:
+        return len(pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def time_ranges(source_times: Iterable[Tuple[Any, Any]],
+                    ranges: Dict[str, Tuple[float, float]] = None) -> Dict[str, Tuple[float, float]]:
+        """
+        Compute, for each source, the interval spanned by the (tdmq_id, time)
+        pairs in `source_times`, extending the intervals in `ranges` if given.
+        """
+        ranges = dict() if ranges is None else ranges
+        for tdmq_id, t in source_times:
+            try:
+                t = to_epoch(t)
+            except (TypeError, ValueError):
+                t_min, t_max = -math.inf, math.inf
+            else:
+                t_min, t_max = t, t
+            tdmq_id = str(tdmq_id)
+            if tdmq_id in ranges:
+                t_min, t_max = min(t_min, ranges[tdmq_id][0]), max(t_max, ranges[tdmq_id][1])
+            ranges[tdmq_id] = (t_min, t_max)
+        return ranges
+
+    def invalidate(self, source_times: Iterable[Tuple[Any, Any]]) -> None:
+        """
+        Invalidate the entries affected by records loaded at the given
+        (tdmq_id, time) pairs.
+        """
+        self.invalidate_ranges(self.time_ranges(source_times))
+
+    def invalidate_ranges(self, ranges: Dict[str, Tuple[float, float]]) -> None:
+        """
+        Invalidate the entries affected by records loaded in the given
+        intervals, as computed by `time_ranges`.
+        """
+        for tdmq_id, (t_min, t_max) in ranges.items():
+            n = self._backend.invalidate(tdmq_id, t_min, t_max)
+            if n:
+                _logger.debug("Invalidated %s cached results for source %s", n, tdmq_id)
+
+    def clear(self) -> None:
+        self._backend.clear()
+
+
+result_cache = ResultCache()
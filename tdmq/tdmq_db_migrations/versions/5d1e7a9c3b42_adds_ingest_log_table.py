@@ -0,0 +1,39 @@
+"""Adds ingest_log table
+
+The table records, for each source and day of data, when records were last
+ingested.  It's used to compute cheap cache validators for timeseries queries.
+The days of the existing records are marked as ingested at the time of the
+migration, so that their timeseries get a version and a Last-Modified time.
+
+Revision ID: 5d1e7a9c3b42
+Revises: cc88f3768771
+Create Date: 2026-10-18 10:12:31.102934
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1e7a9c3b42'
+down_revision = 'cc88f3768771'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE TABLE ingest_log (
+            source_id UUID NOT NULL REFERENCES source(tdmq_id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            last_ingest TIMESTAMP NOT NULL DEFAULT (clock_timestamp() AT TIME ZONE 'UTC'),
+            PRIMARY KEY (source_id, day)
+        );""")
+    op.execute("""
+        INSERT INTO ingest_log (source_id, day, last_ingest)
+        SELECT source_id, time::date, now() AT TIME ZONE 'UTC'
+        FROM record
+        GROUP BY 1, 2;""")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS ingest_log;")
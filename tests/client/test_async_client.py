@@ -0,0 +1,140 @@
+
+import asyncio
+import http.server
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+from tdmq.errors import TdmqError
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from tdmq.client.async_client import AsyncClient  # noqa: E402
+
+N_SOURCES = 8
+
+
+def _source(i):
+    return {
+        "tdmq_id": f"00000000-0000-0000-0000-00000000000{i}",
+        "external_id": f"s{i}",
+        "entity_category": "Station",
+        "entity_type": "WeatherObserver",
+        "default_footprint": {"type": "Point", "coordinates": [9.2, 30.0]},
+        "stationary": True,
+        "public": True,
+        "description": {"controlledProperties": ["temperature"], "shape": []},
+    }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Minimal TDMq service.  Replies 503 to the first `failures` requests and
+    tracks the maximum number of concurrent requests.
+    """
+    failures = 0
+    delay = 0
+    active = 0
+    max_active = 0
+    posts = []
+    lock = threading.Lock()
+
+    def _send(self, status, obj=None):
+        body = json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            failed = cls.failures > 0
+            cls.failures -= failed
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(cls.delay)
+            if failed:
+                return self._send(503)
+            url = urlparse(self.path)
+            path = url.path.split('/')[3:]  # skip /api/v0.0
+            if self.command == 'POST':
+                cls.posts.append((json.loads(body), parse_qs(url.query)))
+                return self._send(200, {'loaded': 1, 'skipped': 0})
+            if path == ['service_info']:
+                return self._send(200, {'version': '0.1'})
+            if path == ['entity_types']:
+                return self._send(200, {'entity_types': [{
+                    'entity_category': 'Station', 'entity_type': 'WeatherObserver',
+                    'schema': {'properties': {'temperature': {'type': 'number'}}}}]})
+            if path == ['sources']:
+                return self._send(200, [ _source(i) for i in range(N_SOURCES) ])
+            if path[0] == 'sources' and path[2:] == ['timeseries_stream']:
+                i = int(path[1][-1])
+                return self._send(200, {
+                    'source_id': path[1], 'orient': 'columns', 'time_format': 'epoch_us', 'sparse': False,
+                    'fields': ['time', 'footprint', 'temperature'],
+                    'items': {'time': [0, 1000000], 'footprint': [None, None], 'temperature': [i, i + 0.5]}})
+            return self._send(404)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def service():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.protocol_version = _Handler.protocol_version = 'HTTP/1.1'
+    _Handler.failures, _Handler.delay, _Handler.max_active, _Handler.posts = 0, 0, 0, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/api/v0.0'
+    server.shutdown()
+    server.server_close()
+
+
+def test_gather_timeseries(service):
+    async def run():
+        async with AsyncClient(service, use_arrow=False, max_concurrency=3) as client:
+            sources = await client.find_sources(entity_type='WeatherObserver')
+            assert [ s.id for s in sources ] == [ f's{i}' for i in range(N_SOURCES) ]
+            _Handler.delay = 0.05
+            return await client.gather_timeseries(sources, properties=['temperature'])
+
+    series = asyncio.run(run())
+    assert len(series) == N_SOURCES
+    for i, ts in enumerate(series):
+        assert ts.source.id == f's{i}'
+        assert ts.series['temperature'].dtype == np.float64
+        assert list(ts.series['temperature']) == [i, i + 0.5]
+        assert ts.time[1] - ts.time[0] == np.timedelta64(1, 's')
+    assert 1 < _Handler.max_active <= 3
+
+
+def test_retries(service):
+    async def run():
+        async with AsyncClient(service, use_arrow=False, backoff_factor=0.01) as client:
+            _Handler.failures = 2
+            await client.connect()
+            assert client.connected
+
+            # POSTs are not retried
+            _Handler.failures = 1
+            with pytest.raises(TdmqError):
+                await client.add_records([{'source': 's0'}])
+            assert _Handler.posts == []
+            return await client.add_records([{'source': 's0'}], on_conflict='ignore')
+
+    assert asyncio.run(run()) == {'loaded': 1, 'skipped': 0}
+    assert _Handler.posts == [([{'source': 's0'}], {'on_conflict': ['ignore']})]
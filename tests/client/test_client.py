@@ -1,10 +1,13 @@
 
+import http.server
+import json
+import threading
 
 import pytest
 
 from pytest_mock import MockerFixture
 from tdmq.client import Client
-from tdmq.errors import UnauthorizedError
+from tdmq.errors import TdmqError, UnauthorizedError
 
 
 def test_strip_trailing_slash_from_url():
@@ -20,7 +23,7 @@ def test_unauthorized(mocker: MockerFixture) -> None:
         status_code=403,
         reason="Unauthorized",
         headers={"Server": "nginx"})
-    p = mocker.patch("requests.get", autospec=True)
+    p = mocker.patch("requests.Session.get", autospec=True)
     p.return_value = mock_api_response
     c = Client()
     with pytest.raises(UnauthorizedError) as exc_info:
@@ -29,6 +32,58 @@ def test_unauthorized(mocker: MockerFixture) -> None:
     assert "please get an authentication token from" in exc_info.value.detail.lower()
 
 
+class _FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Replies 503 to the first `failures` requests, then 200.
+    """
+    failures = 0
+    requests = []
+
+    def _reply(self):
+        type(self).requests.append(self.command)
+        if type(self).failures > 0:
+            type(self).failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.command == 'POST':
+            self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'loaded': 0}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def test_session_retries():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _FlakyHandler)
+    server.protocol_version = _FlakyHandler.protocol_version = 'HTTP/1.1'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        c = Client(f'http://127.0.0.1:{server.server_port}', backoff_factor=0.01)
+        c.connected = True
+        _FlakyHandler.failures = 2
+        assert c._do_get('entity_types') == {'loaded': 0}
+        assert len(_FlakyHandler.requests) == 3
+
+        # POSTs are not retried
+        _FlakyHandler.failures, _FlakyHandler.requests = 1, []
+        with pytest.raises(TdmqError):
+            c.add_records([])
+        assert len(_FlakyHandler.requests) == 1
+        c.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def test_connect(clean_storage, live_app):
     c = Client(live_app.url())
     assert not c.connected
@@ -95,6 +150,32 @@ def test_find_source_only_public(clean_storage, db_data, live_app):
     assert len(sources) > n_public_sources
 
 
+def test_export_sources(clean_storage, db_data, live_app, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    c = Client(live_app.url())
+    n_public_sources = len(c.find_sources())
+    path = str(tmp_path / "sources.parquet")
+    c.export_sources(path)
+    table = pq.read_table(path)
+    assert table.num_rows == n_public_sources
+    assert 'tdmq_id' in table.column_names
+
+
+def test_timeseries_conditional_requests(clean_storage, db_data, live_app):
+    c = Client(live_app.url(), use_arrow=False, timeseries_cache_size=4)
+    s = c.find_sources(args={'id': 'tdm/sensor_0'})[0]
+    args = {'after': '2019-05-02T00:00:00Z', 'before': '2019-05-03T00:00:00Z'}
+    first = c.get_timeseries(s.tdmq_id, args)
+    assert len(c._timeseries_cache) == 1
+    # the service replies 304 and the cached response is returned
+    assert c.get_timeseries(s.tdmq_id, dict(args)) is first
+
+    # disabled by default
+    c = Client(live_app.url(), use_arrow=False)
+    c.get_timeseries(s.tdmq_id, args)
+    assert not c._timeseries_cache
+
+
 def test_find_source_not_anonymized(clean_storage, db_data, live_app):
     c = Client(live_app.url(), auth_token=live_app.auth_token)
     sources = c.find_sources(args={'public': False, 'anonymized': False})
@@ -0,0 +1,124 @@
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from tdmq.client import Client
+from tdmq.client.disk_cache import TimeseriesDiskCache
+from tdmq.client.timeseries import ScalarTimeSeries
+
+BASE = datetime(2021, 1, 4, tzinfo=timezone.utc)
+
+
+def _us(t):
+    return (t - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1)
+
+
+def _parse(t):
+    if isinstance(t, str):
+        return datetime.strptime(t, Client.TDMQ_DT_FMT).replace(tzinfo=timezone.utc)
+    return t
+
+
+class _Source:
+    """
+    Fake scalar source with a record every second, answering the
+    timeseries queries itself.  Records the intervals requested.
+    """
+    tdmq_id = '6cb10168-c65b-48fa-af9b-a3ca6d03156d'
+    is_stationary = True
+    property_types = {'value': 'number'}
+
+    def __init__(self, cache_dir, n_records):
+        self.client = self
+        self.use_arrow = False
+        self.timeseries_disk_cache = TimeseriesDiskCache(cache_dir, 'http://test')
+        self.times = [ BASE + timedelta(seconds=i) for i in range(n_records) ]
+        self.requests = []
+
+    _format_timestamp = Client._format_timestamp
+
+    def get_latest_source_activity(self, tdmq_id):
+        return {'time': self.times[-1] if self.times else None}
+
+    def get_timeseries(self, args, sparse=None):
+        after, before = (_parse(args[k]) for k in ('after', 'before'))
+        self.requests.append((after, before))
+        times = [ _us(t) for t in self.times if (after is None or t >= after) and (before is None or t < before) ]
+        values = [ t // 1_000_000 % 1000 for t in times ]
+        if args['bucket']:
+            width = args['bucket'] * 1_000_000
+            buckets = dict()
+            for t, v in zip(times, values):
+                buckets.setdefault(t - t % width, []).append(v)
+            times, values = list(buckets), [ sum(v) for v in buckets.values() ]
+        return {'fields': ['time', 'footprint', 'value'], 'orient': 'columns', 'time_format': 'epoch_us',
+                'items': {'time': times, 'footprint': [None] * len(times), 'value': values}}
+
+    def timeseries(self, after=None, before=None, bucket=None, op=None):
+        ts = ScalarTimeSeries(self, after, before, bucket, op)
+        ts._ensure_fetched()
+        return ts
+
+    def remote(self, after=None, before=None, bucket=None, op=None):
+        ts = ScalarTimeSeries(self, after, before, bucket, op)
+        ts._fetch_remote()
+        return ts
+
+
+def _assert_equal(ts, expected):
+    assert np.array_equal(ts.time, expected.time)
+    assert np.array_equal(ts.series['value'], expected.series['value'])
+
+
+def test_incremental_top_up(tmp_path):
+    source = _Source(str(tmp_path), 100)
+    middle = BASE + timedelta(seconds=50)
+    _assert_equal(source.timeseries(middle), source.remote(middle))
+    assert source.requests.pop(0) == (middle, None)
+    source.requests.clear()
+
+    # only the uncovered intervals are requested:  the head and the newest tail
+    _assert_equal(source.timeseries(), source.remote())
+    assert source.requests[:2] == [(None, middle), (source.times[-1] + timedelta(microseconds=1), None)]
+    source.requests.clear()
+
+    source.times += [ source.times[-1] + timedelta(seconds=i) for i in range(1, 11) ]
+    ts = source.timeseries()
+    assert len(ts.time) == 110
+    _assert_equal(ts, source.remote())
+    source.requests.clear()
+
+    # covered intervals aren't requested
+    _assert_equal(source.timeseries(BASE + timedelta(seconds=20), BASE + timedelta(seconds=30)),
+                  source.remote(BASE + timedelta(seconds=20), BASE + timedelta(seconds=30)))
+    assert len(source.requests) == 1
+    # the segments are merged
+    manifests = list(tmp_path.glob('*/*/manifest.json'))
+    assert len(manifests) == 1 and len(list(manifests[0].parent.glob('*.npz'))) == 1
+
+
+def test_invalidation(tmp_path):
+    source = _Source(str(tmp_path), 50)
+    source.timeseries()
+    # records deleted:  the latest activity moved back
+    source.times = source.times[:10]
+    source.requests.clear()
+    ts = source.timeseries()
+    assert len(ts.time) == 10
+    assert source.requests[0] == (None, None)
+
+
+def test_buckets(tmp_path):
+    source = _Source(str(tmp_path), 95)
+    after, before = BASE + timedelta(seconds=5), BASE + timedelta(seconds=200)
+    ts = source.timeseries(after, before, bucket=10, op='sum')
+    # widened to whole buckets
+    _assert_equal(ts, source.remote(BASE, before, bucket=10, op='sum'))
+    source.requests.clear()
+
+    # the last bucket, still filling up, isn't cached
+    source.times += [ source.times[-1] + timedelta(seconds=i) for i in range(1, 11) ]
+    ts = source.timeseries(after, before, bucket=10, op='sum')
+    assert source.requests[0][0] == BASE + timedelta(seconds=90)
+    _assert_equal(ts, source.remote(BASE, before, bucket=10, op='sum'))
@@ -0,0 +1,50 @@
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from tdmq.client import frames
+from tdmq.client.timeseries import NoneArray
+
+
+def _series(source_id, seconds, **series):
+    times = np.array(seconds, dtype='datetime64[s]').astype('datetime64[us]')
+    return SimpleNamespace(source=SimpleNamespace(id=source_id, tdmq_id=None), time=times, series=series)
+
+
+def _all_series():
+    return [
+        _series('s1', [0, 20], temperature=np.array([1, 3]), label=np.array(['a', 'c'])),
+        _series('s2', [10, 30], temperature=np.array([2.5, None], dtype=object), label=NoneArray(2)),
+    ]
+
+
+def test_align():
+    times, columns = frames.align(_all_series(), bucket=5)
+    assert len(times) == 7 and np.all(np.diff(times) == np.timedelta64(5, 's'))
+    assert columns['temperature'].dtype == np.float64
+    assert np.array_equal(columns['temperature'],
+                          [[1, np.nan, np.nan, np.nan, 3, np.nan, np.nan],
+                           [np.nan, np.nan, 2.5, np.nan, np.nan, np.nan, np.nan]], equal_nan=True)
+    assert columns['label'].dtype == object
+    assert list(columns['label'][0]) == ['a', None, None, None, 'c', None, None]
+    assert all(v is None for v in columns['label'][1])
+
+    # without a bucket, the union of the timestamps
+    times, _ = frames.align(_all_series())
+    assert len(times) == 4
+
+
+def test_to_dataframe_and_dataset():
+    pytest.importorskip('pandas')
+    df = frames.to_dataframe(_all_series())
+    assert df.index.names == ['source', 'time']
+    assert df.shape == (8, 2)
+    assert df.loc['s2']['temperature'].iloc[1] == 2.5
+
+    pytest.importorskip('xarray')
+    ds = frames.to_dataset(_all_series(), bucket=10)
+    assert dict(ds.sizes) == {'source': 2, 'time': 4}
+    assert list(ds['source'].values) == ['s1', 's2']
+    assert ds['temperature'].sel(source='s1').values[2] == 3
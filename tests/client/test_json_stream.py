@@ -0,0 +1,84 @@
+
+import json
+
+import numpy as np
+import pytest
+
+from tdmq.client.json_stream import ColumnBuffer, parse_timeseries
+from tdmq.client.timeseries import NoneArray
+
+FIELDS = ['time', 'footprint', 'temperature', 'count', 'label', 'ok', 'CO']
+
+ROWS = [
+    [1556794800000000, None, 20.5, 1, 'a, [b]', True, None],
+    [1556794801000000, {'type': 'Point', 'coordinates': [9.2, 30.0]}, None, 2, 'città', False, None],
+    [1556794802000000, None, 21, 3, None, True, None],
+]
+
+
+def _response(orient='rows', sparse=False):
+    if orient == 'columns':
+        items = { f: [ row[i] for row in ROWS ] for i, f in enumerate(FIELDS) }
+    elif sparse:
+        items = [ { f: v for f, v in zip(FIELDS, row) if v is not None } for row in ROWS ]
+    else:
+        items = ROWS
+    response = {'tdmq_id': 'x', 'shape': [], 'bucket': None, 'fields': FIELDS, 'sparse': sparse,
+                'time_format': 'epoch_us', 'items': items}
+    if orient == 'columns':
+        response['orient'] = orient
+    return json.dumps(response, indent=1).encode('utf-8')
+
+
+def _chunks(body, size):
+    return [ body[i:i + size] for i in range(0, len(body), size) ]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+def test_parse_columns(chunk_size):
+    res = parse_timeseries(_chunks(_response('columns'), chunk_size))
+    assert res['orient'] == 'columns' and res['fields'] == FIELDS and res['bucket'] is None
+    items = res['items']
+    assert items['time'].dtype == np.int64 and items['time'][-1] == ROWS[-1][0]
+    assert items['temperature'].dtype == np.float64
+    assert np.array_equal(items['temperature'], [20.5, np.nan, 21], equal_nan=True)
+    assert items['count'].dtype == np.int64 and list(items['count']) == [1, 2, 3]
+    assert items['ok'].dtype == np.bool_
+    assert list(items['label']) == ['a, [b]', 'città', None]
+    assert list(items['footprint']) == [ row[1] for row in ROWS ]
+    assert isinstance(items['CO'], NoneArray) and len(items['CO']) == 3
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_parse_rows(sparse):
+    body = _response(sparse=sparse)
+    # not transposed:  as json.loads
+    assert parse_timeseries(_chunks(body, 5)) == json.loads(body)
+
+    res = parse_timeseries(_chunks(body, 5), columns=True)
+    assert res['orient'] == 'columns'
+    assert list(res['items']) == FIELDS
+    assert list(res['items']['count']) == [1, 2, 3]
+    assert isinstance(res['items']['CO'], NoneArray)
+
+
+def test_truncated():
+    body = _response('columns')
+    with pytest.raises(ValueError):
+        parse_timeseries([body[:-10]])
+
+
+def test_column_buffer_promotion():
+    buffer = ColumnBuffer()
+    buffer.extend([None, None])
+    buffer.extend(list(range(2000)))
+    assert buffer._kind == 'f'
+    buffer.extend(['x'])
+    array = buffer.finish()
+    assert array.dtype == object and len(array) == 2003
+    assert array[0] is None and array[2] == 0 and array[-1] == 'x'
+
+    buffer = ColumnBuffer()
+    buffer.extend([1, 2])
+    buffer.extend([2**64])
+    assert list(buffer.finish()) == [1, 2, 2**64]
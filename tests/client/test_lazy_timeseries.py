@@ -0,0 +1,120 @@
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+from tdmq.client import Client
+from tdmq.client.timeseries import ScalarTimeSeries
+
+BASE = datetime(2021, 1, 4, tzinfo=timezone.utc)
+
+
+def _parse(t):
+    if isinstance(t, str):
+        return datetime.strptime(t, Client.TDMQ_DT_FMT).replace(tzinfo=timezone.utc)
+    return t
+
+
+class _Source:
+    """
+    Fake scalar source with irregularly spaced records (some sharing their
+    timestamp), answering the summary and timeseries queries itself.
+    Records the rows returned by each timeseries request.
+    """
+    tdmq_id = '6cb10168-c65b-48fa-af9b-a3ca6d03156d'
+    is_stationary = True
+    property_types = {'value': 'number'}
+    timeseries_disk_cache = None
+
+    def __init__(self, n_records, seed=1):
+        rnd = random.Random(seed)
+        self.client = self
+        self.use_arrow = False
+        self.times, t = [], BASE
+        for _ in range(n_records):
+            t += timedelta(seconds=rnd.choice([0, 1, 1, 2, 60, 3600]))
+            self.times.append(t)
+        self.summaries = 0
+        self.fetched = []
+
+    _format_timestamp = Client._format_timestamp
+
+    def _select(self, after, before):
+        after, before = _parse(after), _parse(before)
+        return [ (i, t) for i, t in enumerate(self.times)
+                 if (after is None or t >= after) and (before is None or t < before) ]
+
+    def get_timeseries_summary(self, tdmq_id, after=None, before=None):
+        self.summaries += 1
+        rows = self._select(after, before)
+        return {'count': len(rows),
+                'first': rows[0][1] if rows else None,
+                'last': rows[-1][1] if rows else None}
+
+    def get_timeseries(self, args, sparse=None):
+        rows = self._select(args['after'], args['before'])
+        self.fetched.append(len(rows))
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        times = [ (t - epoch) // timedelta(microseconds=1) for _, t in rows ]
+        return {'fields': ['time', 'footprint', 'value'], 'orient': 'columns', 'time_format': 'epoch_us',
+                'items': {'time': times, 'footprint': [None] * len(rows), 'value': [ i for i, _ in rows ]}}
+
+
+def _eager(source, after=None, before=None):
+    ts = ScalarTimeSeries(source, after, before, None, None)
+    ts._ensure_fetched()
+    return ts
+
+
+@pytest.mark.parametrize('index', [
+    slice(-100, None), slice(0, 10), slice(1234, 1300), slice(None, None, 500),
+    slice(-1, -20, -3), slice(3000, 2000), slice(None, 0), 0, 1500, -1])
+def test_lazy_slices(index):
+    source = _Source(3000)
+    expected = _eager(source)[index]
+    source.fetched.clear()
+
+    ts = ScalarTimeSeries(source, None, None, None, None, lazy=True)
+    assert len(ts) == 3000
+    times, series = ts[index]
+    assert np.array_equal(times, expected[0])
+    assert np.array_equal(series['value'], expected[1]['value'])
+    assert ts._time is None  # the whole series was not fetched
+    if isinstance(index, slice) and index.step is None:
+        # only a window a little larger than the slice is fetched
+        assert source.fetched[0] <= len(range(*index.indices(3000))) + 2 * ts.MIN_WINDOW_MARGIN
+
+
+def test_lazy_tail_is_cheap():
+    source = _Source(20000)
+    ts = ScalarTimeSeries(source, BASE + timedelta(seconds=30), None, None, None, lazy=True)
+    n = len(ts)
+    _, series = ts[-100:]
+    assert list(series['value']) == list(range(20000 - 100, 20000))
+    assert len(source.fetched) == 1 and source.fetched[0] < 1000
+    assert source.summaries < 10
+
+    # slices inside a fetched window don't fetch anything
+    _, series = ts[-50:-10]
+    assert list(series['value']) == list(range(20000 - 50, 20000 - 10))
+    assert len(source.fetched) == 1
+
+    # new records don't move the positions, nor change the length
+    source.times.append(source.times[-1] + timedelta(hours=1))
+    assert len(ts) == n
+    _, series = ts[-1:]
+    assert list(series['value']) == [19999]
+    assert len(ts.time) == n
+
+
+def test_lazy_empty_and_bucketed():
+    source = _Source(10)
+    ts = ScalarTimeSeries(source, BASE + timedelta(days=365), None, None, None, lazy=True)
+    assert len(ts) == 0
+    assert len(ts[-10:][0]) == 0
+    with pytest.raises(IndexError):
+        ts[0]  # pylint: disable=pointless-statement
+
+    assert not ScalarTimeSeries(source, None, None, 60, 'sum', lazy=True).lazy
@@ -11,6 +11,7 @@ from tdmq.client.sources import NonScalarSource
 from tdmq.errors import UnauthorizedError
 
 from test_source import is_scalar, register_sources
+from test_timeseries import _datetime64
 
 
 def create_data_frame(shape, properties, fill_value):
@@ -43,7 +44,7 @@ def check_records(source, timebase, dt, N):
 
     t = timebase
     for i in range(N):
-        assert (ts_times[i] - t).total_seconds() < 1.0e-5
+        assert (ts_times[i] - _datetime64(t)) / np.timedelta64(1, 's') < 1.0e-5
         t += dt
         for p in source.controlled_properties:
             assert series[p][i].min() == series[p][i].max()
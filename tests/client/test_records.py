@@ -8,6 +8,7 @@ from tdmq.client import Client
 from tdmq.errors import UnauthorizedError
 
 from test_source import register_scalar_sources
+from test_timeseries import _datetime64
 
 
 source_desc = {
@@ -122,19 +123,19 @@ def test_ingest_scalar_record_timezone(clean_storage, public_source_data, live_a
     dt_naive = datetime.now()  # naive datetime, no timezone
     source.ingest_one(dt_naive, r['data'])
     timeseries = source.timeseries()
-    assert abs(timeseries.time[0] - dt_naive.astimezone(timezone.utc)) < timedelta(seconds=1)
+    assert abs(timeseries.time[0] - _datetime64(dt_naive)) < np.timedelta64(1, 's')
 
     # timestamp in UTC
     dt_utc = datetime.now(tz=timezone.utc)  # utc timestamp
     source.ingest_one(dt_utc, r['data'])
     timeseries = source.timeseries()
-    assert abs(timeseries.time[-1] - dt_utc) < timedelta(seconds=1)
+    assert abs(timeseries.time[-1] - _datetime64(dt_utc)) < np.timedelta64(1, 's')
 
     # timestamp in another time zone
     dt_Rome = datetime.now(tz=pytz.timezone('Europe/Rome'))
     source.ingest_one(dt_Rome, r['data'])
     timeseries = source.timeseries()
-    assert (timeseries.time[-1] - dt_Rome.astimezone(timezone.utc)) < timedelta(seconds=1)
+    assert (timeseries.time[-1] - _datetime64(dt_Rome)) < np.timedelta64(1, 's')
 
 
 def test_check_timeseries(clean_storage, live_app):
@@ -151,7 +152,7 @@ def test_check_timeseries(clean_storage, live_app):
     ts_times, data = ts[:]
     assert np.array_equal(data['temperature'], temps)
     assert np.array_equal(data['humidity'], hums)
-    assert np.array_equal(ts_times, times)
+    assert np.array_equal(ts_times, _datetime64(times))
     tid = s.tdmq_id
     c.deregister_source(s)
     sources = dict((_.tdmq_id, _) for _ in c.find_sources())
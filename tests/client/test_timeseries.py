@@ -11,6 +11,16 @@ from tdmq.errors import UnauthorizedError
 
 pytestmark = pytest.mark.timeseries
 
+
+def _datetime64(times):
+    """
+    Convert (aware) datetimes to the datetime64[us] UTC representation of
+    TimeSeries.time.
+    """
+    if isinstance(times, datetime):
+        return np.datetime64(times.astimezone(timezone.utc).replace(tzinfo=None), 'us')
+    return np.array([ _datetime64(t) for t in times ], dtype='datetime64[us]')
+
 source_desc = {
     "id": "tdm/sensor_1/test_barfoo",
     "alias": "B221",
@@ -29,6 +39,38 @@ source_desc = {
 }
 
 
+def test_decode_column():
+    from tdmq.client.timeseries import NoneArray, decode_column
+    a = decode_column([1, None, 2.5])
+    assert a.dtype == np.float64 and np.isnan(a[1])
+    assert decode_column((1, 2), 'number').dtype == np.float64
+    assert decode_column(np.array([1, 2])).dtype == np.float64
+    assert decode_column([True, False]).dtype == np.bool_
+    assert decode_column([True, None]).dtype == object
+    assert isinstance(decode_column([None, None], 'number'), NoneArray)
+    # declared numbers that aren't
+    assert list(decode_column(['a', {'b': 1}], 'number')) == ['a', {'b': 1}]
+    s = decode_column(['a', None, 'ccc'], 'string')
+    assert list(s) == ['a', None, 'ccc']
+    if hasattr(np, 'dtypes') and hasattr(np.dtypes, 'StringDType'):
+        assert s.dtype.kind == 'T'
+
+
+def test_declared_type():
+    from types import SimpleNamespace
+    from tdmq.client.timeseries import ScalarTimeSeries
+    source = SimpleNamespace(property_types={'temperature': 'number', 'state': 'string'})
+    ts = ScalarTimeSeries(source, None, None, None, None)
+    assert ts._declared_type('temperature') == 'number'
+    assert ts._declared_type('state') == 'string'
+    assert ts._declared_type('humidity') is None
+    ts = ScalarTimeSeries(source, None, None, 60, 'count_values')
+    assert ts._declared_type('state') == 'integer'
+    assert ts._declared_type('temperature:string_agg') == 'string'
+    assert ts._declared_type('temperature:count_records') == 'integer'
+    assert ts._declared_type('state:max') == 'string'
+
+
 def test_check_timeseries_range(clean_storage, clean_db, live_app):
     c = Client(live_app.url(), auth_token=live_app.auth_token)
     s = c.register_source(source_desc)
@@ -45,7 +87,29 @@ def test_check_timeseries_range(clean_storage, clean_db, live_app):
             ts_times, data = ts[u:v]
             assert np.array_equal(data['temperature'], temps[u:v])
             assert np.array_equal(data['humidity'], hums[u:v])
-            assert np.array_equal(ts_times, times[u:v])
+            assert np.array_equal(ts_times, _datetime64(times[u:v]))
+
+
+def test_lazy_timeseries(clean_storage, clean_db, live_app):
+    c = Client(live_app.url(), auth_token=live_app.auth_token)
+    s = c.register_source(source_desc)
+    N = 50
+    time_base = datetime.now(tz=timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(days=N)
+    times = [time_base + timedelta(i) for i in range(N)]
+    temps = [20 + i for i in range(N)]
+    s.ingest_many(times, [{'temperature': tv} for tv in temps])
+    ts = s.timeseries(lazy=True)
+    assert len(ts) == N
+    for index in (slice(-10, None), slice(5, 15), slice(None, None, 7), -1, 3):
+        ts_times, data = ts[index]
+        assert np.array_equal(data['temperature'], np.array(temps)[index])
+        assert np.array_equal(ts_times, _datetime64(times)[index])
+    assert ts._time is None
+
+    # the length and the positions don't change when records are added
+    s.ingest_one(times[-1] + timedelta(hours=1), {'temperature': 0})
+    assert len(ts) == N
+    assert np.array_equal(ts.series['temperature'], temps)
 
 
 def test_check_timeseries_ingest_many(clean_storage, clean_db, live_app):
@@ -64,7 +128,7 @@ def test_check_timeseries_ingest_many(clean_storage, clean_db, live_app):
             ts_times, data = ts[u:v]
             assert np.array_equal(data['temperature'], temps[u:v])
             assert np.array_equal(data['humidity'], hums[u:v])
-            assert np.array_equal(ts_times, times[u:v])
+            assert np.array_equal(ts_times, _datetime64(times[u:v]))
 
 
 def test_check_timeseries_bucket(clean_storage, clean_db, live_app):
@@ -90,7 +154,32 @@ def test_check_timeseries_bucket(clean_storage, clean_db, live_app):
                    (-1, bucket)).sum(axis=1))
     assert np.array_equal(
         ts_times,
-        np.reshape(np.array(times), (-1, bucket)).min(axis=1))
+        np.reshape(_datetime64(times), (-1, bucket)).min(axis=1))
+
+
+def test_fetch_many(clean_storage, clean_db, live_app):
+    pd = pytest.importorskip('pandas')
+    c = Client(live_app.url(), auth_token=live_app.auth_token)
+    time_base = datetime.now(tz=timezone.utc).replace(minute=0, second=0, microsecond=0)
+    sources = []
+    for i in range(3):
+        s = c.register_source(dict(source_desc, id=f"{source_desc['id']}_{i}"))
+        # source i has data in the buckets from i on
+        s.ingest_many([time_base + timedelta(seconds=10 * b + 1) for b in range(i, 5)],
+                      [{'temperature': float(b), 'humidity': 0.5} for b in range(i, 5)])
+        sources.append(s)
+
+    df = c.fetch_many(sources, bucket=10, op='avg', properties=['temperature'])
+    assert isinstance(df, pd.DataFrame)
+    assert df.shape == (15, 1)
+    for i, s in enumerate(sources):
+        assert np.array_equal(df.loc[s.id]['temperature'].to_numpy(),
+                              [np.nan] * i + [float(b) for b in range(i, 5)], equal_nan=True)
+
+    pytest.importorskip('xarray')
+    ds = c.fetch_many(sources, bucket=10, op='avg', properties=['temperature'], output='xarray')
+    assert dict(ds.sizes) == {'source': 3, 'time': 5}
+    assert np.array_equal(ds['temperature'].values, df['temperature'].to_numpy().reshape(3, 5), equal_nan=True)
 
 
 def test_empty_timeseries(clean_storage, clean_db, live_app):
@@ -161,7 +250,7 @@ def test_check_timeseries_range_as_user(clean_storage, clean_db, live_app):
                    (-1, bucket)).sum(axis=1))
     assert np.array_equal(
         ts_times,
-        np.reshape(np.array(times), (-1, bucket)).min(axis=1))
+        np.reshape(_datetime64(times), (-1, bucket)).min(axis=1))
 
 
 def test_timeseries_none_arrays(clean_storage, db_data, live_app):
@@ -210,6 +299,19 @@ def test_timeseries_export_csv(clean_storage, db_data, live_app):
     assert table[0][temp_index] == "20"
 
 
+def test_timeseries_export_parquet(clean_storage, db_data, live_app):
+    pq = pytest.importorskip('pyarrow.parquet')
+    c = Client(live_app.url())
+    s = c.find_sources(args={'id': 'tdm/sensor_1'})[0]
+    ts = s.timeseries()
+    with tempfile.TemporaryDirectory() as wd:
+        path = f"{wd}/ts.parquet"
+        ts.export_to_file(path)
+        table = pq.read_table(path)
+    assert table.num_rows == 4
+    assert table.column('temperature').to_pylist()[0] == 20
+
+
 def test_timeseries_step_index(clean_storage, db_data, source_data, live_app):
     source_id = 'tdm/sensor_0'
     records = source_data['records_by_source'][source_id]
@@ -223,11 +325,11 @@ def test_timeseries_step_index(clean_storage, db_data, source_data, live_app):
     (times, _) = ts[0:-1:2]
 
     def parse_timestamp(time_str):
-        return datetime.strptime(time_str, Client.TDMQ_DT_FMT_NO_MICRO).astimezone(timezone.utc)
+        return _datetime64(datetime.strptime(time_str, Client.TDMQ_DT_FMT_NO_MICRO).replace(tzinfo=timezone.utc))
 
-    assert abs(times[0] - parse_timestamp(records[0]['time'])) < timedelta(seconds=1)
-    assert abs(times[1] - parse_timestamp(records[2]['time'])) < timedelta(seconds=1)
-    assert abs(times[2] - parse_timestamp(records[4]['time'])) < timedelta(seconds=1)
+    assert abs(times[0] - parse_timestamp(records[0]['time'])) < np.timedelta64(1, 's')
+    assert abs(times[1] - parse_timestamp(records[2]['time'])) < np.timedelta64(1, 's')
+    assert abs(times[2] - parse_timestamp(records[4]['time'])) < np.timedelta64(1, 's')
 
 
 def test_timeseries_properties_subset(clean_storage, db_data, live_app):
@@ -242,3 +344,44 @@ def test_timeseries_properties_subset(clean_storage, db_data, live_app):
     ts = s.timeseries(properties='temperature')
     assert len(ts.series.keys()) == 1
     assert 'temperature' in ts.series.keys()
+
+
+def test_timeseries_arrow_matches_json(clean_storage, db_data, live_app):
+    pytest.importorskip('pyarrow')
+    series = []
+    for use_arrow in (False, True):
+        c = Client(live_app.url(), use_arrow=use_arrow)
+        s = c.find_sources(args={'id': 'tdm/sensor_1'})[0]
+        series.append(s.timeseries(properties=['temperature', 'CO']))
+    json_ts, arrow_ts = series
+    assert np.array_equal(json_ts.time, arrow_ts.time)
+    assert np.allclose(json_ts.series['temperature'].astype(float), arrow_ts.series['temperature'])
+    from tdmq.client.timeseries import NoneArray
+    assert isinstance(arrow_ts.series['CO'], NoneArray)
+
+
+def test_decode_column_array_values():
+    from tdmq.client.timeseries import decode_column
+    for values in ([[1, 2], [3, 4]], ([1, 2], [3, 4]), np.array([[1, 2], [3, 4]])):
+        for declared_type in (None, 'number', 'array'):
+            a = decode_column(values, declared_type)
+            assert a.shape == (2,) and a.dtype == object
+            assert [ list(v) for v in a ] == [[1, 2], [3, 4]]
+
+
+def test_array_property_db_json(clean_storage, clean_db, live_app_db_json):
+    c = Client(live_app_db_json.url(), auth_token=live_app_db_json.auth_token)
+    s = c.register_source(source_desc)
+    N = 5
+    time_base = datetime.now(tz=timezone.utc).replace(minute=0, second=0, microsecond=0)
+    times = [time_base + timedelta(i) for i in range(N)]
+    winds = [ [float(i), 10.0 * i] for i in range(N) ]
+    s.ingest_many(times, [ {'temperature': 20 + i, 'wind': w} for i, w in enumerate(winds) ])
+    for sparse in (False, True):
+        # the rows layout is serialized by the database
+        ts = s.timeseries()
+        ts._load_response(ts._fetch_ts_and_set_time(sparse=sparse))
+        wind = ts.series['wind']
+        assert wind.shape == (N,) and wind.dtype == object
+        assert [ list(v) for v in wind ] == winds
+        assert np.array_equal(ts.series['temperature'], [20 + i for i in range(N)])
@@ -0,0 +1,92 @@
+
+import json
+import threading
+
+import pytest
+import requests
+
+import tdmq.errors
+from tdmq.client.writer import BufferedWriter, BufferFullError
+
+
+class _Client:
+    """
+    Fake client recording the batches posted.  The first `failures` posts
+    raise `error`.  Posts wait for `gate`, if set.
+    """
+    def __init__(self, failures=0, error=None):
+        self.batches = []
+        self.failures = failures
+        self.error = error
+        self.gate = None
+
+    def add_records(self, records, on_conflict=None):
+        if self.gate is not None:
+            self.gate.wait()
+        if self.failures > 0:
+            self.failures -= 1
+            raise self.error
+        self.batches.append((list(records), on_conflict))
+
+
+def _records(n):
+    return [ {'time': f'2019-05-02T11:00:{i:02}Z', 'source': f's{i % 3}', 'data': {'v': i}} for i in range(n) ]
+
+
+def test_size_threshold():
+    client = _Client()
+    with BufferedWriter(client, max_records=4, max_delay=60, on_conflict='ignore') as writer:
+        writer.write_many(_records(8))
+        writer.flush(timeout=5)
+        assert [ len(b) for b, _ in client.batches ] == [4, 4]
+        writer.write_many(_records(3))
+    # the rest is posted on close
+    assert [ len(b) for b, _ in client.batches ] == [4, 4, 3]
+    assert all(mode == 'ignore' for _, mode in client.batches)
+    assert writer.records_posted == 11
+    with pytest.raises(RuntimeError):
+        writer.write(_records(1)[0])
+
+
+def test_byte_and_time_thresholds():
+    client = _Client()
+    record_size = len(json.dumps(_records(1)[0]))
+    with BufferedWriter(client, max_records=100, max_bytes=3 * record_size, max_delay=0.05) as writer:
+        writer.write_many(_records(7))
+        assert writer.flush(timeout=5)
+        assert [ len(b) for b, _ in client.batches ] == [3, 3, 1]
+        writer.write(_records(1)[0])
+        # posted after max_delay, without flushing
+        for _ in range(100):
+            if writer.pending == 0:
+                break
+            threading.Event().wait(0.01)
+        assert len(client.batches) == 4
+
+
+def test_retries():
+    client = _Client(failures=2, error=requests.exceptions.ConnectionError())
+    with BufferedWriter(client, backoff=0.01) as writer:
+        writer.write_many(_records(2))
+    assert len(client.batches) == 1 and writer.records_failed == 0
+
+    # client errors aren't retried
+    failed = []
+    client = _Client(failures=1, error=tdmq.errors.TdmqBadRequestException("bad"))
+    with BufferedWriter(client, backoff=0.01, on_error=lambda records, e: failed.append(records)) as writer:
+        writer.write_many(_records(2))
+    assert client.batches == [] and len(failed) == 1 and writer.records_failed == 2
+
+
+def test_backpressure():
+    client = _Client()
+    client.gate = threading.Event()
+    writer = BufferedWriter(client, max_records=2, max_buffered=4, block=False, max_delay=60)
+    try:
+        writer.write_many(_records(4))
+        with pytest.raises(BufferFullError):
+            writer.write(_records(1)[0])
+    finally:
+        client.gate.set()
+        writer.close()
+    assert sum(len(b) for b, _ in client.batches) == 4
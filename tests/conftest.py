@@ -476,15 +476,12 @@ def auth_token():
     return 'supersecret'
 
 
-@pytest.fixture(scope="session")
-def live_app(db, db_connection_config, pytestconfig, auth_token, local_zone_db,
-             service_info, storage_credentials):
-    """Run application in a separate process.
-
-       Get the URL with live_app.url().
+def _run_live_app(db_connection_config, host, port, auth_token, local_zone_db,
+                  service_info, storage_credentials, extra_config=""):
+    """Generator that runs the application in a separate process and yields
+       the server.  `extra_config` is appended to its configuration.
     """
     import tdmq.wsgi as wsgi
-    port = pytestconfig.getvalue('live_server_port')
 
     if port == 0:
         # Bind to an open port
@@ -493,8 +490,6 @@ def live_app(db, db_connection_config, pytestconfig, auth_token, local_zone_db,
         port = s.getsockname()[1]
         s.close()
 
-    host = pytestconfig.getvalue('live_server_host')
-
     cfg = f"""
 SECRET_KEY = "dev"
 TESTING = True
@@ -513,6 +508,7 @@ TILEDB_INTERNAL_VFS = {{
 APP_PREFIX = ''
 AUTH_TOKEN = '{auth_token}'
 LOC_ANONYMIZER_DB = '{local_zone_db}'
+{extra_config}
     """
 
     application_path = os.path.abspath(os.path.splitext(wsgi.__file__)[0])
@@ -528,3 +524,26 @@ LOC_ANONYMIZER_DB = '{local_zone_db}'
             yield server
         finally:
             server.stop()
+
+
+@pytest.fixture(scope="session")
+def live_app(db, db_connection_config, pytestconfig, auth_token, local_zone_db,
+             service_info, storage_credentials):
+    """Run application in a separate process.
+
+       Get the URL with live_app.url().
+    """
+    yield from _run_live_app(db_connection_config, pytestconfig.getvalue('live_server_host'),
+                             pytestconfig.getvalue('live_server_port'), auth_token, local_zone_db,
+                             service_info, storage_credentials)
+
+
+@pytest.fixture(scope="session")
+def live_app_db_json(db, db_connection_config, pytestconfig, auth_token, local_zone_db,
+                     service_info, storage_credentials):
+    """Like live_app, with the timeseries serialized to JSON by the
+       database (DB_JSON_SERIALIZATION).  It listens on an open port.
+    """
+    yield from _run_live_app(db_connection_config, pytestconfig.getvalue('live_server_host'),
+                             0, auth_token, local_zone_db, service_info, storage_credentials,
+                             extra_config="DB_JSON_SERIALIZATION = True")
@@ -1,4 +1,7 @@
 
+import gzip
+import io
+import json
 import logging
 import re
 import tempfile
@@ -9,6 +12,7 @@ from datetime import datetime
 import prometheus_client
 import pytest
 
+import tdmq.db
 from tdmq.app import create_app
 from tdmq.model import Source
 
@@ -225,6 +229,17 @@ def test_sources_get_no_args(flask_client, db_data, public_source_data):
     _validate_ids(data, set(s['id'] for s in public_source_data['sources']))
 
 
+@pytest.mark.sources
+def test_sources_get_parquet(flask_client, db_data, public_source_data):
+    pq = pytest.importorskip('pyarrow.parquet')
+    response = flask_client.get('/sources?format=parquet')
+    assert response.status_code == 200
+    assert response.content_type == 'application/vnd.apache.parquet'
+    table = pq.read_table(io.BytesIO(response.data))
+    assert table.num_rows == len(public_source_data['sources'])
+    assert set(table.column('external_id').to_pylist()) == set(s['id'] for s in public_source_data['sources'])
+
+
 @pytest.mark.sources
 def test_sources_get_by_roi_private_shifted_out(flask_client, db_data, source_data):
     # The anonymization process can bump a source outside of the roi by shifting
@@ -525,6 +540,66 @@ def test_create_timeseries(flask_client, clean_db):
     assert response.get_json() == {'loaded': 1}
 
 
+@pytest.mark.timeseries
+def test_create_timeseries_ndjson(flask_client, clean_db):
+    _create_source(flask_client)
+    records = [ {"time": f"2019-05-02T10:5{i}:00Z", "source": "st1", "data": {"temperature": 20 + i}}
+                for i in range(5) ]
+    headers = _create_auth_header(flask_client.auth_token)
+    headers['Content-Type'] = 'application/x-ndjson'
+    body = '\n'.join(json.dumps(r) for r in records) + '\n'
+    response = flask_client.post('/records?batch_size=2', data=body, headers=headers)
+    _checkresp(response)
+    assert response.get_json() == {'loaded': 5, 'batches': [2, 2, 1]}
+
+    # With the default commit mode, nothing is loaded if a record is invalid
+    bad_body = body + json.dumps({"source": "st1", "data": {}}) + '\n'
+    response = flask_client.post('/records?batch_size=2', data=bad_body, headers=headers)
+    assert response.status_code == 400
+    response = flask_client.get('/sources?id=st1')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream')
+    assert len(response.get_json()['items']) == 5
+
+    # With commit=batch, the batches before the invalid record are loaded
+    response = flask_client.post('/records?batch_size=2&commit=batch', data=bad_body, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json()['loaded'] == 4
+    assert response.get_json()['batches'] == [2, 2]
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream')
+    assert len(response.get_json()['items']) == 9
+
+
+@pytest.mark.timeseries
+def test_create_timeseries_on_conflict(flask_client, clean_db):
+    _create_source(flask_client)
+    records = [ {"time": f"2019-05-02T10:5{i}:00Z", "source": "st1", "data": {"temperature": 20 + i}}
+                for i in range(3) ]
+    headers = _create_auth_header(flask_client.auth_token)
+    response = flask_client.post('/records?on_conflict=overwrite', json=records, headers=headers)
+    assert response.status_code == 400
+    # requires the unique index
+    response = flask_client.post('/records?on_conflict=ignore', json=records, headers=headers)
+    assert response.status_code == 501
+
+    tdmq.db.create_record_unique_index(clean_db)
+    try:
+        response = flask_client.post('/records?on_conflict=ignore', json=records[:2], headers=headers)
+        _checkresp(response)
+        assert response.get_json() == {'loaded': 2, 'skipped': 0}
+        response = flask_client.post('/records?on_conflict=ignore', json=records, headers=headers)
+        assert response.get_json() == {'loaded': 1, 'skipped': 2}
+        response = flask_client.post('/records', json=records, headers=headers)
+        assert response.status_code == 409
+
+        update = [ dict(r, data={"humidity": 0.5}) for r in records[1:] ]
+        update.append(dict(records[0], time="2019-05-02T10:59:00Z"))
+        response = flask_client.post('/records?on_conflict=update', json=update, headers=headers)
+        assert response.get_json() == {'loaded': 1, 'updated': 2}
+    finally:
+        tdmq.db.drop_record_unique_index(clean_db)
+
+
 @pytest.mark.timeseries
 def test_post_bad_timeseries_no_timestamp(flask_client, clean_db):
     _create_source(flask_client)
@@ -657,6 +732,30 @@ def test_get_timeseries(flask_client, db_data):
     assert 'temperature' in d['data'] and 'relativeHumidity' in d['data']
 
 
+@pytest.mark.timeseries
+def test_get_timeseries_matches_stream(flask_client, db_data):
+    source_id = 'tdm/sensor_1'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    for q in ('', 'bucket=1200&op=sum', 'fields=temperature,CO'):
+        response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&sparse=false')
+        _checkresp(response)
+        expected = response.get_json()
+        columns = list(zip(*expected['items']))
+
+        response = flask_client.get(f'/sources/{tdmq_id}/timeseries?{q}&batch_size=2')
+        _checkresp(response)
+        d = response.get_json()
+        assert d['bucket'] == expected['bucket']
+        assert d['coords']['time'] == list(columns[0])
+        for i, field in enumerate(expected['fields'][2:], start=2):
+            if all(v is None for v in columns[i]):
+                assert d['data'][field] is None
+            else:
+                assert d['data'][field] == list(columns[i])
+
+
 @pytest.mark.timeseries
 def test_get_timeseries_stream_empty_properties(flask_client, db_data):
     source_id = 'tdm/sensor_1'
@@ -750,6 +849,309 @@ def test_get_timeseries_stream_properties_sparse_override(flask_client, db_data)
     assert isinstance(d['items'][0], (list, tuple))
 
 
+@pytest.mark.timeseries
+def test_get_timeseries_summary(flask_client, db_data):
+    source_id = 'tdm/sensor_1'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?time_format=epoch_us')
+    times = [ row['time'] for row in response.get_json()['items'] ]
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_summary?time_format=epoch_us')
+    _checkresp(response)
+    d = response.get_json()
+    assert d == {'tdmq_id': tdmq_id, 'count': len(times), 'first': times[0], 'last': times[-1],
+                 'time_format': 'epoch_us'}
+
+    q = 'after=2100-01-01T00:00:00Z'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_summary?{q}')
+    assert response.get_json() == {'tdmq_id': tdmq_id, 'count': 0, 'first': None, 'last': None}
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_summary?time_format=nope')
+    assert response.status_code == 400
+    response = flask_client.get(f'/sources/{uuid.uuid4()}/timeseries_summary')
+    assert response.status_code == 404
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_gapfill(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    q = 'fields=temperature&bucket=1&op=avg&fill=locf&after=2019-05-02T11:00:00Z&before=2019-05-02T11:00:30Z'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    d = response.get_json()
+    assert d['bucket']['fill'] == 'locf'
+    assert len(d['items']) == 30
+    assert all(row[2] is not None for row in d['items'])
+
+    # fill requires after and before
+    q = 'fields=temperature&bucket=1&op=avg&fill=locf'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    assert response.status_code == 400
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_multiple_ops(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    q = 'fields=temperature&bucket=20&op=min,avg,max'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    d = response.get_json()
+    assert d['fields'] == ['time', 'footprint', 'temperature:min', 'temperature:avg', 'temperature:max']
+    assert d['bucket']['op'] == ['min', 'avg', 'max']
+    assert len(d['items']) == 2
+    assert d['items'][0][2:] == pytest.approx([22, 22.5, 23])
+
+    q = 'bucket=20&ops=temperature:avg,relativeHumidity:max'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    d = response.get_json()
+    assert d['fields'] == ['time', 'footprint', 'temperature:avg', 'relativeHumidity:max']
+    assert d['bucket']['ops'] == ['temperature:avg', 'relativeHumidity:max']
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_db_json(flask_client, db_data):
+    queries = [
+        'fields=temperature,relativeHumidity',
+        'fields=temperature,relativeHumidity&sparse=true',
+        'fields=temperature&bucket=20&op=min,max',
+        '',
+    ]
+    for source_id, public in (('tdm/sensor_0', 'true'), ('tdm/sensor_7', 'false')):
+        response = flask_client.get(f'/sources?id={source_id}&public={public}')
+        tdmq_id = response.get_json()[0]['tdmq_id']
+        for q in queries:
+            flask_client.application.config['DB_JSON_SERIALIZATION'] = False
+            response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+            _checkresp(response)
+            expected = response.get_json()
+
+            flask_client.application.config['DB_JSON_SERIALIZATION'] = True
+            response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+            _checkresp(response)
+            assert response.get_json() == expected
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_arrow(flask_client, db_data):
+    pytest.importorskip('pyarrow')
+    from tdmq.arrow_io import read_ts_arrow
+
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    q = 'fields=temperature,relativeHumidity'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    expected = response.get_json()
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&format=arrow&batch_size=4')
+    assert response.status_code == 200
+    assert response.content_type == 'application/vnd.apache.arrow.stream'
+    metadata, table = read_ts_arrow(response.data)
+    assert metadata['tdmq_id'] == tdmq_id
+    assert table.column_names == expected['fields']
+    assert table.num_rows == len(expected['items'])
+    assert [ t.timestamp() for t in table.column('time').to_pylist() ] == \
+        pytest.approx([ row[0] for row in expected['items'] ])
+    assert table.column('temperature').to_pylist() == [ row[2] for row in expected['items'] ]
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_parquet(flask_client, db_data):
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    q = 'fields=temperature,relativeHumidity&format=parquet&batch_size=4'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    assert response.status_code == 200
+    assert response.content_type == 'application/vnd.apache.parquet'
+    assert response.headers['Content-Disposition'] == f"attachment;filename={tdmq_id}.parquet"
+    parquet_file = pq.ParquetFile(io.BytesIO(response.data))
+    assert parquet_file.metadata.num_row_groups == 2
+    table = parquet_file.read()
+    assert table.column_names == ['time', 'footprint', 'temperature', 'relativeHumidity']
+    assert table.num_rows == 6
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_compressed(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    flask_client.application.config['COMPRESSION_MIN_SIZE'] = 0
+    q = 'fields=temperature,relativeHumidity&sparse=true&batch_size=2'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    assert 'Content-Encoding' not in response.headers
+    expected = response.get_json()
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}',
+                                headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data)) == expected
+
+    # small responses are not compressed
+    flask_client.application.config['COMPRESSION_MIN_SIZE'] = 1024 * 1024
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}',
+                                headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json() == expected
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_columns(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    for q in ('fields=temperature,relativeHumidity', 'fields=temperature&bucket=10&op=avg,max',
+              'before=2000-01-01T00:00:00Z'):
+        response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&sparse=false&batch_size=4')
+        _checkresp(response)
+        expected = response.get_json()
+
+        response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&orient=columns&batch_size=4')
+        _checkresp(response)
+        result = response.get_json()
+        assert result['orient'] == 'columns'
+        assert result['fields'] == expected['fields']
+        assert list(result['items'].keys()) == expected['fields']
+        for i, field in enumerate(expected['fields']):
+            assert result['items'][field] == [ row[i] for row in expected['items'] ]
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?orient=index')
+    assert response.status_code == 400
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_time_format(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    q = 'fields=temperature'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    expected = [ row[0] for row in response.get_json()['items'] ]
+    assert 'time_format' not in response.get_json()
+
+    for time_format, scale in (('epoch_ms', 1000), ('epoch_us', 1000000)):
+        for extra in ('', '&bucket=10&op=avg'):
+            response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&time_format={time_format}{extra}')
+            _checkresp(response)
+            result = response.get_json()
+            assert result['time_format'] == time_format
+            assert all(isinstance(row[0], int) for row in result['items'])
+            if not extra:
+                assert [ row[0] for row in result['items'] ] == [ round(t * scale) for t in expected ]
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&time_format=iso')
+    assert response.status_code == 400
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_conditional(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+
+    q = 'after=2019-05-02T00:00:00Z&before=2019-05-03T00:00:00Z'
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    _checkresp(response)
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    # by default, responses are always revalidated
+    assert response.cache_control.no_cache
+    assert response.last_modified is not None
+
+    # historical data can be cached by proxies if configured
+    flask_client.application.config['CACHE_IMMUTABLE_AFTER'] = 24 * 3600
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+    assert response.headers['ETag'] == etag
+    assert response.cache_control.max_age == flask_client.application.config['CACHE_MAX_AGE']
+    assert response.cache_control.public
+
+    # the arguments are validated before looking up the version
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?after=yesterday',
+                                headers={'If-None-Match': etag})
+    assert response.status_code == 400
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries?{q}&bucket=ten',
+                                headers={'If-None-Match': etag})
+    assert response.status_code == 400
+
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}',
+                                headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.data
+
+    # other query arguments, other validator
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}&fields=temperature',
+                                headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    # open intervals may still change and must be revalidated
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream')
+    assert response.cache_control.no_cache
+
+    # ingesting records in the interval changes the validator
+    record = { "time": "2019-05-02T12:00:00Z", "source": source_id, "data": {"temperature": 30} }
+    response = flask_client.post('/records', json=[record],
+                                 headers=_create_auth_header(flask_client.auth_token))
+    _checkresp(response)
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}',
+                                headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_downsampled(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+    for method in ('lttb', 'minmax'):
+        q = f'fields=temperature,relativeHumidity&max_points=4&method={method}'
+        response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?{q}')
+        _checkresp(response)
+        d = response.get_json()
+        # 6 records in the timeseries.  First and last always selected
+        assert 0 < len(d['items']) < 6
+        times = [ row[0] for row in d['items'] ]
+        assert times == sorted(times)
+
+
+@pytest.mark.timeseries
+def test_get_timeseries_stream_downsampled_bad_args(flask_client, db_data):
+    source_id = 'tdm/sensor_0'
+    response = flask_client.get(f'/sources?id={source_id}')
+    tdmq_id = response.get_json()[0]['tdmq_id']
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?max_points=4&method=foo')
+    assert response.status_code == 400
+    response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?max_points=4&bucket=10&op=sum')
+    assert response.status_code == 400
+    for max_points in ('four', '2.5', '0', '-4'):
+        response = flask_client.get(f'/sources/{tdmq_id}/timeseries_stream?max_points={max_points}')
+        assert response.status_code == 400
+
+
 @pytest.mark.timeseries
 def test_get_private_timeseries_stream_unauthenticated(flask_client, clean_db, source_data):
     private_source = [ next(s for s in source_data['sources'] if not s.get('public')) ]
@@ -0,0 +1,156 @@
+
+from datetime import datetime, timezone
+
+import pytest
+
+from tdmq import arrow_io
+from tdmq.errors import ColumnTypeError
+
+pa = pytest.importorskip('pyarrow')
+
+
+class _ResultSet:
+    def __init__(self, fields, batches):
+        self.tdmq_id = 'f5f1c4b2-3a5e-4e4b-8a6b-1b1d1c1e1f10'
+        self.shape = []
+        self.bucket = None
+        self.default_footprint = {"type": "Point", "coordinates": [9.2, 30.0]}
+        self.fields = fields
+        self._batches = iter(batches)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._batches)
+
+
+def _roundtrip(resultset):
+    return arrow_io.read_ts_arrow(b''.join(arrow_io.generate_ts_arrow(resultset)))
+
+
+def test_arrow_roundtrip():
+    fields = ['time', 'footprint', 'temperature', 'label', 'flag', 'missing']
+    batches = [
+        [ (1556794800.0, None, 22, 'a', True, None),
+          (1556794805.5, None, None, None, False, None) ],
+        [ (1556794810, None, 23.5, {'x': 1}, None, None) ],
+    ]
+    metadata, table = _roundtrip(_ResultSet(fields, batches))
+
+    assert metadata['tdmq_id'] == 'f5f1c4b2-3a5e-4e4b-8a6b-1b1d1c1e1f10'
+    assert metadata['bucket'] is None
+    assert table.column_names == fields
+    assert table.num_rows == 3
+    assert table.schema.field('time').type == pa.timestamp('us', tz='UTC')
+    assert table.schema.field('temperature').type == pa.float64()
+    assert table.schema.field('label').type == pa.string()
+    assert table.schema.field('flag').type == pa.bool_()
+    assert table.schema.field('missing').type == pa.string()
+
+    assert table.column('time').to_pylist() == [
+        datetime(2019, 5, 2, 11, 0, 0, tzinfo=timezone.utc),
+        datetime(2019, 5, 2, 11, 0, 5, 500000, tzinfo=timezone.utc),
+        datetime(2019, 5, 2, 11, 0, 10, tzinfo=timezone.utc) ]
+    assert table.column('temperature').to_pylist() == [22.0, None, 23.5]
+    assert table.column('label').to_pylist() == ['a', None, '{"x": 1}']
+    assert table.column('flag').to_pylist() == [True, False, None]
+    assert table.column('missing').null_count == 3
+
+
+def test_arrow_declared_types():
+    # the first batch has no label, and a count that looks like a float
+    fields = ['time', 'footprint', 'temperature', 'label', 'temperature:count_values']
+    batches = [
+        [ (1556794800.0, None, None, None, 2) ],
+        [ (1556794810.0, None, 21, 'a', 3) ],
+    ]
+    resultset = _ResultSet(fields, batches)
+    resultset.bucket = {'interval': 10, 'op': None, 'ops': ['temperature:avg', 'temperature:count_values']}
+    property_types = {'temperature': 'number', 'label': 'string'}
+    _, table = arrow_io.read_ts_arrow(b''.join(arrow_io.generate_ts_arrow(resultset, property_types)))
+    assert table.schema.field('label').type == pa.string()
+    assert table.schema.field('temperature:count_values').type == pa.int64()
+    assert table.column('label').to_pylist() == [None, 'a']
+    assert table.column('temperature:count_values').to_pylist() == [2, 3]
+
+
+def test_arrow_type_mismatch():
+    # a value that doesn't fit the column raises, rather than becoming null
+    fields = ['time', 'footprint', 'temperature']
+    batches = [ [ (1556794800.0, None, 22) ], [ (1556794810.0, None, 'n/a') ] ]
+    with pytest.raises(ColumnTypeError):
+        _roundtrip(_ResultSet(fields, batches))
+    # in the first batch, the error is raised before the stream starts
+    with pytest.raises(ColumnTypeError):
+        arrow_io.generate_ts_arrow(_ResultSet(fields, batches[1:]), {'temperature': 'number'})
+
+
+def test_arrow_type_mismatch_mid_stream():
+    # in a later batch, the stream is ended cleanly with the error
+    fields = ['time', 'footprint', 'temperature']
+    batches = [ [ (1556794800.0, None, 22) ], [ (1556794810.0, None, 'n/a') ], [ (1556794820.0, None, 23) ] ]
+    data = b''.join(arrow_io.generate_ts_arrow(_ResultSet(fields, batches)))
+    with pa.ipc.open_stream(data) as reader:
+        table = reader.read_all()
+    assert table.column('temperature').to_pylist() == [22.0]
+    with pytest.raises(ColumnTypeError, match="temperature"):
+        arrow_io.read_ts_arrow(data)
+
+
+def test_arrow_empty_result():
+    metadata, table = _roundtrip(_ResultSet(['time', 'footprint', 'temperature'], []))
+    assert table.num_rows == 0
+    assert table.column_names == ['time', 'footprint', 'temperature']
+    assert metadata['default_footprint']['type'] == 'Point'
+
+
+def test_parquet_timeseries():
+    pq = pytest.importorskip('pyarrow.parquet')
+    fields = ['time', 'footprint', 'temperature']
+    batches = [ [ (1556794800.0, None, 22), (1556794805.0, None, 23) ],
+                [ (1556794810.0, None, None) ] ]
+    with arrow_io.write_ts_parquet(_ResultSet(fields, batches)) as f:
+        parquet_file = pq.ParquetFile(f)
+        assert parquet_file.metadata.num_row_groups == 2
+        table = parquet_file.read()
+    assert table.column_names == fields
+    assert table.column('temperature').to_pylist() == [22.0, 23.0, None]
+
+
+def test_parquet_timeseries_later_types():
+    pq = pytest.importorskip('pyarrow.parquet')
+    # the first batch has no value for any of the properties
+    fields = ['time', 'footprint', 'temperature', 'label', 'comment']
+    batches = [ [ (1556794800.0, None, None, None, None) ],
+                [ (1556794810.0, None, 22, 'a', {'x': 1}) ] ]
+    property_types = {'temperature': 'number', 'label': 'string'}
+    with arrow_io.write_ts_parquet(_ResultSet(fields, batches), property_types) as f:
+        table = pq.read_table(f)
+    assert table.schema.field('temperature').type == pa.float64()
+    assert table.column('temperature').to_pylist() == [None, 22.0]
+    assert table.column('label').to_pylist() == [None, 'a']
+    assert table.column('comment').to_pylist() == [None, '{"x": 1}']
+
+    # a value of a different type in a later batch fails the export
+    batches = [ [ (1556794800.0, None, True) ], [ (1556794810.0, None, 'yes') ] ]
+    with pytest.raises(ColumnTypeError):
+        arrow_io.write_ts_parquet(_ResultSet(['time', 'footprint', 'flag'], batches))
+
+
+def test_parquet_sources():
+    pq = pytest.importorskip('pyarrow.parquet')
+    sources = [
+        { 'tdmq_id': 'a', 'external_id': 'tdm/sensor_0', 'public': True,
+          'default_footprint': {'type': 'Point', 'coordinates': [9.2, 30.0]},
+          'registration_time': datetime(2019, 5, 2, tzinfo=timezone.utc) },
+        { 'tdmq_id': 'b', 'external_id': None, 'public': False,
+          'default_footprint': None, 'registration_time': None },
+    ]
+    with arrow_io.write_sources_parquet(sources) as f:
+        table = pq.read_table(f)
+    assert table.column_names == list(sources[0].keys())
+    assert table.column('public').to_pylist() == [True, False]
+    assert table.column('external_id').to_pylist() == ['tdm/sensor_0', None]
+    assert table.column('default_footprint').to_pylist()[0] == '{"type": "Point", "coordinates": [9.2, 30.0]}'
+    assert table.column('registration_time').to_pylist()[0] == sources[0]['registration_time']
@@ -0,0 +1,69 @@
+
+import json
+
+import pytest
+
+from tdmq.column_spool import ColumnSpool, generate_json_object
+
+
+@pytest.mark.parametrize("max_size", [0, 1024 * 1024])
+def test_column_spool(max_size):
+    rows = [ (float(t), None, t % 3, None if t % 2 else 'x') for t in range(10) ]
+    with ColumnSpool(4, max_size=max_size) as spool:
+        for i in range(0, len(rows), 3):
+            spool.add_rows(rows[i:i + 3])
+        assert spool.n_rows == len(rows)
+        assert spool.all_null(1)
+        assert not spool.all_null(2)
+
+        for i, column in enumerate(zip(*rows)):
+            assert json.loads(b''.join(spool.column_chunks(i))) == list(column)
+
+        names = ['time', 'footprint', 'a', 'b']
+        result = json.loads(b''.join(generate_json_object(names, spool, null_if_all_null=True)))
+        assert result == { 'time': list(range(10)), 'footprint': None,
+                           'a': [ t % 3 for t in range(10) ], 'b': [ None if t % 2 else 'x' for t in range(10) ] }
+
+
+def test_column_spool_budget():
+    rows = [ (t, 'x' * 100, t) for t in range(100) ]
+    with ColumnSpool(3, max_size=5000) as spool:
+        for i in range(0, len(rows), 10):
+            spool.add_rows(rows[i:i + 10])
+            # the budget is shared by all the columns
+            assert spool.in_memory_size <= 5000
+        for i, column in enumerate(zip(*rows)):
+            assert json.loads(b''.join(spool.column_chunks(i))) == list(column)
+
+
+def test_column_spool_streaming():
+    rows = [ (t, None, t * 2) for t in range(10) ]
+    batches = [ rows[i:i + 4] for i in range(0, len(rows), 4) ]
+    read = []
+
+    def reader():
+        for batch in batches:
+            read.append(len(batch))
+            yield batch
+
+    with ColumnSpool(3) as spool:
+        chunks = generate_json_object(['time', 'footprint', 'a'], spool, batches=reader(), null_if_all_null=True)
+        # the first column starts with the first batch
+        opening = next(chunks) + next(chunks) + next(chunks) + next(chunks)
+        assert opening == b'{"time":[0, 1, 2, 3'
+        assert read == [4]
+        result = json.loads(opening + b''.join(chunks))
+        assert result == { 'time': list(range(10)), 'footprint': None, 'a': [ t * 2 for t in range(10) ] }
+
+
+def test_column_spool_empty():
+    with ColumnSpool(2) as spool:
+        spool.add_batches([[], []])
+        assert spool.n_rows == 0
+        assert spool.all_null(0)
+        assert json.loads(b''.join(generate_json_object(['time', 'footprint'], spool))) == \
+            { 'time': [], 'footprint': [] }
+    with ColumnSpool(2) as spool:
+        assert json.loads(b''.join(generate_json_object(['time', 'footprint'], spool, batches=[[]],
+                                                        null_if_all_null=True))) == \
+            { 'time': [], 'footprint': [] }
@@ -0,0 +1,56 @@
+
+import gzip
+import zlib
+
+import pytest
+
+from tdmq import compression
+
+
+@pytest.mark.parametrize("header, expected", [
+    ('', None),
+    ('identity', None),
+    ('gzip', 'gzip'),
+    ('gzip, deflate', 'gzip'),
+    ('gzip;q=0', None),
+    ('*', compression.available_encodings()[0]),
+    ('br;q=0.5, gzip;q=0.8', 'gzip'),
+])
+def test_negotiate(header, expected):
+    assert compression.negotiate(header, ['zstd', 'br', 'gzip']) == expected
+
+
+def test_negotiate_only_enabled():
+    assert compression.negotiate('gzip, br, zstd', []) is None
+    assert compression.negotiate('gzip, br, zstd', ['gzip']) == 'gzip'
+
+
+def test_read_prefix():
+    prefix, rest = compression.read_prefix(iter(['ab', b'cd', 'ef']), 3)
+    assert prefix == [b'ab', b'cd']
+    assert list(rest) == ['ef']
+    prefix, rest = compression.read_prefix(iter(['ab']), 3)
+    assert prefix == [b'ab']
+    assert rest is None
+
+
+def test_gzip_chunks_decodable_incrementally():
+    batches = [ ('x' * 5000 + str(i)) for i in range(3) ]
+    chunks = list(compression.compress_chunks(batches, 'gzip', 6))
+    assert gzip.decompress(b''.join(chunks)) == ''.join(batches).encode()
+    # each batch is flushed, so the data received so far can be decoded
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decoder.decompress(chunks[0]) == batches[0].encode()
+
+
+@pytest.mark.parametrize("encoding", compression.available_encodings())
+def test_compress_roundtrip(encoding):
+    data = [ '{"temperature": 22}' * 100, ',', '{"temperature": 23}' * 100 ]
+    compressed = b''.join(compression.compress_chunks(data, encoding, 3))
+    if encoding == 'gzip':
+        plain = gzip.decompress(compressed)
+    elif encoding == 'zstd':
+        plain = compression.zstandard.ZstdDecompressor().decompressobj().decompress(compressed)
+    else:
+        plain = compression.brotli.decompress(compressed)
+    assert plain == ''.join(data).encode()
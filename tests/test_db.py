@@ -1,11 +1,17 @@
 
 
 import copy
+import json
 import operator as op
+from datetime import timedelta
+from unittest.mock import patch
+
+import psycopg2.errors
 import pytest
 
 import tdmq.db as db_query
-from tdmq.errors import ItemNotFoundException
+from tdmq.errors import ItemNotFoundException, TdmqBadRequestException, UnsupportedFunctionality
+from tdmq.result_cache import result_cache
 from test_api import _filter_records_in_time_range_and_source
 
 
@@ -247,6 +253,146 @@ def test_get_bucketed_timeseries(app, db_data, source_data):
     assert len(result['rows']) < len(all_src_recs)
 
 
+def test_get_bucketed_timeseries_gapfill(app, db_data, source_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'fields': ['temperature'], 'bucket': timedelta(seconds=1), 'op': 'avg',
+            'after': '2019-05-02T11:00:00Z', 'before': '2019-05-02T11:00:30Z'}
+
+    result = db_query.get_timeseries(tdmq_id, dict(args, fill='null'))
+    assert len(result['rows']) == 30
+    assert [ r[2] is not None for r in result['rows'] ] == [ i % 5 == 0 for i in range(30) ]
+
+    result = db_query.get_timeseries(tdmq_id, dict(args, fill='locf'))
+    assert len(result['rows']) == 30
+    assert result['rows'][7][2] == pytest.approx(22)
+
+    result = db_query.get_timeseries(tdmq_id, dict(args, fill='linear'))
+    assert len(result['rows']) == 30
+    assert result['rows'][7][2] == pytest.approx(22.4)
+    # time buckets are evenly spaced
+    times = [ float(r[0]) for r in result['rows'] ]
+    assert all(t1 - t0 == 1 for t0, t1 in zip(times, times[1:]))
+
+
+def test_get_bucketed_timeseries_gapfill_bad_args(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'fields': ['temperature'], 'bucket': timedelta(seconds=1), 'op': 'avg', 'fill': 'linear'}
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, args)  # missing after and before
+    args.update(after='2019-05-02T11:00:00Z', before='2019-05-02T11:00:30Z')
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, fill='cubic'))
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, op='string_agg'))
+
+
+def test_get_bucketed_timeseries_multiple_ops(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'fields': ['temperature'], 'bucket': timedelta(seconds=20), 'op': ['min', 'avg', 'max']}
+
+    result = db_query.get_timeseries(tdmq_id, args)
+    assert result['properties'] == ['temperature:min', 'temperature:avg', 'temperature:max']
+    assert len(result['rows']) == 2
+    assert result['rows'][0][2:] == pytest.approx((22, 22.5, 23))
+    assert result['rows'][1][2:] == pytest.approx((24, 24, 24))
+
+    # same layout when fetching by batches
+    ts_result = db_query.get_timeseries_result(tdmq_id, **args)
+    assert ts_result.fields == ['time', 'footprint'] + result['properties']
+    rows = [ row for batch in ts_result for row in batch ]
+    assert [ row[2:] for row in rows ] == [ row[2:] for row in result['rows'] ]
+
+
+def test_get_bucketed_timeseries_per_field_ops(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'bucket': timedelta(seconds=20), 'ops': ['temperature:max', 'temperature:count_records']}
+
+    result = db_query.get_timeseries(tdmq_id, args)
+    assert result['properties'] == ['temperature:max', 'temperature:count_records']
+    assert [ tuple(r[2:]) for r in result['rows'] ] == [ (23, 4), (24, 2) ]
+
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, ops=['temperature:median']))
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, ops=['temperature']))
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, ops=['nonexistent:avg']))
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, fields=['temperature']))
+
+
+def test_get_bucketed_timeseries_percentiles(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'fields': ['temperature'], 'bucket': timedelta(seconds=20), 'op': ['p50', 'p100']}
+
+    result = db_query.get_timeseries(tdmq_id, args)
+    assert result['properties'] == ['temperature:p50', 'temperature:p100']
+    assert result['rows'][0][2:] == pytest.approx((22.5, 23))
+
+    for bad_op in ('p101', 'p', 'approx_avg'):
+        with pytest.raises(TdmqBadRequestException):
+            db_query.get_timeseries(tdmq_id, dict(args, op=bad_op))
+
+
+def test_get_timeseries_time_format(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'fields': ['temperature'], 'bucket': None}
+    seconds = [ row[0] for row in db_query.get_timeseries(tdmq_id, args)['rows'] ]
+    assert all(isinstance(t, float) for t in seconds)
+
+    micro = [ row[0] for row in db_query.get_timeseries(tdmq_id, dict(args, time_format='epoch_us'))['rows'] ]
+    assert micro == [ round(t * 1000000) for t in seconds ]
+
+    args = {'fields': ['temperature'], 'bucket': timedelta(seconds=10), 'op': 'avg',
+            'after': '2019-05-02T11:00:00Z', 'before': '2019-05-02T11:00:30Z'}
+    for fill in (None, 'null'):
+        rows = db_query.get_timeseries(tdmq_id, dict(args, fill=fill, time_format='epoch_ms'))['rows']
+        assert rows[0][0] == 1556794800000
+
+    with pytest.raises(TdmqBadRequestException):
+        db_query.get_timeseries(tdmq_id, dict(args, time_format='iso'))
+
+
+def test_get_bucketed_timeseries_result_cache(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    args = {'fields': ['temperature'], 'bucket': timedelta(seconds=10), 'op': 'max',
+            'after': '2019-05-02T11:00:00Z', 'before': '2019-05-02T12:00:00Z'}
+    expected = db_query.get_timeseries(tdmq_id, args)['rows']
+
+    app.config['RESULT_CACHE'] = 'memory'
+    result_cache.init_app(app)
+    try:
+        rows = [ r for b in db_query.get_timeseries_result(tdmq_id, 2, **args) for r in b ]
+        assert rows == expected
+        with patch('tdmq.db._timeseries_query') as query:
+            assert db_query.get_timeseries(tdmq_id, args)['rows'] == expected
+            query.assert_not_called()
+
+        db_query.load_records([{'time': '2019-05-02T11:00:01Z', 'source': 'tdm/sensor_0',
+                                'data': {'temperature': 40}}])
+        assert db_query.get_timeseries(tdmq_id, args)['rows'][0][2] == 40
+    finally:
+        app.config['RESULT_CACHE'] = None
+        result_cache.init_app(app)
+
+
+def test_get_timeseries_json_result(app, db_data):
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    # nested null values are kept in the sparse format
+    db_query.load_records([{'time': '2019-05-02T11:00:30Z', 'source': 'tdm/sensor_0',
+                            'data': {'temperature': 40, 'state': {'mode': None, 'level': 2}}}])
+    args = {'fields': ['temperature', 'state']}
+    rows = [ r for b in db_query.get_timeseries_result(tdmq_id, **args) for r in b ]
+    fields = ['time', 'footprint', 'temperature', 'state']
+    for sparse in (False, True):
+        batches = list(db_query.get_timeseries_json_result(tdmq_id, 3, sparse, **args))
+        assert len(batches) == (len(rows) + 2) // 3
+        items = json.loads('[' + ','.join(batches) + ']')
+        assert items == json.loads('[' + db_query._format_json_rows(rows, fields, sparse) + ']')
+    assert {'temperature': 40, 'state': {'mode': None, 'level': 2}}.items() <= \
+        json.loads('[' + ','.join(db_query.get_timeseries_json_result(tdmq_id, 3, True, **args)) + ']')[-1].items()
+
+
 def test_get_empty_timeseries(app, db_data, source_data):
     our_source_id = 'tdm/sensor_0'
     all_src_recs = sorted((r for r in source_data['records'] if r['source'] == our_source_id), key=op.itemgetter('time'))
@@ -257,6 +403,80 @@ def test_get_empty_timeseries(app, db_data, source_data):
     assert len(result['rows']) == 0
 
 
+def test_load_record_batches(app, clean_db, source_data):
+    db_query.load_sources(source_data['sources'])
+    records = source_data['records']
+    batches = [ records[i:i + 7] for i in range(0, len(records), 7) ]
+    loaded = []
+    counts = db_query.load_record_batches(iter(batches), on_batch=loaded.append)
+    assert counts == [ len(b) for b in batches ]
+    assert loaded == counts
+
+    tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+    assert len(db_query.get_timeseries(tdmq_id)['rows']) == \
+        len([ r for r in records if r['source'] == 'tdm/sensor_0' ])
+
+
+def test_load_records_on_conflict(app, clean_db, source_data):
+    db_query.load_sources(source_data['sources'])
+    records = [ {'time': f'2019-05-02T11:00:0{i}Z', 'source': 'tdm/sensor_0', 'data': {'temperature': i}}
+                for i in range(3) ]
+
+    with pytest.raises(UnsupportedFunctionality):
+        db_query.load_records(records, on_conflict='ignore')
+
+    # duplicates are allowed without the unique index
+    db_query.load_records(records[:1])
+    db_query.load_records(records[:1])
+    assert db_query.create_record_unique_index(clean_db, deduplicate=True) == 1
+    try:
+        assert db_query.load_records(records, on_conflict='ignore') == 2
+        assert db_query.load_records(records, on_conflict='ignore') == 0
+        with pytest.raises(psycopg2.errors.UniqueViolation):
+            db_query.load_records(records[:1])
+
+        # updated records aren't counted as loaded, nor are the ones merged
+        # with another record of the same request
+        update = [ {'time': records[1]['time'], 'source': 'tdm/sensor_0', 'data': {'humidity': 50}},
+                   {'time': '2019-05-02T11:00:05Z', 'source': 'tdm/sensor_0', 'data': {'humidity': 51}},
+                   {'time': '2019-05-02T11:00:05Z', 'source': 'tdm/sensor_0', 'data': {'temperature': 5}} ]
+        assert db_query.load_records(update, on_conflict='update') == 1
+
+        tdmq_id = db_query.list_sources({'id': 'tdm/sensor_0'})[0]['tdmq_id']
+        rows = db_query.get_timeseries(tdmq_id, {'fields': ['temperature', 'humidity']})['rows']
+        assert [ r[2:] for r in rows ] == [ (0, None), (1, 50), (2, None), (5, 51) ]
+    finally:
+        db_query.drop_record_unique_index(clean_db)
+
+
+def test_record_unique_index_reorder_policy(app, clean_db):
+    def reorder_index():
+        return db_query.query_db_all("""
+            SELECT config->>'index_name' FROM timescaledb_information.jobs
+            WHERE hypertable_name = 'record' AND proc_name = 'policy_reorder'""")
+
+    assert reorder_index() == [(db_query.RECORD_INDEX,)]
+    db_query.create_record_unique_index(clean_db)
+    try:
+        # the reorder policy follows the index that replaces the plain one
+        assert reorder_index() == [(db_query.RECORD_UNIQUE_INDEX,)]
+    finally:
+        db_query.drop_record_unique_index(clean_db)
+    assert reorder_index() == [(db_query.RECORD_INDEX,)]
+
+
+def test_get_source_entity_types(app, clean_db, source_data):
+    db_query.load_sources(source_data['sources'])
+    src = source_data['sources'][0]
+    tdmq_id = db_query.list_sources({'id': src['id']})[0]['tdmq_id']
+    expected = (str(tdmq_id), src['id'], src['entity_category'], src['entity_type'])
+    for args in (([tdmq_id], []), ([], [src['id']])):
+        rows = db_query.get_source_entity_types(*args)
+        assert [ (str(r[0]),) + tuple(r[1:]) for r in rows ] == [expected]
+    assert db_query.get_source_entity_types([], ['unknown']) == []
+    assert (src['entity_category'], src['entity_type'], None) in db_query.get_entity_type_schemas()
+
+
 def test_load_source(app, clean_db, source_data):
     results = db_query.list_sources({})
     assert len(results) == 0
@@ -0,0 +1,62 @@
+
+import math
+
+import pytest
+
+from tdmq.downsampling import downsample_batches
+
+
+def _make_rows(n, fields_fn):
+    return [ (float(t), None, *fields_fn(t)) for t in range(n) ]
+
+
+def _batches(rows, batch_size):
+    return iter([rows[i:i + batch_size] for i in range(0, len(rows), batch_size)])
+
+
+def _run(rows, max_points, method, batch_size=7, n_fields=1):
+    out = []
+    for batch in downsample_batches(_batches(rows, batch_size), len(rows), max_points, n_fields, method):
+        assert batch
+        out.extend(batch)
+    return out
+
+
+@pytest.mark.parametrize("method", ['lttb', 'minmax'])
+def test_downsampling_short_series_untouched(method):
+    rows = _make_rows(10, lambda t: [t])
+    assert _run(rows, 20, method) == rows
+
+
+@pytest.mark.parametrize("method", ['lttb', 'minmax'])
+def test_downsampling_reduces_and_keeps_order(method):
+    rows = _make_rows(1000, lambda t: [math.sin(t / 10)])
+    out = _run(rows, 50, method)
+    assert len(out) <= 50
+    assert len(out) >= 25
+    assert out[0] == rows[0]
+    assert out[-1] == rows[-1]
+    times = [r[0] for r in out]
+    assert times == sorted(set(times))
+
+
+@pytest.mark.parametrize("method", ['lttb', 'minmax'])
+def test_downsampling_preserves_peaks(method):
+    rows = _make_rows(1000, lambda t: [100.0 if t == 517 else 0.0])
+    out = _run(rows, 20, method)
+    assert any(r[2] == 100.0 for r in out)
+
+
+def test_downsampling_multiple_fields_with_nulls():
+    rows = _make_rows(300, lambda t: [t if t % 2 else None, 'text', -t])
+    out = _run(rows, 20, 'lttb', n_fields=3)
+    # each field selects at most max_points rows
+    assert len(out) <= 2 * 20
+    assert sum(1 for r in out if r[2] is not None) >= 10
+
+
+def test_downsampling_bad_args():
+    with pytest.raises(ValueError):
+        downsample_batches(iter([]), 10, 5, 1, 'bad_method')
+    with pytest.raises(ValueError):
+        downsample_batches(iter([]), 10, 2, 1, 'lttb')
@@ -0,0 +1,147 @@
+
+import time
+
+import psycopg2
+import pytest
+
+import tdmq.db
+import tdmq.db_manager
+from tdmq.ingest_queue import IngestQueue
+
+
+class _App:
+    def __init__(self, **config):
+        self.config = config
+
+
+class _Connection:
+    closed = 0
+
+
+class _Loader:
+    """
+    Fake `load_record_batches_conn` recording the records loaded in each
+    transaction.  Transactions containing a record with data 'bad' fail.
+    """
+    def __init__(self):
+        self.transactions = []
+
+    def __call__(self, conn, batches, *args, **kwargs):
+        records = [ r for batch in batches for r in batch ]
+        if any(r['data'] == 'bad' for r in records):
+            raise ValueError("bad record")
+        if any(r['data'] == 'offline' for r in records):
+            raise psycopg2.OperationalError("connection refused")
+        self.transactions.append(records)
+        return [ len(b) for b in batches ]
+
+
+def _records(n, data=None):
+    return [ {'time': f"2019-05-02T11:00:{i:02}Z", 'source': 's1', 'data': data or {'v': i}} for i in range(n) ]
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    loader = _Loader()
+    monkeypatch.setattr(tdmq.db, 'load_record_batches_conn', loader)
+    monkeypatch.setattr(tdmq.db_manager, 'db_connect', lambda settings: _Connection())
+    return loader
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = IngestQueue(_App(
+        INGEST_QUEUE=f"sqlite:///{tmp_path / 'queue.db'}", INGEST_QUEUE_FLUSHER='external',
+        INGEST_FLUSH_MAX_RECORDS=5, DB_USER='u', DB_PASSWORD='p', DB_HOST='h', DB_NAME='n'))
+    yield q
+    q.stop()
+
+
+def test_disabled():
+    assert not IngestQueue(_App()).enabled
+    with pytest.raises(ValueError):
+        IngestQueue(_App(INGEST_QUEUE='redis://localhost'))
+
+
+def test_group_commit(queue, loader):
+    assert queue.enqueue(_records(2)) == 2
+    assert queue.enqueue(_records(3)) == 3
+    assert queue.enqueue(_records(4)) == 4
+    assert queue.depth() == 9
+
+    # requests are grouped up to INGEST_FLUSH_MAX_RECORDS records
+    assert queue.flush() == 5
+    assert queue.depth() == 4
+    assert queue.flush() == 4
+    assert queue.flush() == 0
+    assert [ len(t) for t in loader.transactions ] == [5, 4]
+
+
+def test_failed_requests(queue, loader):
+    queue.enqueue(_records(2))
+    queue.enqueue(_records(1, data='bad'))
+    queue.enqueue(_records(2))
+    assert queue.flush() == 4
+    assert queue.depth() == 0
+    # the group failed, so its requests were loaded one at a time
+    assert [ len(t) for t in loader.transactions ] == [2, 2]
+    failed = queue._connection().execute("SELECT records, error FROM failed").fetchall()
+    assert len(failed) == 1
+    assert 'bad record' in failed[0][1]
+
+
+def test_abandoned_claims(queue, loader):
+    queue.enqueue(_records(2))
+    claim, requests = queue._claim()
+    assert len(requests) == 1
+    # claimed requests aren't flushed again...
+    assert queue.flush() == 0
+    # ...unless their claim has expired
+    queue._claim_timeout = -1
+    assert queue.flush() == 2
+    assert queue.depth() == 0
+
+
+def test_mixed_modes_one_transaction(queue, loader):
+    queue.enqueue(_records(2), 'ignore')
+    queue.enqueue(_records(1), None)
+    queue.enqueue(_records(1, data='bad'), 'update')
+    assert queue.flush() == 3
+    # the failed group wasn't stored:  each request was loaded once
+    assert [ len(t) for t in loader.transactions ] == [2, 1]
+    assert queue._connection().execute("SELECT COUNT(*) FROM failed").fetchone()[0] == 1
+
+
+def test_connection_errors(queue, loader):
+    queue.enqueue(_records(2))
+    queue.enqueue(_records(1, data='offline'))
+    with pytest.raises(psycopg2.OperationalError):
+        queue.flush()
+    # the group is loaded one at a time only for errors in the records
+    assert not loader.transactions
+    assert queue.depth() == 3
+    assert queue._connection().execute("SELECT COUNT(*) FROM failed").fetchone()[0] == 0
+    # the requests aren't claimed anymore
+    assert len(queue._claim()[1]) == 2
+
+
+def test_worker_flusher(tmp_path, loader):
+    import flask
+    config = dict(INGEST_QUEUE=f"sqlite:///{tmp_path / 'queue.db'}", INGEST_QUEUE_FLUSHER='external',
+                  INGEST_FLUSH_INTERVAL=0.01, DB_USER='u', DB_PASSWORD='p', DB_HOST='h', DB_NAME='n')
+    IngestQueue(_App(**config)).enqueue(_records(3))
+    app = flask.Flask(__name__)
+    app.config.update(config, INGEST_QUEUE_FLUSHER='worker')
+    q = IngestQueue(app)
+    try:
+        # the flusher isn't started outside of the serving processes...
+        assert q._flusher is None
+        # ...where records queued before the start are loaded without new requests
+        app.test_client().get('/')
+        deadline = time.monotonic() + 10
+        while q.depth() > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert q.depth() == 0
+        assert [ len(t) for t in loader.transactions ] == [3]
+    finally:
+        q.stop()
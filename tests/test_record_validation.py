@@ -0,0 +1,90 @@
+
+import pytest
+
+import tdmq.db
+from tdmq.errors import RecordValidationError
+from tdmq.record_validation import RecordValidator
+
+jsonschema = pytest.importorskip('jsonschema')
+
+TEMPERATURE_SCHEMA = {
+    'type': 'object',
+    'properties': {'temperature': {'type': 'number'}},
+    'required': ['temperature'],
+}
+
+
+class _App:
+    def __init__(self, **config):
+        self.config = config
+
+
+class _DB:
+    """
+    Fake entity type and source tables.  Counts the lookups.
+    """
+    def __init__(self):
+        self.schemas = {('Station', 'WeatherObserver'): TEMPERATURE_SCHEMA, ('Station', 'TrafficObserver'): None}
+        self.sources = [('6cb10168-c65b-48fa-af9b-a3ca6d03156d', 's1', 'Station', 'WeatherObserver'),
+                        ('5ba7e3d4-5d4e-5e2f-b1c1-3d8e9b0e1c2a', 's2', 'Station', 'TrafficObserver')]
+        self.schema_queries = 0
+        self.source_queries = 0
+
+    def get_entity_type_schemas(self):
+        self.schema_queries += 1
+        return [ k + (v,) for k, v in self.schemas.items() ]
+
+    def get_source_entity_types(self, tdmq_ids, external_ids):
+        self.source_queries += 1
+        return [ s for s in self.sources if s[0] in tdmq_ids or s[1] in external_ids ]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = _DB()
+    monkeypatch.setattr(tdmq.db, 'get_entity_type_schemas', db.get_entity_type_schemas)
+    monkeypatch.setattr(tdmq.db, 'get_source_entity_types', db.get_source_entity_types)
+    return db
+
+
+def test_validate(db):
+    validator = RecordValidator(_App())
+    good = {'source': 's1', 'data': {'temperature': 20}}
+    validator.validate([good, {'tdmq_id': db.sources[0][0], 'data': {'temperature': 1.5}}])
+    # no schema for the entity type, or unknown source
+    validator.validate([{'source': 's2', 'data': {'count': 'x'}}, {'source': 's3', 'data': {}}])
+
+    with pytest.raises(RecordValidationError) as excinfo:
+        validator.validate([good, {'source': 's1', 'data': {'temperature': 'hot'}}, good,
+                            {'source': 's1', 'data': {}}], offset=10)
+    assert excinfo.value.status == 400
+    assert [ e['record'] for e in excinfo.value.errors ] == [11, 13]
+    assert excinfo.value.errors[0]['source'] == 's1'
+    assert excinfo.value.errors[0]['errors'][0].startswith('temperature: ')
+
+
+def test_schemas_cached(db):
+    validator = RecordValidator(_App(RECORD_SCHEMA_REFRESH_INTERVAL=3600))
+    records = [{'source': 's1', 'data': {'temperature': 20}}]
+    for _ in range(3):
+        validator.validate(records)
+    assert db.schema_queries == 1
+    assert db.source_queries == 1
+
+    # changed schemas are picked up after invalidation
+    db.schemas[('Station', 'WeatherObserver')] = dict(TEMPERATURE_SCHEMA, properties={'temperature': {'type': 'string'}})
+    validator.validate(records)
+    validator.invalidate()
+    with pytest.raises(RecordValidationError):
+        validator.validate(records)
+    assert db.schema_queries == 2
+
+
+def test_disabled(db):
+    validator = RecordValidator(_App(RECORD_SCHEMA_VALIDATION=False))
+    validator.validate([{'source': 's1', 'data': {}}])
+    assert db.schema_queries == 0
+
+    # invalid schemas are ignored
+    db.schemas[('Station', 'WeatherObserver')] = {'type': 'no-such-type'}
+    RecordValidator(_App()).validate([{'source': 's1', 'data': {}}])
@@ -0,0 +1,139 @@
+
+from datetime import timedelta
+
+import pytest
+
+from tdmq.result_cache import ResultCache, make_key, to_epoch
+
+T0 = to_epoch('2019-05-02T11:00:00Z')
+
+
+class _App:
+    def __init__(self, **config):
+        self.config = config
+
+
+class _Query:
+    """
+    Fake bucketed query over `records`, a list of (epoch time, value), with
+    10-second buckets.  Counts the records read from the "database".
+    """
+    def __init__(self, records):
+        self.records = records
+        self.records_read = 0
+
+    def __call__(self, args):
+        after, before = to_epoch(args.get('after')), to_epoch(args.get('before'))
+        buckets = dict()
+        for t, v in self.records:
+            if (after is None or t >= after) and (before is None or t < before):
+                self.records_read += 1
+                b = t - t % 10
+                buckets[b] = buckets.get(b, 0) + v
+        return [ (b, None, v) for b, v in sorted(buckets.items()) ]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path):
+    setting = 'memory' if request.param == 'memory' else f"sqlite:///{tmp_path / 'cache.db'}"
+    return ResultCache(_App(RESULT_CACHE=setting))
+
+
+def test_key_normalization():
+    args = {'bucket': timedelta(seconds=10), 'op': 'sum', 'fields': ['a', 'b'], 'fill': None}
+    assert make_key('id', args) == make_key('id', {'fields': ['a', 'b'], 'op': 'sum', 'bucket': timedelta(seconds=10)})
+    assert make_key('id', args) != make_key('id', dict(args, fields=['b', 'a']))
+    assert make_key('id', args) != make_key('other', args)
+
+
+def test_disabled():
+    assert not ResultCache(_App()).enabled
+    with pytest.raises(ValueError):
+        ResultCache(_App(RESULT_CACHE='redis://localhost'))
+
+
+def test_closed_interval(cache):
+    query = _Query([ (T0 + i, 1) for i in range(30) ])
+    args = {'bucket': timedelta(seconds=10), 'after': '2019-05-02T11:00:00Z', 'before': '2019-05-02T11:00:30Z'}
+    rows = cache.fetch('s1', args, query)
+    assert [ r[2] for r in rows ] == [10, 10, 10]
+    assert cache.fetch('s1', args, query) == rows
+    assert query.records_read == 30
+
+    # records of other sources, or outside the interval, don't invalidate the entry
+    cache.invalidate([('s2', T0 + 1), ('s1', '2019-05-02T12:00:00Z')])
+    assert cache.fetch('s1', args, query) == rows
+    assert query.records_read == 30
+
+    query.records.append((T0 + 15, 1))
+    cache.invalidate([('s1', '2019-05-02T11:00:15Z')])
+    assert [ r[2] for r in cache.fetch('s1', args, query) ] == [10, 11, 10]
+    assert query.records_read == 61
+
+
+def test_open_interval_recomputes_last_bucket(cache):
+    query = _Query([ (T0 + i, 1) for i in range(25) ])
+    args = {'bucket': timedelta(seconds=10), 'after': '2019-05-02T11:00:00Z'}
+    assert [ r[2] for r in cache.fetch('s1', args, query) ] == [10, 10, 5]
+    assert query.records_read == 25
+
+    # new records in the last bucket and after it don't invalidate the entry
+    query.records.extend((T0 + i, 1) for i in range(25, 35))
+    cache.invalidate([ ('s1', T0 + i) for i in range(25, 35) ])
+    assert [ r[2] for r in cache.fetch('s1', args, query) ] == [10, 10, 10, 5]
+    assert query.records_read == 25 + 15  # only the records from the last bucket on
+
+    # late records in the completed buckets do
+    query.records.append((T0 + 1, 1))
+    cache.invalidate([('s1', T0 + 1)])
+    assert [ r[2] for r in cache.fetch('s1', args, query) ] == [11, 10, 10, 5]
+    assert query.records_read == 40 + 36
+
+
+def test_open_interval_gapfill_not_cached(cache):
+    query = _Query([ (T0 + i, 1) for i in range(5) ])
+    args = {'bucket': timedelta(seconds=10), 'fill': 'null', 'after': '2019-05-02T11:00:00Z'}
+    cache.fetch('s1', args, query)
+    cache.fetch('s1', args, query)
+    assert query.records_read == 10
+
+
+def test_max_entries(tmp_path):
+    for setting in ('memory', f"sqlite:///{tmp_path / 'cache.db'}"):
+        cache = ResultCache(_App(RESULT_CACHE=setting, RESULT_CACHE_MAX_ENTRIES=1))
+        query = _Query([(T0, 1)])
+        args = {'bucket': timedelta(seconds=10), 'before': '2019-05-02T11:00:30Z'}
+        cache.fetch('s1', args, query)
+        cache.fetch('s2', args, query)
+        cache.fetch('s1', args, query)
+        assert query.records_read == 3
+
+
+def test_time_key_normalization():
+    args = {'bucket': timedelta(seconds=10), 'after': '2019-05-02T11:00:00Z'}
+    assert make_key('id', args) == make_key('id', dict(args, after='2019-05-02T11:00:00+00:00'))
+    assert make_key('id', args) == make_key('id', dict(args, after='2019-05-02 13:00:00+02:00'))
+    assert make_key('id', args) != make_key('id', dict(args, after='2019-05-02T11:00:01Z'))
+
+
+def test_streamed_rows(cache):
+    query = _Query([ (T0 + i, 1) for i in range(30) ])
+    args = {'bucket': timedelta(seconds=10), 'after': '2019-05-02T11:00:00Z', 'before': '2019-05-02T11:00:30Z'}
+    rows = cache.fetch_iter('s1', args, query)
+    assert next(rows)[2] == 10
+    # the result is cached once it has been read completely
+    assert cache.fetch('s1', args, query) == [(T0, None, 10), (T0 + 10, None, 10), (T0 + 20, None, 10)]
+    assert query.records_read == 60
+    assert len(list(rows)) == 2
+    cache.fetch('s1', args, query)
+    assert query.records_read == 60
+
+
+def test_max_entry_size(tmp_path):
+    args = {'bucket': timedelta(seconds=10), 'before': '2019-05-02T11:00:30Z'}
+    for config in ({'RESULT_CACHE_MAX_ROWS': 2}, {'RESULT_CACHE_MAX_ENTRY_SIZE': 20}):
+        cache = ResultCache(_App(RESULT_CACHE='memory', **config))
+        query = _Query([ (T0 + i, 1) for i in range(30) ])
+        assert len(cache.fetch('s1', args, query)) == 3
+        assert len(cache.fetch('s1', args, query)) == 3
+        assert query.records_read == 60